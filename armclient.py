@@ -0,0 +1,238 @@
+'''armclient.py - pooled HTTP client for the Azure Resource Manager scale set REST calls'''
+import json
+import os
+import threading
+import time
+
+import metrics
+import ratelimit
+
+COMP_API = '2019-03-01'
+DEFAULT_RM_ENDPOINT = 'https://management.azure.com'
+
+
+class ArmClient():
+    '''owns a keep-alive requests session shared by the vmss, VMSSZ and subscription classes
+       - connections are pooled per host, so a refresh cycle pays for one TLS handshake
+         instead of one per call
+       - idempotent GETs are retried on connection errors and 5xx responses; actions are
+         never retried by the transport, so an action can't be submitted twice
+       - every request is paced by a ratelimit.RateGovernor, and a 429 response is waited
+         out and sent again up to throttle_retries times instead of being returned
+       - pass a transport (a requests adapter such as FakeTransport) to replace the network
+       - each request's latency, payload sizes, status and retries are recorded in a
+         metrics.Registry
+    '''
+
+    def __init__(self, endpoint=None, pool_size=10, timeout=(5, 60), retries=3, backoff=0.5,
+                 transport=None, governor=None, throttle_retries=5, registry=None):
+        '''class initialization routine
+           - endpoint defaults to AZURE_RM_ENDPOINT, or the public cloud
+           - timeout is a (connect, read) tuple in seconds
+           - governor defaults to a RateGovernor of this client's own
+           - registry defaults to the process wide metrics registry
+        '''
+        if endpoint is None:
+            endpoint = os.environ.get('AZURE_RM_ENDPOINT', DEFAULT_RM_ENDPOINT)
+        self.endpoint = endpoint.rstrip('/')
+        self.timeout = timeout
+        self.governor = governor or ratelimit.RateGovernor()
+        self.throttle_retries = throttle_retries
+        self.registry = registry or metrics.get_registry()
+        # requests is imported on first use so importing the scale set classes stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.session = requests.Session()
+        if transport is None:
+            retry = Retry(total=retries, connect=retries, read=retries, status=retries,
+                          backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+                          allowed_methods=frozenset(['GET', 'HEAD']), raise_on_status=False,
+                          respect_retry_after_header=True)
+            transport = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                                    max_retries=retry)
+        self.session.mount('https://', transport)
+        self.session.mount('http://', transport)
+
+    def close(self):
+        '''close the pooled connections'''
+        self.session.close()
+
+    def vmss_url(self, sub_id, rgname, vmssname, path='', query=''):
+        '''build the URL of a scale set, or of a path below it'''
+        return ''.join([self.endpoint, '/subscriptions/', sub_id, '/resourceGroups/', rgname,
+                        '/providers/Microsoft.Compute/virtualMachineScaleSets/', vmssname,
+                        path, '?', query, 'api-version=', COMP_API])
+
+    def request(self, method, url, access_token, body=None, etag=None):
+        '''do an HTTP request on the pooled session and return the raw response
+           - access_token is a token string, or a TokenProvider which is asked for a new
+             token and the request sent once more if the response is a 401
+        '''
+        token_provider = None
+        if not isinstance(access_token, str):
+            token_provider = access_token
+            access_token = token_provider.get()
+        response = self.send(method, url, access_token, body, etag)
+        if response.status_code == 401 and token_provider is not None:
+            # a rejected request wasn't acted on, so it is safe to send it again
+            self.registry.inc('arm_retries_total', reason='unauthorized')
+            response = self.send(method, url, token_provider.renew(access_token), body, etag)
+        return response
+
+    def send(self, method, url, access_token, body=None, etag=None):
+        '''send an HTTP request with a token string when the governor allows it
+           - a throttled request wasn't acted on, so it is safe to send it again
+        '''
+        headers = {'Authorization': 'Bearer ' + access_token}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        for attempt in range(self.throttle_retries + 1):
+            waited = self.governor.acquire(method, url)
+            if waited > 0:
+                self.registry.observe('arm_throttle_wait_seconds', waited)
+            start_time = time.perf_counter()
+            response = self.session.request(method, url, data=body, headers=headers,
+                                            timeout=self.timeout)
+            response_bytes = len(response.content)  # read the body inside the timing
+            self.registry.record_request(method, url, response.status_code,
+                                         time.perf_counter() - start_time, response_bytes,
+                                         len(body) if body is not None else 0)
+            # connection errors and 5xx responses retried by the transport
+            transport_retries = getattr(response.raw, 'retries', None)
+            if transport_retries is not None and len(transport_retries.history) > 0:
+                self.registry.inc('arm_retries_total', len(transport_retries.history),
+                                  reason='transport')
+            if self.governor.observe(method, url, response) is None:
+                break
+            if attempt < self.throttle_retries:
+                self.registry.inc('arm_retries_total', reason='throttled')
+        return response
+
+    def get(self, url, access_token, etag=None):
+        '''do a GET, sending If-None-Match when an ETag is known, and return the response'''
+        return self.request('GET', url, access_token, etag=etag)
+
+    def get_json(self, url, access_token):
+        '''do a GET and return the JSON body'''
+        return self.get(url, access_token).json()
+
+    def get_pages(self, url, access_token):
+        '''GET a list and follow its nextLink chain, yielding each page's JSON body
+           - a page without a value list (i.e. an error) is yielded and ends the chain
+        '''
+        while url is not None:
+            page = self.get_json(url, access_token)
+            yield page
+            if 'value' not in page:
+                return
+            url = page.get('nextLink')
+
+    def get_all(self, url, access_token):
+        '''GET a complete list, returning {'value': [...]} or the first error body'''
+        value_list = []
+        for page in self.get_pages(url, access_token):
+            if 'value' not in page:
+                return page
+            value_list.extend(page['value'])
+        return {'value': value_list}
+
+    # scale set calls - same arguments as the azurerm functions they replace
+    def list_vmss_sub(self, access_token, sub_id):
+        '''list the VM scale sets in a subscription'''
+        url = ''.join([self.endpoint, '/subscriptions/', sub_id,
+                       '/providers/Microsoft.Compute/virtualMachineScaleSets?api-version=',
+                       COMP_API])
+        return self.get_all(url, access_token)
+
+    def update_vmss(self, access_token, sub_id, rgname, vmssname, body):
+        '''PUT a scale set model'''
+        return self.request('PUT', self.vmss_url(sub_id, rgname, vmssname), access_token, body)
+
+    def scale_vmss(self, access_token, sub_id, rgname, vmssname, capacity):
+        '''set the capacity of a scale set'''
+        body = json.dumps({'sku': {'capacity': str(capacity)}})
+        return self.request('PATCH', self.vmss_url(sub_id, rgname, vmssname), access_token, body)
+
+    def vmss_action(self, access_token, sub_id, rgname, vmssname, action, instance_ids='["*"]'):
+        '''POST a scale set action (start, restart, powerOff, deallocate, reimage,
+           manualupgrade or delete) to a JSON list of instance ids, default all VMs
+        '''
+        body = '{"instanceIds" : ' + instance_ids + '}'
+        return self.request('POST', self.vmss_url(sub_id, rgname, vmssname, '/' + action),
+                            access_token, body)
+
+    def list_vmss_vms(self, access_token, sub_id, rgname, vmssname):
+        '''list the VM model views of a scale set'''
+        return self.get_all(self.vmss_url(sub_id, rgname, vmssname, '/virtualMachines'),
+                            access_token)
+
+    def list_vmss_vm_instance_view(self, access_token, sub_id, rgname, vmssname):
+        '''list the VM instance views of a scale set'''
+        return self.get_all(self.instance_view_url(sub_id, rgname, vmssname), access_token)
+
+    def list_vmss_vm_instance_view_pg(self, access_token, sub_id, rgname, vmssname, link=None):
+        '''get one page of VM instance views, the first page unless a nextLink is given'''
+        if link is None:
+            link = self.instance_view_url(sub_id, rgname, vmssname)
+        return self.get_json(link, access_token)
+
+    def instance_view_url(self, sub_id, rgname, vmssname):
+        '''URL of the first page of VM instance views'''
+        return self.vmss_url(sub_id, rgname, vmssname, '/virtualMachines',
+                             '$expand=instanceView&$select=instanceView&')
+
+    def get_vmss_vm_instance_view(self, access_token, sub_id, rgname, vmssname, instance_id):
+        '''get the instance view of one VM'''
+        return self.get_json(self.vmss_url(sub_id, rgname, vmssname, '/virtualMachines/' +
+                                           str(instance_id) + '/instanceView'), access_token)
+
+
+class FakeTransport():
+    '''requests transport adapter which answers from a local handler instead of the network
+       - handler(request) gets the requests.PreparedRequest and returns a
+         (status_code, body, headers) tuple, body being a JSON-serializable object
+    '''
+
+    def __init__(self, handler):
+        '''class initialization routine'''
+        self.handler = handler
+
+    def send(self, request, **kwargs):
+        '''build a response from the handler's answer'''
+        import requests
+        status_code, body, headers = self.handler(request)
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers or {})
+        response._content = json.dumps(body).encode('utf-8') if body is not None else b''
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+        return response
+
+    def close(self):
+        '''nothing to close'''
+        pass
+
+
+default_client = None
+default_client_lock = threading.Lock()
+
+
+def get_client():
+    '''return the client shared by default, creating it on first use'''
+    global default_client
+    with default_client_lock:
+        if default_client is None:
+            default_client = ArmClient()
+        return default_client
+
+
+def set_client(client):
+    '''replace the shared client, e.g. with one using a FakeTransport'''
+    global default_client
+    with default_client_lock:
+        default_client = client
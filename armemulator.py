@@ -0,0 +1,446 @@
+'''armemulator.py - local stand-in for the Azure Resource Manager VM scale set endpoints
+   - emulates listing scale sets, scale set models, VM model and instance views paged
+     with nextLink, scale set actions and the Azure-AsyncOperation protocol, so the tools
+     and benchmark.py can run without a live subscription
+   - scale sets can have any number of VMs, placement groups and availability zones, and
+     every request can be delayed by a fixed latency
+   - point the tools at it by setting AZURE_RM_ENDPOINT to the emulator URL
+'''
+import argparse
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+LIST_PATH = re.compile(r'^/subscriptions/([^/]+)/providers/Microsoft.Compute/'
+                       r'virtualMachineScaleSets$')
+VMSS_PATH = re.compile(r'^/subscriptions/([^/]+)/resourceGroups/([^/]+)/providers/'
+                       r'Microsoft.Compute/virtualMachineScaleSets/([^/]+)(?:/([^/]+))?$')
+VM_PATH = re.compile(r'^/subscriptions/([^/]+)/resourceGroups/([^/]+)/providers/'
+                     r'Microsoft.Compute/virtualMachineScaleSets/([^/]+)/virtualMachines/'
+                     r'([^/]+)/instanceView$')
+OPERATION_PATH = re.compile(r'^/subscriptions/([^/]+)/providers/Microsoft.Compute/'
+                            r'locations/([^/]+)/operations/([^/]+)$')
+API_VERSION = '2019-03-01'
+
+# action -> (VM power state while the operation runs, power state once it is done)
+# a final state of None removes the VMs
+ACTION_STATES = {'start': ('starting', 'running'), 'restart': ('starting', 'running'),
+                 'powerOff': ('stopping', 'stopped'),
+                 'deallocate': ('deallocating', 'deallocated'),
+                 'reimage': ('starting', 'running'), 'manualupgrade': ('starting', 'running'),
+                 'delete': ('stopping', None)}
+
+
+def make_vmss_model(sub_id, rgname, vmssname, capacity=5, location='westus', zones=None,
+                    single_placement_group=True, tags=None):
+    '''create a minimal scale set model with the properties the vmss class reads'''
+    model = {
+        'id': '/subscriptions/' + sub_id + '/resourceGroups/' + rgname +
+              '/providers/Microsoft.Compute/virtualMachineScaleSets/' + vmssname,
+        'name': vmssname,
+        'location': location,
+        'sku': {'name': 'Standard_D1_v2', 'tier': 'Standard', 'capacity': capacity},
+        'properties': {
+            'overprovision': False,
+            'singlePlacementGroup': single_placement_group,
+            'upgradePolicy': {'mode': 'Manual'},
+            'provisioningState': 'Succeeded',
+            'virtualMachineProfile': {
+                'osProfile': {'adminUsername': 'azure', 'computerNamePrefix': vmssname[:9]},
+                'storageProfile': {
+                    'imageReference': {'publisher': 'Canonical', 'offer': 'UbuntuServer',
+                                       'sku': '16.04-LTS', 'version': 'latest'},
+                    'osDisk': {'createOption': 'FromImage'}}}}}
+    if zones:
+        model['zones'] = list(zones)
+    if tags:
+        model['tags'] = dict(tags)
+    return model
+
+
+class EmulatedVMSS():
+    '''model and VMs of one emulated scale set'''
+
+    def __init__(self, model, placement_groups=1):
+        '''class initialization routine'''
+        self.model = model
+        self.placement_groups = max(1, placement_groups)
+        self.zones = model.get('zones', [])
+        self.vms = {}  # instance id -> VM record, in instance id order
+        self.next_instance_id = 0
+        self.scale_to(model['sku']['capacity'])
+
+    def add_vm(self):
+        '''add a running VM, spreading VMs across placement groups, zones and domains'''
+        number = self.next_instance_id
+        self.next_instance_id += 1
+        pg = number % self.placement_groups
+        per_group = number // self.placement_groups
+        zone = ''
+        if self.zones:
+            zone = self.zones[per_group % len(self.zones)]
+            per_group //= len(self.zones)
+        self.vms[str(number)] = {'pg': 'pg-' + str(pg), 'fd': per_group % 5,
+                                 'ud': (per_group // 5) % 5, 'zone': zone,
+                                 'power': 'running', 'latestModelApplied': True}
+
+    def scale_to(self, capacity):
+        '''add VMs or remove the newest ones to reach a capacity'''
+        while len(self.vms) < capacity:
+            self.add_vm()
+        while len(self.vms) > capacity:
+            self.vms.popitem()
+        self.model['sku']['capacity'] = len(self.vms)
+
+    def instance_view(self, instance_id):
+        '''the instance view of one VM'''
+        vm = self.vms[instance_id]
+        instance_view = {'platformUpdateDomain': vm['ud'], 'platformFaultDomain': vm['fd'],
+                         'statuses': [{'code': 'ProvisioningState/succeeded'},
+                                      {'code': 'PowerState/' + vm['power']}]}
+        if self.model['properties']['singlePlacementGroup'] is False:
+            instance_view['placementGroupId'] = vm['pg']
+        return instance_view
+
+    def vm_view(self, instance_id, expand):
+        '''a VM list entry - the instance view with $expand=instanceView, else the model
+           - None if the VM has been deleted since the list was started
+        '''
+        vm = self.vms.get(instance_id)
+        if vm is None:
+            return None
+        if expand is True:
+            return {'instanceId': instance_id,
+                    'properties': {'instanceView': self.instance_view(instance_id)}}
+        entry = {'instanceId': instance_id, 'name': self.model['name'] + '_' + instance_id,
+                 'properties': {'latestModelApplied': vm['latestModelApplied'],
+                                'provisioningState': 'Succeeded'}}
+        if vm['zone'] != '':
+            entry['zones'] = [vm['zone']]
+        return entry
+
+    def select(self, instance_ids):
+        '''the instance ids an action applies to - '*' or no list means all VMs'''
+        if instance_ids is None or '*' in instance_ids:
+            return list(self.vms)
+        return [vmid for vmid in instance_ids if vmid in self.vms]
+
+
+class ArmEmulator():
+    '''in-process HTTP server emulating the VM scale set endpoints of a subscription'''
+
+    def __init__(self, host='127.0.0.1', port=0, operation_time=2.0, sub_id='emulated-sub',
+                 latency=0, page_size=100):
+        '''class initialization routine
+           - operation_time is how long each action runs
+           - latency is added to every request, in seconds
+           - page_size is the most entries per page of a list, further pages are linked
+             with nextLink
+        '''
+        self.host = host
+        self.port = port
+        self.operation_time = operation_time
+        self.sub_id = sub_id
+        self.latency = latency
+        self.page_size = page_size
+        self.scale_sets = {}     # (resource group, name) -> model
+        self.vmss = {}           # (resource group, name) -> EmulatedVMSS
+        self.operations = {}     # operation id -> operation record
+        self.fail_actions = set()  # actions which finish in the Failed state
+        self.request_count = 0
+        self.lock = threading.RLock()
+        self.server = None
+
+    @property
+    def endpoint(self):
+        '''base URL of the running emulator'''
+        return 'http://' + self.host + ':' + str(self.port)
+
+    def add_vmss(self, vmssname, rgname='vmssrg', capacity=5, location='westus',
+                 placement_groups=1, zones=None, tags=None):
+        '''add a scale set to the emulated subscription and return its model
+           - zones is a list of zone names like ['1', '2', '3'], VMs are spread across them
+           - more than one placement group makes it a large scale set
+        '''
+        model = make_vmss_model(self.sub_id, rgname, vmssname, capacity, location, zones,
+                                placement_groups <= 1, tags)
+        with self.lock:
+            self.scale_sets[(rgname, vmssname)] = model
+            self.vmss[(rgname, vmssname)] = EmulatedVMSS(model, placement_groups)
+        return model
+
+    def start(self):
+        '''start serving in a background thread, return the endpoint URL'''
+        self.server = ThreadingHTTPServer((self.host, self.port), EmulatorRequestHandler)
+        self.server.daemon_threads = True
+        self.server.emulator = self
+        self.port = self.server.server_address[1]
+        server_thread = threading.Thread(target=self.server.serve_forever, args=())
+        server_thread.daemon = True
+        server_thread.start()
+        return self.endpoint
+
+    def stop(self):
+        '''stop serving'''
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def start_operation(self, rgname, vmssname, action, instance_ids=None):
+        '''record a new operation, put its VMs in their transitional power state and return
+           its status URL
+        '''
+        operation_id = str(uuid.uuid4())
+        location = self.scale_sets[(rgname, vmssname)]['location']
+        with self.lock:
+            scale_set = self.vmss[(rgname, vmssname)]
+            instance_ids = scale_set.select(instance_ids) if action in ACTION_STATES else []
+            if action in ACTION_STATES:
+                for vmid in instance_ids:
+                    scale_set.vms[vmid]['power'] = ACTION_STATES[action][0]
+            self.operations[operation_id] = {
+                'vmss': (rgname, vmssname), 'action': action, 'start': time.time(),
+                'instance_ids': instance_ids, 'applied': False}
+        return self.endpoint + '/subscriptions/' + self.sub_id + \
+            '/providers/Microsoft.Compute/locations/' + location + '/operations/' + \
+            operation_id + '?api-version=' + API_VERSION
+
+    def get_operation_status(self, operation_id):
+        '''return the Azure-AsyncOperation status body of an operation'''
+        operation = self.operations[operation_id]
+        start = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(operation['start']))
+        status = {'name': operation_id, 'startTime': start, 'status': 'InProgress'}
+        if time.time() - operation['start'] >= self.operation_time:
+            if operation['action'] in self.fail_actions:
+                status['status'] = 'Failed'
+                status['error'] = {'code': 'EmulatedFailure',
+                                   'message': operation['action'] + ' failed'}
+            else:
+                status['status'] = 'Succeeded'
+        return status
+
+    def settle(self):
+        '''apply the final VM states of operations which have finished'''
+        with self.lock:
+            for operation_id, operation in self.operations.items():
+                if operation['applied'] is True:
+                    continue
+                status = self.get_operation_status(operation_id)['status']
+                if status == 'InProgress':
+                    continue
+                operation['applied'] = True
+                if operation['action'] not in ACTION_STATES:
+                    continue
+                scale_set = self.vmss[operation['vmss']]
+                final_state = ACTION_STATES[operation['action']][1]
+                if status == 'Failed':
+                    final_state = 'stopped' if final_state is not None else 'running'
+                for vmid in operation['instance_ids']:
+                    if vmid not in scale_set.vms:
+                        continue
+                    if final_state is None:
+                        del scale_set.vms[vmid]
+                        continue
+                    scale_set.vms[vmid]['power'] = final_state
+                    if operation['action'] in ('manualupgrade', 'reimage') and \
+                            status == 'Succeeded':
+                        scale_set.vms[vmid]['latestModelApplied'] = True
+                scale_set.model['sku']['capacity'] = len(scale_set.vms)
+
+    def get_vmss_model(self, rgname, vmssname):
+        '''return a scale set model with a provisioning state reflecting its operations'''
+        model = self.scale_sets[(rgname, vmssname)]
+        updating = False
+        with self.lock:
+            for operation_id, operation in self.operations.items():
+                if operation['vmss'] == (rgname, vmssname) and \
+                        self.get_operation_status(operation_id)['status'] == 'InProgress':
+                    updating = True
+        model['properties']['provisioningState'] = 'Updating' if updating else 'Succeeded'
+        return model
+
+    def list_page(self, url, keys, render):
+        '''return one page of a list, with a nextLink if there are more entries
+           - only the keys on the page are passed to render() to build their entries
+        '''
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        skip = int(query.pop('$skiptoken', ['0'])[0])
+        with self.lock:
+            entries = [render(key) for key in keys[skip:skip + self.page_size]]
+        page = {'value': [entry for entry in entries if entry is not None]}
+        if skip + self.page_size < len(keys):
+            query['$skiptoken'] = [str(skip + self.page_size)]
+            page['nextLink'] = self.endpoint + parsed.path + '?' + \
+                urlencode(query, doseq=True, safe='$')
+        return page
+
+
+class EmulatorRequestHandler(BaseHTTPRequestHandler):
+    '''routes ARM REST calls to the emulator'''
+    protocol_version = 'HTTP/1.1'  # keep-alive, like ARM
+    disable_nagle_algorithm = True  # headers and body are written separately
+
+    def log_message(self, format, *args):
+        '''keep the console quiet'''
+        pass
+
+    def send_json(self, status_code, body, headers=None):
+        '''send a JSON response'''
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_error_json(self, status_code, code, message):
+        '''send an ARM style error response'''
+        self.send_json(status_code, {'error': {'code': code, 'message': message}})
+
+    def read_body(self):
+        '''read and decode the JSON request body, if any'''
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return None
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def begin(self):
+        '''count the request, apply the emulated latency and settle finished operations'''
+        emulator = self.server.emulator
+        with emulator.lock:
+            emulator.request_count += 1
+        if emulator.latency > 0:
+            time.sleep(emulator.latency)
+        emulator.settle()
+        return emulator
+
+    def do_GET(self):
+        '''list scale sets or VMs, get a scale set model, a VM instance view or an
+           operation status
+        '''
+        emulator = self.begin()
+        parsed = urlparse(self.path)
+        path = parsed.path
+        match = OPERATION_PATH.match(path)
+        if match is not None:
+            if match.group(3) not in emulator.operations:
+                self.send_error_json(404, 'NotFound', 'operation not found')
+            else:
+                self.send_json(200, emulator.get_operation_status(match.group(3)))
+            return
+        if LIST_PATH.match(path) is not None:
+            self.send_json(200, emulator.list_page(self.path, sorted(emulator.scale_sets),
+                                                   lambda key: emulator.get_vmss_model(*key)))
+            return
+        match = VM_PATH.match(path)
+        if match is not None:
+            key = (match.group(2), match.group(3))
+            with emulator.lock:
+                if key not in emulator.vmss or match.group(4) not in emulator.vmss[key].vms:
+                    self.send_error_json(404, 'ResourceNotFound', 'VM not found')
+                    return
+                instance_view = emulator.vmss[key].instance_view(match.group(4))
+            self.send_json(200, instance_view)
+            return
+        match = VMSS_PATH.match(path)
+        if match is None or (match.group(2), match.group(3)) not in emulator.scale_sets:
+            self.send_error_json(404, 'NotFound', path + ' is not emulated')
+            return
+        key = (match.group(2), match.group(3))
+        if match.group(4) is None:
+            self.send_json(200, emulator.get_vmss_model(*key))
+        elif match.group(4) == 'virtualMachines':
+            expand = 'instanceView' in parse_qs(parsed.query).get('$expand', [])
+            scale_set = emulator.vmss[key]
+            with emulator.lock:
+                instance_ids = list(scale_set.vms)
+            self.send_json(200, emulator.list_page(self.path, instance_ids,
+                                                   lambda vmid: scale_set.vm_view(vmid, expand)))
+        else:
+            self.send_error_json(404, 'NotFound', path + ' is not emulated')
+
+    def do_POST(self):
+        '''start a scale set action like start, manualupgrade or reimage'''
+        emulator = self.begin()
+        match = VMSS_PATH.match(urlparse(self.path).path)
+        if match is None or match.group(4) is None or \
+                (match.group(2), match.group(3)) not in emulator.scale_sets:
+            self.send_error_json(404, 'NotFound', self.path + ' is not emulated')
+            return
+        body = self.read_body() or {}
+        status_url = emulator.start_operation(match.group(2), match.group(3), match.group(4),
+                                              body.get('instanceIds'))
+        self.send_json(202, {}, {'Azure-AsyncOperation': status_url})
+
+    def update_vmss(self, replace):
+        '''apply a PUT or PATCH to a scale set model'''
+        emulator = self.begin()
+        match = VMSS_PATH.match(urlparse(self.path).path)
+        if match is None or match.group(4) is not None or \
+                (match.group(2), match.group(3)) not in emulator.scale_sets:
+            self.send_error_json(404, 'NotFound', self.path + ' is not emulated')
+            return
+        body = self.read_body() or {}
+        key = (match.group(2), match.group(3))
+        with emulator.lock:
+            model = emulator.scale_sets[key]
+            if replace is True:
+                model.update({name: value for name, value in body.items() if name != 'id'})
+                # a new model is applied to existing VMs by a manual upgrade
+                for vm in emulator.vmss[key].vms.values():
+                    vm['latestModelApplied'] = False
+            elif 'sku' in body:
+                model['sku'].update(body['sku'])
+            emulator.vmss[key].scale_to(int(model['sku']['capacity']))
+        status_url = emulator.start_operation(match.group(2), match.group(3), 'update')
+        self.send_json(200, model, {'Azure-AsyncOperation': status_url})
+
+    def do_PUT(self):
+        '''update a scale set model'''
+        self.update_vmss(True)
+
+    def do_PATCH(self):
+        '''scale a scale set'''
+        self.update_vmss(False)
+
+
+def main():
+    '''run the emulator from the command line'''
+    parser = argparse.ArgumentParser(description='Local Azure VM scale set REST emulator')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--operation-time', type=float, default=2.0,
+                        help='seconds each emulated operation stays InProgress')
+    parser.add_argument('--vmss', action='append', default=[],
+                        help='name of a scale set to create, may be repeated')
+    parser.add_argument('--vms', type=int, default=5, help='VMs in each scale set')
+    parser.add_argument('--placement-groups', type=int, default=1,
+                        help='placement groups in each scale set')
+    parser.add_argument('--zones', help='comma separated zones, e.g. 1,2,3')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--page-size', type=int, default=100, help='entries per list page')
+    args = parser.parse_args()
+    emulator = ArmEmulator(port=args.port, operation_time=args.operation_time,
+                           latency=args.latency, page_size=args.page_size)
+    zones = args.zones.split(',') if args.zones else None
+    for vmssname in args.vmss or ['vmss1']:
+        emulator.add_vmss(vmssname, capacity=args.vms, placement_groups=args.placement_groups,
+                          zones=zones)
+    print('Serving on ' + emulator.start() + ' - set AZURE_RM_ENDPOINT to this URL')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
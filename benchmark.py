@@ -0,0 +1,229 @@
+'''benchmark.py - time the heatmap and upgrade paths against the local ARM emulator
+   - runs armemulator in-process with scale sets of each requested size and times loading
+     the instance view a page at a time, building the VM inventory, loading the details of
+     a zonal scale set, drawing the heatmaps and a rolling upgrade
+   - the rate governor is opened wide so the timings measure the client, not ARM pacing
+   - heatmaps are drawn on a canvas which only records calls, or with --tk on a real Tk
+     canvas (needs a display)
+'''
+import argparse
+import json
+import time
+
+import armclient
+import armemulator
+import heatmap
+import metrics
+import ratelimit
+import rollingupgrade
+import vmss
+import vmssz
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+class RecordingCanvas():
+    '''stand-in for a tk.Canvas which counts the calls the heatmap renderers make'''
+
+    def __init__(self, width=1300, height=800):
+        '''class initialization routine'''
+        self.width = width
+        self.height = height
+        self.item_count = 0
+        self.calls = 0
+
+    def create_item(self, *args, **kwargs):
+        '''create a canvas item, return its id'''
+        self.calls += 1
+        self.item_count += 1
+        return self.item_count
+
+    create_oval = create_text = create_line = create_rectangle = create_item
+
+    def record(self, *args, **kwargs):
+        '''count a call which changes existing items'''
+        self.calls += 1
+
+    delete = itemconfig = coords = record
+
+    def cget(self, option):
+        '''canvas options, only the size is needed'''
+        return str(getattr(self, option))
+
+
+class Benchmark():
+    '''runs each benchmark against an emulated scale set and collects one row per
+       (benchmark, size) with the elapsed seconds and the emulator requests it made
+    '''
+
+    def __init__(self, sizes, latency=0, page_size=100, operation_time=0.05,
+                 placement_groups=1, use_tk=False):
+        '''class initialization routine
+           - latency is added to every emulated request, in seconds
+           - operation_time is how long each emulated upgrade batch takes
+        '''
+        self.sizes = sizes
+        self.placement_groups = placement_groups
+        self.use_tk = use_tk
+        self.emulator = armemulator.ArmEmulator(operation_time=operation_time,
+                                                latency=latency, page_size=page_size)
+        self.client = None
+        self.results = []
+        self.root = None
+
+    def start(self):
+        '''create the scale sets and start the emulator'''
+        for size in self.sizes:
+            self.emulator.add_vmss('bench' + str(size), capacity=size,
+                                   placement_groups=self.placement_groups)
+            self.emulator.add_vmss('benchz' + str(size), capacity=size, zones=['1', '2', '3'])
+        endpoint = self.emulator.start()
+        governor = ratelimit.RateGovernor(read_rate=1e6, read_burst=1e6, write_rate=1e6,
+                                          write_burst=1e6)
+        self.client = armclient.ArmClient(endpoint=endpoint, governor=governor)
+
+    def stop(self):
+        '''stop the emulator'''
+        self.client.close()
+        self.emulator.stop()
+        if self.root is not None:
+            self.root.destroy()
+
+    def open(self, vmssname, scale_set_class):
+        '''create a vmss or VMSSZ object for an emulated scale set'''
+        model = self.emulator.get_vmss_model('vmssrg', vmssname)
+        return scale_set_class(vmssname, json.loads(json.dumps(model)), self.emulator.sub_id,
+                               'emulated-token', client=self.client)
+
+    def new_canvas(self):
+        '''a canvas to draw a heatmap on'''
+        if self.use_tk is False:
+            return RecordingCanvas()
+        import tkinter as tk
+        if self.root is None:
+            self.root = tk.Tk()
+        canvas = tk.Canvas(self.root, height=800, width=1300)
+        canvas.pack()
+        return canvas
+
+    def measure(self, name, size, fn):
+        '''time one benchmark, returning what fn returned'''
+        requests_before = self.emulator.request_count
+        start_time = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start_time
+        self.results.append({'benchmark': name, 'vms': size, 'seconds': round(elapsed, 4),
+                             'requests': self.emulator.request_count - requests_before})
+        return result
+
+    def grow_instance_view(self, scale_set):
+        '''load the instance view one page at a time the way the editor's heatmap does'''
+        scale_set.grow_vm_instance_view()
+        while 'nextLink' in scale_set.vm_instance_view:
+            scale_set.grow_vm_instance_view(scale_set.vm_instance_view['nextLink'])
+
+    def draw_domains(self, scale_set):
+        '''draw a placement group/FD/UD heatmap, then redraw it from a complete VM list'''
+        canvas = self.new_canvas()
+        domain_heatmap = heatmap.DomainHeatmap(canvas)
+        vm_list = scale_set.get_vm_list(scale_set.vm_instance_view['value'])
+        domain_heatmap.add_vms(vm_list)
+        domain_heatmap.update(vm_list)
+        if self.use_tk is True:
+            canvas.update_idletasks()
+            canvas.destroy()
+
+    def draw_zones(self, scale_set):
+        '''draw a zone/FD heatmap'''
+        canvas = self.new_canvas()
+        zone_heatmap = heatmap.ZoneHeatmap(canvas, 1300, 800)
+        zone_heatmap.update(scale_set.inventory)
+        if self.use_tk is True:
+            canvas.update_idletasks()
+            canvas.destroy()
+
+    def rolling_upgrade(self, scale_set, size):
+        '''upgrade every VM FD by FD in batches of 5% of the scale set'''
+        batchsize = max(1, size // 20)
+        upgrade = rollingupgrade.DomainRollingUpgrade(
+            scale_set, scale_set.get_domain_groups(), batchsize,
+            max_vms=batchsize * self.placement_groups, min_poll=0.02, max_poll=0.2)
+        if upgrade.run() is False:
+            raise RuntimeError('rolling upgrade of ' + scale_set.name + ' failed')
+
+    def run_size(self, size):
+        '''run every benchmark on the scale sets of one size'''
+        scale_set = self.open('bench' + str(size), vmss.vmss)
+        self.measure('grow_vm_instance_view', size,
+                     lambda: self.grow_instance_view(scale_set))
+        self.measure('set_domain_lists', size, scale_set.set_domain_lists)
+        self.measure('iter_vm_instance_view', size, scale_set.load_vm_instance_view)
+        self.measure('draw_domain_heatmap', size, lambda: self.draw_domains(scale_set))
+        self.measure('rolling_upgrade', size, lambda: self.rolling_upgrade(scale_set, size))
+        zonal_scale_set = self.open('benchz' + str(size), vmssz.VMSSZ)
+        self.measure('VMSSZ.init_vm_details', size, zonal_scale_set.init_vm_details)
+        self.measure('draw_zone_heatmap', size, lambda: self.draw_zones(zonal_scale_set))
+
+    def run(self):
+        '''run the benchmarks on every size, return the result rows'''
+        self.start()
+        try:
+            for size in self.sizes:
+                self.run_size(size)
+        finally:
+            self.stop()
+        return self.results
+
+
+def print_table(results):
+    '''print the results with one row per benchmark and one column per size'''
+    sizes = sorted({row['vms'] for row in results})
+    names = []
+    for row in results:
+        if row['benchmark'] not in names:
+            names.append(row['benchmark'])
+    cells = {(row['benchmark'], row['vms']): row for row in results}
+    print('{:<24}'.format('seconds (requests)') +
+          ''.join('{:>18}'.format(str(size) + ' VMs') for size in sizes))
+    for name in names:
+        line = '{:<24}'.format(name)
+        for size in sizes:
+            row = cells.get((name, size))
+            text = '-' if row is None else \
+                '{:.3f} ({})'.format(row['seconds'], row['requests'])
+            line += '{:>18}'.format(text)
+        print(line)
+
+
+def main():
+    '''run the benchmarks from the command line'''
+    parser = argparse.ArgumentParser(description='Benchmark the VMSS dashboard against a '
+                                     'local ARM emulator')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='scale set sizes to benchmark')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every emulated request')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='VMs per instance view page')
+    parser.add_argument('--operation-time', type=float, default=0.05,
+                        help='seconds each emulated upgrade batch takes')
+    parser.add_argument('--placement-groups', type=int, default=1,
+                        help='placement groups in the non-zonal scale sets')
+    parser.add_argument('--tk', action='store_true', help='draw on a real Tk canvas')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='also save the ARM call and render timings to FILE, see metrics.py')
+    args = parser.parse_args()
+    benchmark = Benchmark(args.sizes, args.latency, args.page_size, args.operation_time,
+                          args.placement_groups, args.tk)
+    results = benchmark.run()
+    if args.json is True:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    if args.metrics is not None:
+        metrics.save(args.metrics)
+
+
+if __name__ == '__main__':
+    main()
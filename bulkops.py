@@ -0,0 +1,156 @@
+'''bulkops.py - run one scale set action on many scale sets with bounded concurrency'''
+import fnmatch
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import vmss
+
+# bulk action -> (vmss method, whether it takes the instance id list)
+ACTIONS = {'start': ('poweron', False), 'restart': ('restart', False),
+           'poweroff': ('poweroff', False), 'dealloc': ('dealloc', False),
+           'reimage': ('reimagevm', True), 'upgrade': ('upgradevm', True)}
+
+
+def match_tags(model_tags, tags):
+    '''check a scale set's tags against a list of "key" or "key=value" selectors'''
+    model_tags = {key.lower(): value for key, value in (model_tags or {}).items()}
+    for tag in tags:
+        key, _, value = tag.partition('=')
+        if key.lower() not in model_tags:
+            return False
+        if value != '' and model_tags[key.lower()] != value:
+            return False
+    return True
+
+
+def select(vmss_catalog, name='*', resource_group=None, location=None, tags=None,
+           sub_id=None):
+    '''return the catalog keys of the scale sets matching a selector
+       - name and resource_group are shell-style globs, e.g. 'dev-*'
+       - location and resource group are matched case-insensitively
+       - tags is a list of "key" or "key=value" strings which must all match
+    '''
+    keys = []
+    for key in vmss_catalog.keys(sub_id):
+        model = vmss_catalog.models[key]
+        if not fnmatch.fnmatchcase(key[2], name):
+            continue
+        if resource_group is not None and \
+                not fnmatch.fnmatch(key[1].lower(), resource_group.lower()):
+            continue
+        if location is not None and model['location'].lower() != location.lower():
+            continue
+        if tags and not match_tags(model.get('tags'), tags):
+            continue
+        keys.append(key)
+    return keys
+
+
+def percentile(values, fraction):
+    '''nearest-rank percentile of a list of numbers, None if it is empty'''
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class BulkOperation():
+    '''submits an action to a list of scale sets from a pool of worker threads
+       - at most max_workers actions are in flight at once; the client's rate governor
+         paces the calls, and min_interval optionally spaces submissions further apart
+       - with wait=True each worker polls its operation until it is done before taking the
+         next scale set
+       - results are one row per scale set with the submit latency and the total duration
+    '''
+
+    def __init__(self, vmss_catalog, keys, action, max_workers=8, min_interval=0,
+                 wait=False, progress=None):
+        '''class initialization routine
+           - action is one of ACTIONS
+           - progress(row) is called from the worker threads as each scale set finishes
+        '''
+        if action not in ACTIONS:
+            raise ValueError('Unknown bulk action: ' + action)
+        self.vmss_catalog = vmss_catalog
+        self.keys = list(keys)
+        self.action = action
+        self.max_workers = max_workers
+        self.min_interval = min_interval
+        self.wait = wait
+        self.progress = progress
+        self.results = []
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.next_submit = 0  # earliest time the next action may be submitted
+
+    def throttle(self):
+        '''wait for this worker's submission slot'''
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_submit)
+            self.next_submit = slot + self.min_interval
+        if slot > now:
+            self.stop_event.wait(slot - now)
+
+    def run_one(self, key):
+        '''submit the action to one scale set and optionally wait for it'''
+        row = {'subscriptionId': key[0], 'resourceGroup': key[1], 'name': key[2],
+               'action': self.action, 'state': 'Skipped', 'error': None,
+               'submitLatency': None, 'duration': None}
+        if self.stop_event.is_set():
+            return self.finish_row(row)
+        self.throttle()
+        method, takes_ids = ACTIONS[self.action]
+        start_time = time.time()
+        try:
+            scale_set = self.vmss_catalog.open(key, vmss.vmss)
+            if takes_ids is True:
+                operation = getattr(scale_set, method)('["*"]')
+            else:
+                operation = getattr(scale_set, method)()
+            row['submitLatency'] = round(time.time() - start_time, 3)
+            if self.wait is True and not operation.is_done():
+                operation.poll_until_done(scale_set.access_token, stop_event=self.stop_event)
+            row['state'] = operation.state
+            row['error'] = None if operation.error is None else str(operation.error)
+        except Exception as error:
+            row['state'] = 'Failed'
+            row['error'] = str(error)
+        row['duration'] = round(time.time() - start_time, 3)
+        return self.finish_row(row)
+
+    def finish_row(self, row):
+        '''record a result row'''
+        with self.lock:
+            self.results.append(row)
+        if self.progress is not None:
+            self.progress(row)
+        return row
+
+    def run(self):
+        '''run the action on every scale set and return the result rows in key order'''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            rows = list(executor.map(self.run_one, self.keys))
+        return rows
+
+    def stop(self):
+        '''stop submitting and waiting - scale sets not yet submitted are skipped'''
+        self.stop_event.set()
+
+    def summary(self):
+        '''aggregate the results: counts by state and submit latency/duration percentiles'''
+        with self.lock:
+            results = list(self.results)
+        states = {}
+        for row in results:
+            states[row['state']] = states.get(row['state'], 0) + 1
+        latencies = [row['submitLatency'] for row in results if row['submitLatency'] is not None]
+        durations = [row['duration'] for row in results if row['duration'] is not None]
+        return {'action': self.action, 'scaleSets': len(self.keys), 'states': states,
+                'submitLatency': {'p50': percentile(latencies, 0.5),
+                                  'p95': percentile(latencies, 0.95),
+                                  'max': percentile(latencies, 1)},
+                'duration': {'p50': percentile(durations, 0.5),
+                             'p95': percentile(durations, 0.95),
+                             'max': percentile(durations, 1)}}
@@ -0,0 +1,182 @@
+'''catalog.py - scale sets of many subscriptions, listed concurrently into one index'''
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import subscription
+
+
+def get_resource_group(vmss_id):
+    '''extract the resource group name from a scale set resource id'''
+    return vmss_id[vmss_id.index('resourceGroups/') + 15:vmss_id.index('/providers')]
+
+
+def load_subscriptions(config_data, client=None):
+    '''create a subscription object for each subscription in a vmssconfig.json dict
+       - the top level tenantId, appId, appSecret and subscriptionId describe one
+         subscription, as before
+       - an optional "subscriptions" list adds more, each entry either a subscription id or a
+         dict with a subscriptionId and any of tenantId, appId, appSecret and name; missing
+         values are taken from the top level
+       - subscriptions using the same app in the same tenant share one token provider
+    '''
+    entries = []
+    if 'subscriptionId' in config_data:
+        entries.append({'subscriptionId': config_data['subscriptionId']})
+    for entry in config_data.get('subscriptions', []):
+        if isinstance(entry, str):
+            entry = {'subscriptionId': entry}
+        entries.append(entry)
+    subscriptions = []
+    token_providers = {}
+    seen = set()
+    for entry in entries:
+        settings = {key: entry.get(key, config_data.get(key))
+                    for key in ('tenantId', 'appId', 'appSecret')}
+        sub_id = entry['subscriptionId']
+        if sub_id in seen:
+            continue
+        seen.add(sub_id)
+        sub = subscription.subscription(settings['tenantId'], settings['appId'],
+                                        settings['appSecret'], sub_id, client=client,
+                                        name=entry.get('name'))
+        app_key = (settings['tenantId'], settings['appId'])
+        if app_key in token_providers:
+            sub.token_provider = token_providers[app_key]
+        else:
+            token_providers[app_key] = sub.token_provider
+        subscriptions.append(sub)
+    return subscriptions
+
+
+class Catalog():
+    '''index of the scale sets in a set of subscriptions, keyed by
+       (subscription id, resource group, scale set name)
+       - refresh() lists the subscriptions on a bounded pool of worker threads and merges
+         each one as soon as it arrives, so a slow subscription doesn't hold back the others
+       - a subscription which fails to list keeps its previous entries, and the error is
+         kept in errors
+       - with a SnapshotCache the catalog starts from the models saved by the last run,
+         flagged as stale until their subscription has been listed again
+    '''
+
+    def __init__(self, subscriptions, max_workers=4, cache=None):
+        '''class initialization routine
+           - max_workers is the most subscriptions listed at once
+           - cache is an optional snapshotcache.SnapshotCache
+        '''
+        self.subscriptions = {sub.sub_id: sub for sub in subscriptions}
+        self.max_workers = max_workers
+        self.cache = cache
+        self.models = {}    # (sub_id, rgname, vmssname) -> scale set model
+        self.errors = {}    # sub_id -> last listing error message
+        self.stale = {}     # key -> time saved, for models loaded from the cache
+        self.lock = threading.Lock()
+        if cache is not None:
+            for key, (model, saved) in cache.load_models().items():
+                if key[0] in self.subscriptions:
+                    self.models[key] = model
+                    self.stale[key] = saved
+
+    def __len__(self):
+        '''number of scale sets in the catalog'''
+        return len(self.models)
+
+    def iter_refresh(self, force=False, sub_ids=None):
+        '''list every subscription concurrently, yielding (sub_id, [keys], error) for each
+           subscription in the order they finish - error is None on success
+           - sub_ids limits the listing to some of the subscriptions
+        '''
+        if sub_ids is None:
+            sub_ids = list(self.subscriptions)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.subscriptions[sub_id].get_vmss_list, force):
+                       self.subscriptions[sub_id] for sub_id in sub_ids}
+            for future in as_completed(futures):
+                sub = futures[future]
+                try:
+                    future.result()
+                    error = sub.status if sub.status != '' else None
+                except Exception as exc:
+                    error = str(exc)
+                if error is None:
+                    keys = self.merge(sub)
+                else:
+                    with self.lock:
+                        self.errors[sub.sub_id] = error
+                    keys = self.keys(sub.sub_id)
+                yield sub.sub_id, keys, error
+
+    def refresh(self, force=False, sub_ids=None):
+        '''list every subscription concurrently and return the errors, if any'''
+        for _ in self.iter_refresh(force, sub_ids):
+            pass
+        return dict(self.errors)
+
+    def merge(self, sub):
+        '''replace the entries of a subscription with its current scale set list'''
+        models = {(sub.sub_id, get_resource_group(model['id']), name): model
+                  for name, model in sub.vmssdict.items()}
+        with self.lock:
+            for key in [key for key in self.models if key[0] == sub.sub_id]:
+                del self.models[key]
+                self.stale.pop(key, None)
+            self.models.update(models)
+            self.errors.pop(sub.sub_id, None)
+        if self.cache is not None:
+            self.cache.save_models(sub.sub_id, models)
+        return sorted(models)
+
+    def is_stale(self, key):
+        '''return the time a cached model was saved, or None if it is current'''
+        return self.stale.get(key)
+
+    def keys(self, sub_id=None):
+        '''sorted keys of the catalog, or of one subscription'''
+        with self.lock:
+            return sorted(key for key in self.models if sub_id is None or key[0] == sub_id)
+
+    def find(self, vmssname, sub_id=None, rgname=None):
+        '''keys of the scale sets with a given name, optionally in one subscription or
+           resource group
+        '''
+        return [key for key in self.keys(sub_id) if key[2] == vmssname and
+                (rgname is None or key[1].lower() == rgname.lower())]
+
+    def label(self, key):
+        '''display name of a scale set - qualified by subscription and resource group when
+           there is more than one subscription, or by resource group when the name is used
+           in more than one resource group
+        '''
+        if len(self.subscriptions) > 1:
+            return key[2] + ' (' + self.subscriptions[key[0]].name + '/' + key[1] + ')'
+        if len(self.find(key[2], key[0])) > 1:
+            return key[2] + ' (' + key[1] + ')'
+        return key[2]
+
+    def update_model(self, key, vmssmodel):
+        '''replace the cached model of one scale set, e.g. after vmss.refresh_model()'''
+        with self.lock:
+            self.models[key] = vmssmodel
+            self.stale.pop(key, None)
+        self.subscriptions[key[0]].update_vmss_model(key[2], vmssmodel)
+        if self.cache is not None:
+            self.cache.save_model(key, vmssmodel)
+
+    def save_inventory(self, key, vm_inventory):
+        '''save the VM inventory of a scale set in the cache, if there is one'''
+        if self.cache is not None:
+            self.cache.save_inventory(key, vm_inventory)
+
+    def load_inventory(self, key):
+        '''return the cached (VMInventory, saved time) of a scale set, or None'''
+        if self.cache is None:
+            return None
+        return self.cache.load_inventory(key)
+
+    def open(self, key, scale_set_class, **kwargs):
+        '''create a vmss or VMSSZ object for a catalog entry, sharing its subscription's
+           token provider and client
+        '''
+        sub = self.subscriptions[key[0]]
+        return scale_set_class(key[2], self.models[key], sub.sub_id, sub.token_provider,
+                               client=sub.client, **kwargs)
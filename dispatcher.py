@@ -0,0 +1,71 @@
+'''dispatcher.py - run API calls off the Tk main thread and hand results back to it'''
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Dispatcher():
+    '''runs work on a thread pool and delivers results to the Tk thread
+       - results and UI calls are queued and drained from root.after() polling, so Tk
+         widgets are only ever touched from the Tk thread
+       - each poll spends at most budget_ms draining the queue to keep the UI responsive
+    '''
+
+    def __init__(self, root, max_workers=4, poll_ms=16, budget_ms=8, error_fn=None):
+        '''class initialization routine - error_fn(exception) reports failed work'''
+        self.root = root
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.ui_queue = queue.Queue()
+        self.poll_ms = poll_ms
+        self.budget = budget_ms / 1000
+        self.error_fn = error_fn
+        self.ui_thread = threading.current_thread()
+        self.root.after(self.poll_ms, self.process)
+
+    def on_ui_thread(self):
+        '''is the caller running on the Tk thread'''
+        return threading.current_thread() is self.ui_thread
+
+    def submit(self, fn, *args, callback=None, errback=None):
+        '''run fn(*args) on the thread pool
+           - callback(result) or errback(exception) is then called on the Tk thread
+        '''
+        def done(future):
+            '''queue the outcome for the Tk thread'''
+            error = future.exception()
+            if error is not None:
+                handler = errback or self.error_fn
+                if handler is not None:
+                    self.ui_queue.put((handler, (error,)))
+            elif callback is not None:
+                self.ui_queue.put((callback, (future.result(),)))
+
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(done)
+        return future
+
+    def call_soon(self, fn, *args):
+        '''call fn(*args) on the Tk thread, from any thread'''
+        self.ui_queue.put((fn, args))
+
+    def process(self):
+        '''drain queued UI calls for up to the time budget, then poll again'''
+        deadline = time.time() + self.budget
+        try:
+            while time.time() < deadline:
+                fn, args = self.ui_queue.get_nowait()
+                try:
+                    fn(*args)
+                except Exception as error:  # keep the polling loop alive
+                    if self.error_fn is None:
+                        raise
+                    self.error_fn(error)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(self.poll_ms, self.process)
+
+    def shutdown(self):
+        '''stop accepting work'''
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,252 @@
+'''heatmap.py - retained-mode Tk canvas renderers for VM scale set heatmaps'''
+import time
+
+import inventory
+import metrics
+
+DIAMETER = 10
+
+# layout of the placement group/UD/FD grid
+GROUP_WIDTH = 425
+GROUP_HEIGHT = 170
+GROUPS_PER_ROW = 3
+ROW_HEIGHT = 27
+YSTART = 60
+XEND = 170
+XVAL = 35
+YVAL = 40
+
+# layout of the zone/FD grid
+ZONE_XVAL = 55
+ZONE_ROW_HEIGHT = 26
+ZONE_COLORS = ['#FFFACD', '#C1FFC1', '#fd0']
+
+
+class Heatmap():
+    '''keeps a map from instance id to canvas items so a VM is only touched on the canvas
+       when it is added, removed, moved or changes color
+    '''
+
+    def __init__(self, canvas, colors=inventory.POWER_COLORS):
+        '''class initialization routine - canvas is a tk.Canvas, colors is a lookup table
+           from power state code to color
+        '''
+        self.canvas = canvas
+        self.colors = colors
+        self.fontsize = 5
+        self.items = {}  # instance id -> [oval id, text id, x, y, color]
+        self.stipple = ''  # 'gray50' while showing a cached snapshot
+
+    def reset(self):
+        '''clear the canvas and forget everything drawn so far'''
+        self.canvas.delete("all")
+        self.fontsize = 5
+        self.items = {}
+        self.stipple = ''
+
+    def set_stale(self, saved=None):
+        '''flag the VMs on the canvas as a cached snapshot saved at time saved, or clear the
+           flag with saved=None - stale VMs are drawn stippled under a "cached" label
+        '''
+        self.canvas.delete('stale')
+        self.stipple = '' if saved is None else 'gray50'
+        self.canvas.itemconfig('vm', stipple=self.stipple)
+        if saved is not None:
+            self.canvas.create_text(int(self.canvas.cget('width')) - 5, 5, anchor='ne',
+                                    fill='grey', tags='stale', text='cached ' +
+                                    time.strftime('%Y-%m-%d %H:%M', time.localtime(saved)))
+
+    def draw_vm(self, instance_id, x, y, power):
+        '''create the canvas items for a VM, or move/recolor the existing ones'''
+        color = self.colors[power]
+        item = self.items.get(instance_id)
+        if item is None:
+            # colored circle represents machine power state
+            oval = self.canvas.create_oval(x, y, x + DIAMETER, y + DIAMETER, fill=color,
+                                           stipple=self.stipple, tags='vm')
+            # print VM ID under each circle
+            text = self.canvas.create_text(x + 7, y + 15, font=("Purisa", self.fontsize),
+                                           text=instance_id, tags='vmlabel')
+            self.items[instance_id] = [oval, text, x, y, color]
+            return
+        if item[2] != x or item[3] != y:
+            self.canvas.coords(item[0], x, y, x + DIAMETER, y + DIAMETER)
+            self.canvas.coords(item[1], x + 7, y + 15)
+            item[2] = x
+            item[3] = y
+        if item[4] != color:
+            self.canvas.itemconfig(item[0], fill=color)
+            item[4] = color
+
+    def remove_missing(self, instance_ids):
+        '''delete the canvas items of VMs which are not in instance_ids'''
+        for instance_id in [vmid for vmid in self.items if vmid not in instance_ids]:
+            item = self.items.pop(instance_id)
+            self.canvas.delete(item[0], item[1])
+
+
+class DomainHeatmap(Heatmap):
+    '''draws VMs into a grid of placement groups, update domains and fault domains
+       - add_vms() adds a page of VMs while an instance view is loading; per
+         (placement group, UD, FD) slot counters are kept between calls so the total
+         drawing work for a scale set is linear in the number of VMs
+       - update() diffs a complete VM list against what is on the canvas
+    '''
+
+    def __init__(self, canvas, colors=inventory.POWER_COLORS):
+        '''class initialization routine'''
+        super().__init__(canvas, colors)
+        self.groups = {}  # placement group id -> (originx, originy)
+        self.grids = {}   # placement group id -> canvas item ids of its grid
+        self.slots = {}   # (placement group id, ud, fd) -> number of VMs placed in the slot
+
+    def reset(self):
+        '''clear the canvas and forget everything drawn so far'''
+        super().reset()
+        self.groups = {}
+        self.grids = {}
+        self.slots = {}
+
+    def get_group_origin(self, group_id):
+        '''return the canvas origin of a placement group, drawing its grid on first use
+           - a new group takes the first free position, e.g. one left by a removed group
+        '''
+        if group_id in self.groups:
+            return self.groups[group_id]
+        used = set(self.groups.values())
+        position = 0
+        while True:
+            originx = (position % GROUPS_PER_ROW) * GROUP_WIDTH
+            originy = (position // GROUPS_PER_ROW) * GROUP_HEIGHT
+            if (originx, originy) not in used:
+                break
+            position += 1
+        self.groups[group_id] = (originx, originy)
+        with metrics.span('render', step='draw_grid'):
+            self.grids[group_id] = self.draw_grid(originx, originy, group_id)
+        if len(self.groups) == 2:
+            # multiple placement groups get a smaller font to fit more VMs
+            self.fontsize = 4
+            self.canvas.itemconfig('vmlabel', font=("Purisa", self.fontsize))
+        return originx, originy
+
+    def draw_grid(self, originx, originy, group_id):
+        '''draw a grid to delineate fault domains and update domains on the VMSS heatmap,
+           return the ids of the canvas items drawn
+        '''
+        items = [self.canvas.create_text(originx + 180, originy + 10,
+                                         text='Placement group: ' + group_id)]
+        # horizontal lines for UDs
+        for y in range(5):
+            ydelta = y * ROW_HEIGHT
+            items.append(self.canvas.create_text(originx + 15, originy + ydelta + 50,
+                                                 text='UD ' + str(y)))
+            if y < 4:
+                items.append(self.canvas.create_line(originx + 35, originy + YSTART + ydelta,
+                                                     originx + 415, originy + YSTART + ydelta))
+
+        # vertical lines for FDs
+        for x in range(5):
+            xdelta = x * 80
+            items.append(self.canvas.create_text(originx + 45 + xdelta, originy + 30,
+                                                 text='FD ' + str(x)))
+            if x < 4:
+                items.append(self.canvas.create_line(originx + 110 + xdelta, originy + 40,
+                                                     originx + 110 + xdelta, originy + XEND,
+                                                     dash=(4, 2)))
+        return items
+
+    def remove_missing_groups(self, group_ids):
+        '''delete the grids of placement groups which are not in group_ids, e.g. after a
+           scale in, freeing their positions for new groups
+        '''
+        for group_id in [pgid for pgid in self.groups if pgid not in group_ids]:
+            del self.groups[group_id]
+            self.canvas.delete(*self.grids.pop(group_id))
+
+    def add_vms(self, vm_list):
+        '''draw a list of [group_id, instance_id, fd, ud, power state code] VM entries'''
+        for group_id, instance_id, fd, ud, power in vm_list:
+            originx, originy = self.get_group_origin(group_id)
+            slot_key = (group_id, ud, fd)
+            slot = self.slots.get(slot_key, 0)
+            self.slots[slot_key] = slot + 1
+
+            # the purpose of this is to build up multiple rows of 5 in each UD/FD
+            row = slot // 5
+            xdelta = fd * 80 + (slot - row * 5) * 15
+            ydelta = ud * ROW_HEIGHT + row * 30
+            self.draw_vm(instance_id, originx + XVAL + xdelta, originy + YVAL + ydelta, power)
+
+    def update(self, vm_list):
+        '''bring the canvas in line with a complete list of VM entries, only touching the
+           canvas items of VMs which were added, removed, moved or changed power state
+        '''
+        self.remove_missing_groups({vm[0] for vm in vm_list})
+        self.slots = {}
+        self.add_vms(vm_list)
+        self.remove_missing({vm[1] for vm in vm_list})
+
+
+class ZoneHeatmap(Heatmap):
+    '''draws VMs into a grid of availability zones and fault domains
+       - VMs which are not in a zone can't be placed on the grid, their number is shown
+         at the bottom of the canvas instead
+    '''
+
+    def __init__(self, canvas, width, height, colors=inventory.POWER_COLORS):
+        '''class initialization routine - width and height are the size of the zone area'''
+        super().__init__(canvas, colors)
+        self.width = width
+        self.height = height
+        self.background = False
+
+    def reset(self):
+        '''clear the canvas and forget everything drawn so far'''
+        super().reset()
+        self.background = False
+
+    def draw_background(self):
+        '''draw one rectangle and FD grid for each zone'''
+        zone_width = self.width / 3
+        for zone_idx in range(3):
+            originx = zone_idx * zone_width
+            self.canvas.create_rectangle(originx, 0, originx + zone_width, self.height,
+                                         outline=ZONE_COLORS[zone_idx],
+                                         fill=ZONE_COLORS[zone_idx])
+            self.canvas.create_text(originx + 180, 10, text='Zone: ' + str(zone_idx + 1))
+            # horizontal lines for FDs
+            for y in range(5):
+                ydelta = y * ROW_HEIGHT
+                self.canvas.create_text(originx + 20, ydelta + 50, text='FD ' + str(y))
+                if y < 4:
+                    self.canvas.create_line(originx + 35, YSTART + ydelta, originx + 390,
+                                            YSTART + ydelta)
+        self.background = True
+
+    def update(self, vm_inventory):
+        '''bring the canvas in line with a VMInventory, only touching the canvas items of VMs
+           which were added, removed, moved or changed power state
+        '''
+        if self.background is False:
+            with metrics.span('render', step='draw_background'):
+                self.draw_background()
+        zone_width = self.width / 3
+        unzoned = 0
+        for (zone, fd), rows in vm_inventory.zone_rows.items():
+            if zone < 1:  # not in a zone
+                unzoned += len(rows)
+                continue
+            originx = (zone - 1) * zone_width
+            ydelta = fd * ZONE_ROW_HEIGHT
+            xinc = ZONE_XVAL
+            for row in rows:
+                self.draw_vm(vm_inventory.instance_ids[row], originx + xinc, YVAL + ydelta,
+                             vm_inventory.power[row])
+                xinc += 20
+        self.remove_missing(vm_inventory.rows)
+        self.canvas.delete('unzoned')
+        if unzoned > 0:
+            self.canvas.create_text(5, self.height - 10, anchor='w', tags='unzoned',
+                                    text=str(unzoned) + ' VMs are not in an availability '
+                                    'zone and are not shown')
@@ -0,0 +1,164 @@
+'''inventory.py - compact column-wise inventory of the VMs in a scale set'''
+from array import array
+
+# power states are stored as their index in this tuple
+POWER_STATES = ('unknown', 'running', 'stopped', 'starting', 'stopping', 'deallocating',
+                'deallocated')
+# heatmap color of each power state, indexed the same way
+POWER_COLORS = ('blue', 'green', 'red', 'yellow', 'orange', 'grey', 'black')
+# instance view status code -> power state code, e.g. 'PowerState/running' -> 1
+POWER_STATUS_CODES = {'PowerState/' + power_state: code
+                      for code, power_state in enumerate(POWER_STATES)}
+
+
+def decode_power_state(statuses):
+    '''get the power state code from a list of VM instance view statuses, 0 if unknown
+       - one dict lookup per status, instead of a prefix test and a slice
+    '''
+    for status in statuses:
+        code = POWER_STATUS_CODES.get(status['code'])
+        if code is not None:
+            return code
+    return 0
+
+
+def get_vm_power_states(client, access_token, sub_id, rgname, vmssname, instance_ids):
+    '''get the current power state of a list of VMs in a scale set as an
+       {instance id: power state} dict
+       - a few VMs are read one instance view at a time, more with a single list call
+    '''
+    power_states = {}
+    if len(instance_ids) <= 5:
+        for instance_id in instance_ids:
+            instance_view = client.get_vmss_vm_instance_view(access_token, sub_id, rgname,
+                                                             vmssname, instance_id)
+            if 'statuses' in instance_view:
+                power_states[instance_id] = POWER_STATES[
+                    decode_power_state(instance_view['statuses'])]
+    else:
+        wanted = set(instance_ids)
+        instance_views = client.list_vmss_vm_instance_view(access_token, sub_id, rgname,
+                                                           vmssname)
+        for instance in instance_views.get('value', []):
+            if instance['instanceId'] in wanted:
+                power_states[instance['instanceId']] = POWER_STATES[
+                    decode_power_state(instance['properties']['instanceView']['statuses'])]
+    return power_states
+
+
+class VMInventory():
+    '''one row per VM, stored as columns rather than one object per VM
+       - instance ids are kept once in a list, placement group index, FD, UD, zone and
+         power state code in typed arrays
+       - row numbers are bucketed by (group, FD), (group, UD) and (zone, FD) as VMs are added,
+         so a domain view is a dict lookup instead of a scan or a regrouping
+       - zone is 0 for VMs which are not in an availability zone
+       - power states are decoded once per fetch into POWER_STATES codes
+    '''
+    __slots__ = ('instance_ids', 'groups', 'group_index', 'pg', 'fd', 'ud', 'zone', 'power',
+                 'rows', 'fd_rows', 'ud_rows', 'zone_rows')
+
+    def __init__(self):
+        '''class initialization routine'''
+        self.instance_ids = []
+        self.groups = []        # placement group ids in the order they were first seen
+        self.group_index = {}   # placement group id -> index into groups
+        self.pg = array('H')
+        self.fd = array('b')
+        self.ud = array('b')
+        self.zone = array('b')
+        self.power = array('B')
+        self.rows = {}          # instance id -> row number
+        self.fd_rows = {}       # (group index, fd) -> [row numbers]
+        self.ud_rows = {}       # (group index, ud) -> [row numbers]
+        self.zone_rows = {}     # (zone, fd) -> [row numbers]
+
+    def __len__(self):
+        '''number of VMs in the inventory'''
+        return len(self.instance_ids)
+
+    def get_group_index(self, group_id):
+        '''return the index of a placement group, adding it on first use'''
+        index = self.group_index.get(group_id)
+        if index is None:
+            index = len(self.groups)
+            self.group_index[group_id] = index
+            self.groups.append(group_id)
+        return index
+
+    def add(self, instance_id, group_id, fd, ud, power, zone=0):
+        '''add a VM, or update its power state code if it is already in the inventory'''
+        row = self.rows.get(instance_id)
+        if row is not None:
+            self.power[row] = power
+            return row
+        pg = self.get_group_index(group_id)
+        row = len(self.instance_ids)
+        self.instance_ids.append(instance_id)
+        self.pg.append(pg)
+        self.fd.append(fd)
+        self.ud.append(ud)
+        self.zone.append(zone)
+        self.power.append(power)
+        self.rows[instance_id] = row
+        self.fd_rows.setdefault((pg, fd), []).append(row)
+        self.ud_rows.setdefault((pg, ud), []).append(row)
+        self.zone_rows.setdefault((zone, fd), []).append(row)
+        return row
+
+    def set_power_state(self, instance_id, power):
+        '''update the power state code of a VM, return False if it isn't in the inventory'''
+        row = self.rows.get(instance_id)
+        if row is None:
+            return False
+        self.power[row] = power
+        return True
+
+    def power_state(self, row):
+        '''power state name of a row'''
+        return POWER_STATES[self.power[row]]
+
+    def get_ids(self, rows):
+        '''map a list of row numbers to instance ids'''
+        instance_ids = self.instance_ids
+        return [instance_ids[row] for row in rows]
+
+    def fd_ids(self, fd, group_id=None):
+        '''instance ids in a fault domain, of one placement group or of all of them'''
+        if group_id is not None:
+            return self.get_ids(self.fd_rows.get((self.group_index.get(group_id), fd), []))
+        return [vmid for pg in range(len(self.groups))
+                for vmid in self.get_ids(self.fd_rows.get((pg, fd), []))]
+
+    def ud_ids(self, ud, group_id=None):
+        '''instance ids in an update domain, of one placement group or of all of them'''
+        if group_id is not None:
+            return self.get_ids(self.ud_rows.get((self.group_index.get(group_id), ud), []))
+        return [vmid for pg in range(len(self.groups))
+                for vmid in self.get_ids(self.ud_rows.get((pg, ud), []))]
+
+    def zone_ids(self, zone, fd=None):
+        '''instance ids in an availability zone, or in one FD of the zone'''
+        if fd is not None:
+            return self.get_ids(self.zone_rows.get((zone, fd), []))
+        return [vmid for zfd in sorted(key[1] for key in self.zone_rows if key[0] == zone)
+                for vmid in self.get_ids(self.zone_rows[(zone, zfd)])]
+
+    def domain_groups(self):
+        '''map each placement group id to a {fd: [instance ids]} dict'''
+        domains = {group_id: {} for group_id in self.groups}
+        for (pg, fd), rows in self.fd_rows.items():
+            domains[self.groups[pg]][fd] = self.get_ids(rows)
+        return domains
+
+    def zone_groups(self):
+        '''map each availability zone to a {fd: [instance ids]} dict'''
+        domains = {}
+        for (zone, fd), rows in sorted(self.zone_rows.items()):
+            domains.setdefault(zone, {})[fd] = self.get_ids(rows)
+        return domains
+
+    def vm_list(self):
+        '''list the VMs as [group_id, instance_id, fd, ud, power state code] entries'''
+        return [[self.groups[self.pg[row]], self.instance_ids[row], self.fd[row], self.ud[row],
+                 self.power[row]] for row in range(len(self.instance_ids))]
@@ -0,0 +1,285 @@
+'''metrics.py - in-process latency histograms and counters for ARM calls and render passes
+   - ArmClient records every request by route, the scale set classes and heatmaps time
+     their processing and drawing passes with span(), and the refresh loops call tick()
+   - snapshot() returns everything as a dict, to_json() and to_prometheus() dump it for
+     export, and format_table() is the text the stats panel shows
+'''
+import bisect
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# histogram bucket upper bounds
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+PREFIX = 'vmssdashboard_'
+# HELP text of the metrics recorded by this package
+DESCRIPTIONS = {
+    'arm_request_seconds': 'ARM request latency by method and route',
+    'arm_request_bytes': 'ARM request body size by method and route',
+    'arm_response_bytes': 'ARM response body size by method and route',
+    'arm_requests_total': 'ARM requests by method, route and status code',
+    'arm_retries_total': 'ARM requests sent again, by reason',
+    'arm_throttle_wait_seconds': 'Time requests were held back by the rate governor',
+    'arm_calls_per_tick': 'ARM calls made in each refresh loop iteration',
+    'fetch_seconds': 'Time spent fetching scale set lists and VM details, by call',
+    'process_seconds': 'Time spent processing fetched VM details, by step',
+    'render_seconds': 'Time spent drawing the heatmaps, by step',
+    'token_acquire_seconds': 'Time spent acquiring access tokens'}
+# collections whose next path segment is a resource name or id
+NAMED_SEGMENTS = ('subscriptions', 'resourceGroups', 'virtualMachineScaleSets',
+                  'virtualMachines', 'locations', 'operations')
+NAME_PATTERN = re.compile(r'[^a-zA-Z0-9_:]')
+
+
+def get_route(url):
+    '''reduce an ARM URL to a low cardinality route label, e.g.
+       'virtualMachineScaleSets/{}/virtualMachines?$expand=instanceView'
+    '''
+    parsed = urlparse(url)
+    segments = parsed.path.strip('/').split('/')
+    for index in range(1, len(segments)):
+        if segments[index - 1] in NAMED_SEGMENTS:
+            segments[index] = '{}'
+    if 'Microsoft.Compute' in segments:  # drop the subscription/resource group prefix
+        segments = segments[segments.index('Microsoft.Compute') + 1:]
+    route = '/'.join(segments)
+    if '$expand=instanceView' in parsed.query:
+        route += '?$expand=instanceView'
+    return route
+
+
+def get_description(name):
+    '''HELP text of a metric, made from its name if it isn't in DESCRIPTIONS'''
+    return DESCRIPTIONS.get(name, name.replace('_', ' ').capitalize())
+
+
+class Histogram():
+    '''cumulative-bucket histogram, in the Prometheus sense'''
+
+    def __init__(self, buckets):
+        '''class initialization routine - buckets is a sorted tuple of upper bounds'''
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last count is the +Inf bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        '''add a value'''
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        '''estimate a quantile as the upper bound of the bucket it falls in, or the largest
+           value seen if that is smaller
+        '''
+        if self.count == 0:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                return min(self.buckets[index], self.max) if index < len(self.buckets) \
+                    else self.max
+        return self.max
+
+    def as_dict(self):
+        '''the histogram as a JSON-serializable dict'''
+        cumulative = []
+        seen = 0
+        for count in self.counts[:-1]:
+            seen += count
+            cumulative.append(seen)
+        return {'count': self.count, 'sum': round(self.sum, 6), 'max': round(self.max, 6),
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95),
+                'buckets': dict(zip([str(bound) for bound in self.buckets], cumulative))}
+
+
+class Registry():
+    '''thread-safe store of histograms and counters, each keyed by a metric name and a
+       sorted tuple of (label, value) pairs
+    '''
+
+    def __init__(self):
+        '''class initialization routine'''
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}    # (name, labels) -> number
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.calls = 0        # ARM requests sent, for tick()
+        self.tick_calls = 0   # value of calls at the last tick
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        '''add a value to a histogram'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(buckets)
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        '''add to a counter'''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def span(self, name, **labels):
+        '''time a block into the <name>_seconds histogram'''
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name + '_seconds', time.perf_counter() - start_time, **labels)
+
+    def record_request(self, method, url, status_code, seconds, response_bytes,
+                       request_bytes=0):
+        '''record one ARM request sent by ArmClient'''
+        route = get_route(url)
+        with self.lock:
+            self.calls += 1
+        self.observe('arm_request_seconds', seconds, method=method, route=route)
+        self.observe('arm_response_bytes', response_bytes, BYTES_BUCKETS, method=method,
+                     route=route)
+        if request_bytes > 0:
+            self.observe('arm_request_bytes', request_bytes, BYTES_BUCKETS, method=method,
+                         route=route)
+        self.inc('arm_requests_total', method=method, route=route, status=str(status_code))
+
+    def tick(self, loop='refresh'):
+        '''a refresh loop iteration has ended - record the ARM calls made since the last one'''
+        with self.lock:
+            calls = self.calls - self.tick_calls
+            self.tick_calls = self.calls
+        self.observe('arm_calls_per_tick', calls, COUNT_BUCKETS, loop=loop)
+
+    def reset(self):
+        '''forget everything recorded so far'''
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.started = time.time()
+            self.tick_calls = self.calls
+
+    def snapshot(self):
+        '''everything recorded so far as a JSON-serializable dict'''
+        with self.lock:
+            histograms = [dict(name=name, labels=dict(labels), **histogram.as_dict())
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            return {'started': self.started, 'uptime': round(time.time() - self.started, 3),
+                    'histograms': histograms, 'counters': counters}
+
+    def to_json(self):
+        '''snapshot() as a JSON string'''
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self):
+        '''everything recorded so far in the Prometheus text exposition format'''
+        lines = []
+        typed = set()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = PREFIX + name
+                if metric not in typed:
+                    lines.append('# HELP ' + metric + ' ' + get_description(name))
+                    lines.append('# TYPE ' + metric + ' counter')
+                    typed.add(metric)
+                lines.append(metric + format_labels(labels) + ' ' + str(value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = PREFIX + name
+                if metric not in typed:
+                    lines.append('# HELP ' + metric + ' ' + get_description(name))
+                    lines.append('# TYPE ' + metric + ' histogram')
+                    typed.add(metric)
+                seen = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    seen += count
+                    lines.append(metric + '_bucket' +
+                                 format_labels(labels + (('le', str(bound)),)) + ' ' +
+                                 str(seen))
+                lines.append(metric + '_sum' + format_labels(labels) + ' ' +
+                             repr(histogram.sum))
+                lines.append(metric + '_count' + format_labels(labels) + ' ' +
+                             str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def format_table(self):
+        '''a plain text summary of the histograms and counters for the stats panel'''
+        snapshot = self.snapshot()
+        lines = ['{:<80}{:>7}{:>10}{:>10}{:>10}'.format('histogram', 'count', 'p50', 'p95',
+                                                       'max')]
+        for histogram in snapshot['histograms']:
+            labels = ','.join(str(value) for _, value in sorted(histogram['labels'].items()))
+            title = histogram['name'] + (' ' + labels if labels != '' else '')
+            lines.append('{:<80}{:>7}{:>10}{:>10}{:>10}'.format(
+                title[:79], histogram['count'], format_value(histogram['p50']),
+                format_value(histogram['p95']), format_value(histogram['max'])))
+        lines.append('')
+        lines.append('{:<80}{:>7}'.format('counter', 'value'))
+        for counter in snapshot['counters']:
+            labels = ','.join(str(value) for _, value in sorted(counter['labels'].items()))
+            title = counter['name'] + (' ' + labels if labels != '' else '')
+            lines.append('{:<80}{:>7}'.format(title[:79], counter['value']))
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    '''render a (label, value) tuple as a Prometheus label set'''
+    if len(labels) == 0:
+        return ''
+    pairs = []
+    for label, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(NAME_PATTERN.sub('_', label) + '="' + value + '"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    '''short display form of a histogram value'''
+    if value is None:
+        return '-'
+    if isinstance(value, float) and value < 10:
+        return '{:.4f}'.format(value)
+    return str(value)
+
+
+def save(path, registry=None):
+    '''write the metrics to a file, in the Prometheus text format if the name ends in .prom
+       or .txt, else as JSON
+    '''
+    registry = registry or get_registry()
+    text = registry.to_prometheus() if path.endswith(('.prom', '.txt')) else \
+        registry.to_json()
+    with open(path, 'w') as metrics_file:
+        metrics_file.write(text)
+
+
+default_registry = Registry()
+
+
+def get_registry():
+    '''return the registry shared by the whole process'''
+    return default_registry
+
+
+def span(name, **labels):
+    '''time a block into the shared registry, see Registry.span()'''
+    return default_registry.span(name, **labels)
+
+
+def tick(loop='refresh'):
+    '''end a refresh loop iteration in the shared registry, see Registry.tick()'''
+    default_registry.tick(loop)
@@ -0,0 +1,164 @@
+'''operations.py - track long running ARM operations through their async-operation URLs'''
+import json
+import threading
+import time
+
+import armclient
+import polling
+
+# terminal states of an Azure-AsyncOperation status resource
+DONE_STATES = ('Succeeded', 'Failed', 'Canceled')
+
+
+class Operation():
+    '''state of one long running operation started on a scale set'''
+
+    def __init__(self, name, response, instance_ids=None, client=None):
+        '''class initialization routine - response is the HTTP response of the action
+           - client is the ArmClient used to poll the status URL
+        '''
+        self.name = name
+        self.client = client or armclient.get_client()
+        self.instance_ids = instance_ids
+        self.start_time = time.time()
+        self.end_time = None
+        self.error = None
+        self.retry_after = polling.get_retry_after(response.headers)
+        self.done_event = threading.Event()
+        # prefer the Azure-AsyncOperation status resource, fall back to the Location header
+        self.status_url = response.headers.get('Azure-AsyncOperation')
+        self.location_url = None
+        if self.status_url is None:
+            self.location_url = response.headers.get('Location')
+        if response.status_code >= 400:
+            self.finish('Failed', response.text)
+        elif self.status_url is None and self.location_url is None:
+            # the action completed synchronously
+            self.finish('Succeeded')
+        else:
+            self.state = 'InProgress'
+
+    def __str__(self):
+        '''one line summary for the status bar'''
+        summary = self.name + ' ' + self.state + ' (' + str(round(self.duration, 1)) + 's)'
+        if self.error is not None:
+            summary += ': ' + str(self.error)
+        return summary
+
+    @property
+    def duration(self):
+        '''seconds since the operation was started, or how long it took'''
+        if self.end_time is None:
+            return time.time() - self.start_time
+        return self.end_time - self.start_time
+
+    def is_done(self):
+        '''has the operation reached a terminal state'''
+        return self.done_event.is_set()
+
+    def finish(self, state, error=None):
+        '''record a terminal state and wake anyone waiting on the operation'''
+        self.state = state
+        self.error = error
+        self.end_time = time.time()
+        self.done_event.set()
+
+    def poll(self, access_token):
+        '''get the status of the operation once, return True if it is done'''
+        if self.is_done():
+            return True
+        if self.status_url is not None:
+            response = self.client.get(self.status_url, access_token)
+        else:
+            response = self.client.get(self.location_url, access_token)
+        self.retry_after = polling.get_retry_after(response.headers)
+        if response.status_code == 429:  # throttled, try again after retry_after
+            return False
+        if response.status_code >= 400:
+            self.finish('Failed', response.text)
+        elif self.status_url is not None:
+            try:
+                status = response.json()
+            except ValueError:  # an empty or non-JSON body, e.g. a 202 - still running
+                return False
+            if status.get('status') in DONE_STATES:
+                self.finish(status['status'], status.get('error'))
+        elif response.status_code != 202:  # Location protocol: 202 means still running
+            self.finish('Succeeded')
+        return self.is_done()
+
+    def wait(self, timeout=None):
+        '''block until the operation is done, return True if it finished'''
+        return self.done_event.wait(timeout)
+
+    def poll_until_done(self, access_token, min_poll=1, max_poll=15, stop_event=None):
+        '''poll the status URL with backoff until the operation is done
+           - wakes up straight away if another thread sees the operation finish first
+           - returns False if stop_event is set first
+        '''
+        poller = polling.PollScheduler(min_poll, max_poll)
+        delay = poller.next_delay(self.state, self.retry_after)
+        while not self.wait(delay):
+            if stop_event is not None and stop_event.is_set():
+                return False
+            self.poll(access_token)
+            delay = poller.next_delay(self.state, self.retry_after)
+        return True
+
+    def as_dict(self):
+        '''the operation as a JSON-serializable dict'''
+        instance_ids = self.instance_ids
+        if isinstance(instance_ids, str):  # the JSON list string the action was called with
+            instance_ids = json.loads(instance_ids)
+        return {'name': self.name, 'state': self.state, 'error': self.error,
+                'duration': round(self.duration, 1), 'instanceIds': instance_ids}
+
+
+class OperationTracker():
+    '''keeps the operations started on a scale set and polls the in-flight ones'''
+
+    def __init__(self, client=None, history=100):
+        '''class initialization routine - history is the number of finished operations kept'''
+        self.client = client
+        self.history = history
+        self.operations = []
+        self.lock = threading.Lock()
+
+    def start(self, name, response, instance_ids=None):
+        '''start tracking the operation behind an action's HTTP response'''
+        operation = Operation(name, response, instance_ids, self.client)
+        with self.lock:
+            self.operations.append(operation)
+            finished = [op for op in self.operations if op.is_done()]
+            if len(finished) > self.history:
+                stale = set(finished[:len(finished) - self.history])
+                self.operations = [op for op in self.operations if op not in stale]
+        return operation
+
+    def in_flight(self):
+        '''list the operations which are not done yet'''
+        with self.lock:
+            return [op for op in self.operations if not op.is_done()]
+
+    def last_change(self):
+        '''the latest time an operation was started or finished, or None'''
+        with self.lock:
+            times = [op.end_time or op.start_time for op in self.operations]
+        if len(times) == 0:
+            return None
+        return max(times)
+
+    def retry_after(self):
+        '''the longest Retry-After asked for by an in-flight operation, or None'''
+        delays = [op.retry_after for op in self.in_flight() if op.retry_after is not None]
+        if len(delays) == 0:
+            return None
+        return max(delays)
+
+    def poll(self, access_token):
+        '''poll every in-flight operation once, return the ones which finished'''
+        finished = []
+        for operation in self.in_flight():
+            if operation.poll(access_token):
+                finished.append(operation)
+        return finished
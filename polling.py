@@ -0,0 +1,72 @@
+'''polling.py - adaptive polling and conditional reads for VMSS model refreshes'''
+import hashlib
+import threading
+
+
+class PollScheduler():
+    '''decides how long to wait between model polls
+       - polls quickly right after an operation is started (kick)
+       - backs off exponentially while the provisioning state is unchanged
+       - never polls sooner than a Retry-After header asks for
+    '''
+
+    def __init__(self, min_interval=2, max_interval=30, factor=2):
+        '''class initialization routine - intervals are in seconds'''
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.interval = min_interval
+        self.last_state = None
+        self.wake_event = threading.Event()
+
+    def kick(self):
+        '''an operation was just started - poll fast again and wake up a waiting poller'''
+        self.interval = self.min_interval
+        self.last_state = None
+        self.wake_event.set()
+
+    def next_delay(self, state, retry_after=None):
+        '''return the number of seconds to wait before polling again'''
+        if state != self.last_state:
+            self.last_state = state
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.factor, self.max_interval)
+        if retry_after is not None and retry_after > self.interval:
+            return retry_after
+        return self.interval
+
+    def wait(self, delay):
+        '''sleep for delay seconds, returning early if kick() is called'''
+        self.wake_event.wait(delay)
+        self.wake_event.clear()
+
+
+def get_retry_after(headers):
+    '''return the Retry-After header value in seconds, or None'''
+    retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return int(retry_after)
+    except ValueError:  # HTTP-date form, not used by ARM
+        return None
+
+
+def fingerprint(content):
+    '''cheap fingerprint of a response payload, used to skip re-parsing unchanged models'''
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+def conditional_get(client, url, access_token, etag=None, last_fingerprint=None):
+    '''GET a resource with If-None-Match and compare its payload with the last one seen
+       - returns (response, changed, fingerprint): changed is True only for a successful
+         response whose payload differs from last_fingerprint, and fingerprint is the one
+         to keep for the next call
+       - a 304 or an error response is not a change
+    '''
+    response = client.get(url, access_token, etag)
+    if response.status_code >= 400 or response.status_code == 304:  # error, or ETag matched
+        return response, False, last_fingerprint
+    new_fingerprint = fingerprint(response.content)
+    return response, new_fingerprint != last_fingerprint, new_fingerprint
@@ -0,0 +1,135 @@
+'''ratelimit.py - client-side pacing of ARM requests from the x-ms-ratelimit-remaining headers'''
+import re
+import threading
+import time
+
+import polling
+
+# remaining requests in the subscription's current throttling window, sent on every response
+REMAINING_HEADERS = {'reads': 'x-ms-ratelimit-remaining-subscription-reads',
+                     'writes': 'x-ms-ratelimit-remaining-subscription-writes'}
+SUBSCRIPTION_PATTERN = re.compile(r'/subscriptions/([^/?]+)', re.IGNORECASE)
+
+
+def get_subscription_id(url):
+    '''the subscription id in an ARM URL, '' if there is none'''
+    match = SUBSCRIPTION_PATTERN.search(url)
+    return match.group(1).lower() if match is not None else ''
+
+
+def get_kind(method):
+    '''which ARM rate limit an HTTP method counts against'''
+    return 'reads' if method in ('GET', 'HEAD') else 'writes'
+
+
+class TokenBucket():
+    '''refills rate tokens a second up to burst; callers reserve a token and wait their turn
+       - tokens may go negative, the deficit being the queue of callers already waiting
+    '''
+
+    def __init__(self, rate, burst):
+        '''class initialization routine'''
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0  # monotonic time a 429 asked us to wait until
+
+    def refill(self, now):
+        '''add the tokens earned since the last update'''
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        '''take a token and return how many seconds to wait before using it'''
+        self.refill(now)
+        self.tokens -= 1
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        return max(delay, self.paused_until - now)
+
+
+class RateGovernor():
+    '''paces ARM requests with a token bucket per subscription and per reads/writes
+       - the defaults follow ARM's own per-subscription buckets: 250 reads refilled at 25/s
+         and 200 writes refilled at 10/s
+       - each response's x-ms-ratelimit-remaining header caps the local bucket, and below
+         low_water remaining requests the refill rate is slowed in proportion
+       - a 429 pauses the bucket for its Retry-After, or an exponential backoff, so every
+         caller sharing the subscription waits instead of adding to the throttling
+    '''
+
+    def __init__(self, read_rate=25, read_burst=250, write_rate=10, write_burst=200,
+                 low_water=50, max_backoff=60):
+        '''class initialization routine - rates are requests per second'''
+        self.limits = {'reads': (read_rate, read_burst), 'writes': (write_rate, write_burst)}
+        self.low_water = low_water
+        self.max_backoff = max_backoff
+        self.buckets = {}      # (subscription id, kind) -> TokenBucket
+        self.backoff = {}      # (subscription id, kind) -> consecutive 429s
+        self.remaining = {}    # (subscription id, kind) -> last remaining header value
+        self.throttled = 0     # 429 responses seen
+        self.waited = 0.0      # seconds callers have been held back
+        self.lock = threading.Lock()
+
+    def get_bucket(self, key):
+        '''return the bucket for a (subscription id, kind) key - the caller holds the lock'''
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(*self.limits[key[1]])
+            self.buckets[key] = bucket
+        return bucket
+
+    def acquire(self, method, url):
+        '''wait until a request may be sent, return the seconds waited'''
+        key = (get_subscription_id(url), get_kind(method))
+        with self.lock:
+            delay = self.get_bucket(key).reserve(time.monotonic())
+            if delay > 0:
+                self.waited += delay
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def observe(self, method, url, response):
+        '''adjust the pacing of a subscription from a response's headers
+           - returns the seconds to wait before retrying a 429, or None
+        '''
+        key = (get_subscription_id(url), get_kind(method))
+        remaining = response.headers.get(REMAINING_HEADERS[key[1]])
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.get_bucket(key)
+            if remaining is not None:
+                try:
+                    remaining = int(remaining)
+                except ValueError:
+                    remaining = None
+            if remaining is not None:
+                self.remaining[key] = remaining
+                bucket.refill(now)
+                bucket.tokens = min(bucket.tokens, remaining)
+                if remaining < self.low_water:
+                    bucket.rate = bucket.base_rate * max(0.1, remaining / self.low_water)
+                else:
+                    bucket.rate = bucket.base_rate
+            if response.status_code != 429:
+                self.backoff[key] = 0
+                return None
+            self.throttled += 1
+            attempts = self.backoff.get(key, 0) + 1
+            self.backoff[key] = attempts
+            retry_after = polling.get_retry_after(response.headers)
+            if retry_after is None:
+                retry_after = min(self.max_backoff, 2 ** attempts)
+            bucket.paused_until = max(bucket.paused_until, now + retry_after)
+            bucket.refill(now)
+            bucket.tokens = min(bucket.tokens, 0)
+            return retry_after
+
+    def status(self):
+        '''snapshot of the governor's state for display'''
+        with self.lock:
+            return {'throttled': self.throttled, 'waited': round(self.waited, 3),
+                    'remaining': {key[0] + '/' + key[1]: value
+                                  for key, value in self.remaining.items()}}
@@ -0,0 +1,245 @@
+'''rollingupgrade.py - rolling upgrade engines for VM scale sets, usable without a GUI'''
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RollingUpgrade():
+    '''upgrades the VMs of a scale set one batch at a time
+       - each batch waits on the completion event of its upgrade operation, so the next
+         batch starts as soon as the previous one has finished
+       - the engine polls the operation's status URL itself, but wakes up immediately if
+         another thread (e.g. a GUI refresh loop) sees the operation finish first
+    '''
+
+    def __init__(self, scale_set, instance_ids, batchsize=1, pausetime=0, status_fn=None,
+                 batch_fn=None, min_poll=1, max_poll=15, health_budget=None, adaptive=False,
+                 max_batchsize=None, health_poll=10):
+        '''class initialization routine
+           - scale_set is a vmss or VMSSZ object, instance_ids the VMs in upgrade order
+           - status_fn(message) reports progress, batch_fn(batch_count, operation) is called
+             when each batch has been started
+           - with a health_budget (seconds) each batch has to come back running within the
+             budget; adaptive batch sizing doubles the batch size after a healthy batch (up
+             to max_batchsize) and halves it after a slow one
+        '''
+        self.scale_set = scale_set
+        self.instance_ids = list(instance_ids)
+        self.batchsize = max(1, batchsize)
+        self.pausetime = pausetime
+        self.status_fn = status_fn
+        self.batch_fn = batch_fn
+        self.min_poll = min_poll
+        self.max_poll = max_poll
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.health_budget = health_budget
+        self.health_poll = health_poll
+        self.adaptive = adaptive
+        self.max_batchsize = max_batchsize or len(self.instance_ids)
+        self.batch_count = 0
+        self.upgraded = []
+        self.failed_operation = None
+        self.unhealthy = []
+        self.error = None  # an exception which halted the upgrade, e.g. a connection error
+
+    def status(self, message):
+        '''report progress'''
+        if self.status_fn is not None:
+            self.status_fn(message)
+
+    def stop(self):
+        '''stop after the batches in progress'''
+        self.stop_event.set()
+
+    def wait_for(self, operation):
+        '''block until an operation is done or the upgrade is stopped'''
+        return operation.poll_until_done(self.scale_set.access_token, self.min_poll,
+                                         self.max_poll, self.stop_event)
+
+    def check_health(self, batch_list):
+        '''wait for an upgraded batch to come back running
+           - returns (health, unhealthy VMs): health is 'healthy' if every VM is running
+             within the health budget, 'slow' if some are still starting when the budget
+             runs out, 'stopped' if the upgrade is stopped first, otherwise 'failed'
+        '''
+        if self.health_budget is None:
+            return 'healthy', []
+        start_time = time.time()
+        while True:
+            power_states = self.scale_set.get_vm_power_states(batch_list)
+            states = [power_states.get(vmid) for vmid in batch_list]
+            if all(state == 'running' for state in states):
+                return 'healthy', []
+            if self.stop_event.is_set():  # e.g. another group failed, this batch didn't
+                return 'stopped', []
+            elapsed = time.time() - start_time
+            if elapsed >= self.health_budget:
+                if all(state in ('running', 'starting') for state in states):
+                    return 'slow', []
+                return 'failed', [vmid for vmid, state in zip(batch_list, states)
+                                  if state not in ('running', 'starting')]
+            self.stop_event.wait(min(self.health_poll, self.health_budget - elapsed))
+
+    def adapt(self, health):
+        '''grow the batch size after a healthy batch, shrink it after a slow one'''
+        if self.adaptive is False:
+            return
+        with self.lock:
+            if health == 'healthy':
+                self.batchsize = min(self.batchsize * 2, self.max_batchsize)
+            elif health == 'slow':
+                self.batchsize = max(1, self.batchsize // 2)
+
+    def upgrade_batch(self, batch_list):
+        '''upgrade one batch and wait for it, return True if it succeeded'''
+        with self.lock:
+            self.batch_count += 1
+            batch_count = self.batch_count
+        batch_number = str(batch_count)
+        self.status('Upgrading batch ' + batch_number)
+        operation = self.scale_set.upgradevm(json.dumps(batch_list))
+        if self.batch_fn is not None:
+            self.batch_fn(batch_count, operation)
+        self.status('Batch ' + batch_number + ' upgrade in progress')
+        if self.wait_for(operation) is False:
+            return False
+        if operation.state != 'Succeeded':
+            self.failed_operation = operation
+            self.status('Batch ' + batch_number + ' ' + str(operation))
+            return False
+        health, unhealthy = self.check_health(batch_list)
+        if health == 'stopped':
+            return False
+        if health == 'failed':
+            with self.lock:
+                self.unhealthy.extend(unhealthy)
+            self.status('Batch ' + batch_number + ' unhealthy VMs: ' + json.dumps(unhealthy))
+            return False
+        self.adapt(health)
+        with self.lock:
+            self.upgraded.extend(batch_list)
+        self.status('Batch ' + batch_number + ' complete (' + health + '), batch size: ' +
+                    str(self.batchsize))
+        return True
+
+    def try_batch(self, batch_list):
+        '''upgrade_batch(), counting an exception as a failed batch'''
+        try:
+            return self.upgrade_batch(batch_list)
+        except Exception as error:  # the batch may or may not have been submitted
+            self.error = error
+            self.status('Batch failed: ' + str(error))
+            return False
+
+    def run(self):
+        '''upgrade all the VMs, return True if every batch succeeded'''
+        upgrade_index = 0
+        while upgrade_index < len(self.instance_ids):
+            if self.stop_event.is_set():
+                self.status('Rolling upgrade stopped. Batch count: ' + str(self.batch_count))
+                return False
+            batch_list = self.instance_ids[upgrade_index:upgrade_index + self.batchsize]
+            upgrade_index += len(batch_list)
+            if self.try_batch(batch_list) is False:
+                self.status('Rolling upgrade halted. Batch count: ' + str(self.batch_count))
+                return False
+            # wait for pausetime, unless this was the last batch
+            if upgrade_index < len(self.instance_ids):
+                self.stop_event.wait(self.pausetime)
+        self.status('Rolling upgrade complete. Batch count: ' + str(self.batch_count))
+        return True
+
+
+class DomainRollingUpgrade(RollingUpgrade):
+    '''upgrades placement groups (or zones) in parallel
+       - domains maps a group id to a {fd: [instance ids]} dict, as returned by
+         vmss.get_domain_groups() or VMSSZ.get_domain_groups()
+       - the batches of a group run one at a time in FD order and never span two FDs, so
+         at most one FD per group is being upgraded
+       - batches of different groups run concurrently, with at most max_vms VMs being
+         upgraded at once (a single batch is always allowed to run)
+    '''
+
+    def __init__(self, scale_set, domains, batchsize=1, pausetime=0, max_vms=None,
+                 status_fn=None, batch_fn=None, min_poll=1, max_poll=15, health_budget=None,
+                 adaptive=False, max_batchsize=None, health_poll=10):
+        '''class initialization routine - max_vms defaults to batchsize, i.e. one batch at a
+           time
+        '''
+        instance_ids = [vmid for fd_dict in domains.values() for fd in sorted(fd_dict)
+                        for vmid in fd_dict[fd]]
+        super().__init__(scale_set, instance_ids, batchsize, pausetime, status_fn, batch_fn,
+                         min_poll, max_poll, health_budget, adaptive, max_batchsize,
+                         health_poll)
+        self.domains = domains
+        self.max_vms = max_vms or self.batchsize
+        self.in_flight = 0
+        self.capacity = threading.Condition()
+
+    def group_batches(self, fd_dict):
+        '''split the VMs of one group into batches which never span two FDs
+           - each batch takes the current batch size, which adaptive sizing may change
+        '''
+        for fd in sorted(fd_dict):
+            fd_list = fd_dict[fd]
+            batch_index = 0
+            while batch_index < len(fd_list):
+                batch_list = fd_list[batch_index:batch_index + self.batchsize]
+                batch_index += len(batch_list)
+                yield batch_list
+
+    def acquire(self, count):
+        '''wait until count more VMs can be upgraded, return False if stopped'''
+        with self.capacity:
+            while self.in_flight > 0 and self.in_flight + count > self.max_vms:
+                if self.stop_event.is_set():
+                    return False
+                self.capacity.wait(1)
+            self.in_flight += count
+        return True
+
+    def release(self, count):
+        '''count VMs have finished upgrading'''
+        with self.capacity:
+            self.in_flight -= count
+            self.capacity.notify_all()
+
+    def run_group(self, fd_dict):
+        '''upgrade the batches of one group in order, return True if they all succeeded'''
+        remaining = sum(len(fd_list) for fd_list in fd_dict.values())
+        for batch_list in self.group_batches(fd_dict):
+            if self.stop_event.is_set() or self.acquire(len(batch_list)) is False:
+                return False
+            try:
+                succeeded = self.try_batch(batch_list)
+            finally:
+                self.release(len(batch_list))
+            if succeeded is False:
+                # stop the other groups too
+                self.stop()
+                return False
+            # wait for pausetime, unless this was the group's last batch
+            remaining -= len(batch_list)
+            if remaining > 0:
+                self.stop_event.wait(self.pausetime)
+        return True
+
+    def run(self):
+        '''upgrade all the groups concurrently, return True if every batch succeeded'''
+        groups = [fd_dict for fd_dict in self.domains.values() if len(fd_dict) > 0]
+        if len(groups) == 0:
+            self.status('Rolling upgrade complete. Batch count: 0')
+            return True
+        with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+            results = list(executor.map(self.run_group, groups))
+        if all(results):
+            self.status('Rolling upgrade complete. Batch count: ' + str(self.batch_count))
+            return True
+        if self.failed_operation is not None or len(self.unhealthy) > 0 or \
+                self.error is not None:
+            self.status('Rolling upgrade halted. Batch count: ' + str(self.batch_count))
+        else:
+            self.status('Rolling upgrade stopped. Batch count: ' + str(self.batch_count))
+        return False
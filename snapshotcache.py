@@ -0,0 +1,152 @@
+'''snapshotcache.py - on-disk snapshots of scale set models and VM inventories for a warm start'''
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+import inventory
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.vmssdashboard', 'snapshots.db')
+
+
+def inventory_to_blob(vm_inventory):
+    '''serialize a VMInventory into a compressed blob'''
+    columns = {'instance_ids': vm_inventory.instance_ids, 'groups': vm_inventory.groups,
+               'pg': list(vm_inventory.pg), 'fd': list(vm_inventory.fd),
+               'ud': list(vm_inventory.ud), 'zone': list(vm_inventory.zone),
+               'power': list(vm_inventory.power)}
+    return zlib.compress(json.dumps(columns, separators=(',', ':')).encode('utf-8'))
+
+
+def inventory_from_blob(blob):
+    '''rebuild a VMInventory from inventory_to_blob() output'''
+    columns = json.loads(zlib.decompress(blob).decode('utf-8'))
+    vm_inventory = inventory.VMInventory()
+    groups = columns['groups']
+    for row, instance_id in enumerate(columns['instance_ids']):
+        vm_inventory.add(instance_id, groups[columns['pg'][row]], columns['fd'][row],
+                         columns['ud'][row], columns['power'][row], columns['zone'][row])
+    return vm_inventory
+
+
+class SnapshotCache():
+    '''SQLite store of the last known scale set models and VM inventories
+       - entries are keyed like the catalog, by (subscription id, resource group, name), and
+         carry the time they were saved so callers can show them as stale until refreshed
+       - prune() drops entries older than max_age seconds, then the oldest entries until
+         the stored data fits in max_bytes; it runs on opening and every prune_writes saves
+       - safe to use from several threads, writes are serialized by a lock
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, max_age=7 * 86400, max_bytes=50 * 1024 * 1024,
+                 prune_writes=50):
+        '''class initialization routine - path ':memory:' keeps the cache in memory'''
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.prune_writes = prune_writes
+        self.writes = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS models (sub_id TEXT, rgname TEXT, '
+                            'name TEXT, saved REAL, data BLOB, '
+                            'PRIMARY KEY (sub_id, rgname, name))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS inventories (sub_id TEXT, '
+                            'rgname TEXT, name TEXT, saved REAL, data BLOB, '
+                            'PRIMARY KEY (sub_id, rgname, name))')
+        self.prune()
+
+    def close(self):
+        '''close the database'''
+        with self.lock:
+            self.db.close()
+
+    def save_models(self, sub_id, models):
+        '''replace the saved models of a subscription with a {key: model} dict'''
+        saved = time.time()
+        rows = [key + (saved, zlib.compress(json.dumps(model).encode('utf-8')))
+                for key, model in models.items()]
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM models WHERE sub_id = ?', (sub_id,))
+            self.db.executemany('INSERT INTO models VALUES (?, ?, ?, ?, ?)', rows)
+        self.written()
+
+    def save_model(self, key, model):
+        '''save the model of one scale set'''
+        data = zlib.compress(json.dumps(model).encode('utf-8'))
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?)',
+                            key + (time.time(), data))
+        self.written()
+
+    def load_models(self):
+        '''return a {key: (model, saved time)} dict of the saved models'''
+        with self.lock:
+            rows = self.db.execute('SELECT sub_id, rgname, name, saved, data FROM models')
+            return {(sub_id, rgname, name): (json.loads(zlib.decompress(data).decode('utf-8')),
+                                             saved)
+                    for sub_id, rgname, name, saved, data in rows.fetchall()}
+
+    def save_inventory(self, key, vm_inventory):
+        '''save the VM inventory of a scale set'''
+        blob = inventory_to_blob(vm_inventory)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO inventories VALUES (?, ?, ?, ?, ?)',
+                            key + (time.time(), blob))
+        self.written()
+
+    def load_inventory(self, key):
+        '''return (VMInventory, saved time) for a scale set, or None if there is none'''
+        with self.lock:
+            row = self.db.execute('SELECT saved, data FROM inventories WHERE sub_id = ? AND '
+                                  'rgname = ? AND name = ?', key).fetchone()
+        if row is None:
+            return None
+        return inventory_from_blob(row[1]), row[0]
+
+    def written(self):
+        '''count a save, pruning the cache every prune_writes saves'''
+        with self.lock:
+            self.writes += 1
+            due = self.writes % self.prune_writes == 0
+        if due is True:
+            self.prune()
+
+    def size(self):
+        '''bytes of model and inventory data stored'''
+        with self.lock:
+            return sum(self.db.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM ' +
+                                       table).fetchone()[0]
+                       for table in ('models', 'inventories'))
+
+    def prune(self):
+        '''drop entries older than max_age, then the oldest until the cache fits max_bytes
+           - the file is vacuumed after rows are deleted, as SQLite keeps freed pages
+        '''
+        oldest = time.time() - self.max_age
+        with self.lock:
+            changes = self.db.total_changes
+            with self.db:
+                self.delete_pruned(oldest)
+            if self.db.total_changes != changes:
+                self.db.execute('VACUUM')
+
+    def delete_pruned(self, oldest):
+        '''delete the entries pruned by prune() - the caller holds the lock'''
+        for table in ('models', 'inventories'):
+            self.db.execute('DELETE FROM ' + table + ' WHERE saved < ?', (oldest,))
+        rows = self.db.execute(
+            'SELECT saved, LENGTH(data), tbl, sub_id, rgname, name FROM '
+            "(SELECT *, 'models' AS tbl FROM models UNION ALL "
+            "SELECT *, 'inventories' AS tbl FROM inventories) "
+            'ORDER BY saved DESC').fetchall()
+        total = 0
+        for saved, length, table, sub_id, rgname, name in rows:
+            total += length
+            if total > self.max_bytes:
+                self.db.execute('DELETE FROM ' + table + ' WHERE sub_id = ? AND '
+                                'rgname = ? AND name = ?', (sub_id, rgname, name))
@@ -0,0 +1,58 @@
+'''statspanel.py - Tk window showing the ARM call and render timings recorded by metrics.py'''
+import tkinter as tk
+from tkinter import filedialog
+
+import armclient
+import metrics
+
+
+class StatsPanel():
+    '''top level window with the latency histograms, payload sizes, retries and calls per
+       refresh tick recorded so far, refreshed every refresh_ms
+       - the metrics can be reset, or saved as JSON or Prometheus text
+    '''
+
+    def __init__(self, root, registry=None, refresh_ms=2000, bgcolor='#B0E0E6',
+                 textcolor='#F0FFFF'):
+        '''class initialization routine - registry defaults to the shared one'''
+        self.registry = registry or metrics.get_registry()
+        self.refresh_ms = refresh_ms
+        self.window = tk.Toplevel(root)
+        self.window.wm_title('ARM call and render statistics')
+        self.window.configure(background=bgcolor)
+        buttonframe = tk.Frame(self.window, bg=bgcolor)
+        tk.Button(buttonframe, text='Reset', command=self.reset, width=14).pack(side=tk.LEFT)
+        tk.Button(buttonframe, text='Save JSON', command=lambda: self.save('.json'),
+                  width=14).pack(side=tk.LEFT)
+        tk.Button(buttonframe, text='Save Prometheus', command=lambda: self.save('.prom'),
+                  width=14).pack(side=tk.LEFT)
+        buttonframe.pack(fill=tk.X)
+        self.text = tk.Text(self.window, height=30, width=118, bg=textcolor, font='TkFixedFont')
+        self.text.pack(fill=tk.BOTH, expand=True)
+        self.refresh()
+
+    def refresh(self):
+        '''redraw the statistics, then schedule the next refresh while the window is open'''
+        if not self.window.winfo_exists():
+            return
+        governor = armclient.get_client().governor.status()
+        text = self.registry.format_table() + '\n\nthrottled responses: ' + \
+            str(governor['throttled']) + ', seconds held back by the rate governor: ' + \
+            str(governor['waited'])
+        for bucket, remaining in sorted(governor['remaining'].items()):
+            text += '\nremaining ' + bucket + ': ' + str(remaining)
+        self.text.delete(1.0, tk.END)
+        self.text.insert(tk.END, text)
+        self.window.after(self.refresh_ms, self.refresh)
+
+    def reset(self):
+        '''start recording afresh'''
+        self.registry.reset()
+        self.text.delete(1.0, tk.END)
+
+    def save(self, extension):
+        '''ask for a file name and save the metrics, in Prometheus text format for .prom'''
+        path = filedialog.asksaveasfilename(parent=self.window, defaultextension=extension,
+                                            initialfile='vmssdashboard-metrics' + extension)
+        if path:
+            metrics.save(path, self.registry)
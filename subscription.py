@@ -1,39 +1,89 @@
 '''subscription.py - subscription class for basic subscription level operations'''
 import json
+import time
 
-import azurerm
+import armclient
+import metrics
+import tokenprovider
 
 
 # Azure subscription class
 class subscription():
     '''basic subscription level operations for VMSS Editor'''
-    def __init__(self, tenant_id, app_id, app_secret, subscription_id):
+    def __init__(self, tenant_id, app_id, app_secret, subscription_id, cache_ttl=300,
+                 client=None, name=None):
         self.sub_id = subscription_id
+        self.name = name or subscription_id  # display name
         self.tenant_id = tenant_id
         self.app_id = app_id
         self.app_secret = app_secret
         self.vmsslist = []
         self.vmssdict = {}
         self.status = ""
+        # seconds to reuse the VMSS list before listing the subscription again
+        self.cache_ttl = cache_ttl
+        self.list_time = None
+        # pooled REST client, shared with the vmss objects created for this subscription
+        self.client = client or armclient.get_client()
+        # the token is acquired on first use and refreshed ahead of expiry - pass
+        # token_provider to the vmss objects so they share it
+        self.token_provider = tokenprovider.TokenProvider(self.acquire_token)
 
-        self.access_token = azurerm.get_access_token(tenant_id, app_id, app_secret)
+    @property
+    def access_token(self):
+        '''the current access token'''
+        return self.token_provider.get()
+
+    def acquire_token(self):
+        '''get a new token from Azure AD, returning (token, expires_on)'''
+        # adal and azurerm are imported here as they are slow to import and only needed to
+        # authenticate
+        import adal
+        import azurerm
+        context = adal.AuthenticationContext(azurerm.get_auth_endpoint() + self.tenant_id,
+                                             api_version=None)
+        token_response = context.acquire_token_with_client_credentials(
+            azurerm.get_resource_endpoint(), self.app_id, self.app_secret)
+        expires_on = None
+        if 'expiresIn' in token_response:
+            expires_on = time.time() + int(token_response['expiresIn'])
+        return token_response['accessToken'], expires_on
 
     def auth(self):
         '''update the authentication token for this subscription'''
-        self.access_token = azurerm.get_access_token(self.tenant_id, self.app_id, self.app_secret)
-        return self.access_token
+        return self.token_provider.refresh()
 
-    def get_vmss_list(self):
-        '''list VM Scale Sets in this subscription - names only'''
-        vmss_sub_list = azurerm.list_vmss_sub(self.access_token, self.sub_id)
+    def get_vmss_list(self, force=False):
+        '''list VM Scale Sets in this subscription - names only
+           - the list is cached for cache_ttl seconds unless force is True
+        '''
+        if force is False and self.list_time is not None and \
+                time.time() - self.list_time < self.cache_ttl:
+            return self.vmsslist
+        with metrics.span('fetch', call='list_vmss_sub'):
+            vmss_sub_list = self.client.list_vmss_sub(self.token_provider, self.sub_id)
         # build a simple list of VM Scale Set names and a dictionary of VMSS model views
         try:
-            self.vmsslist = []
+            vmsslist = []
+            vmssdict = {}
             for vmss in vmss_sub_list['value']:
                 vmssname = vmss['name']
-                self.vmsslist.append(vmssname)
-                self.vmssdict[vmssname] = vmss
-
+                vmsslist.append(vmssname)
+                vmssdict[vmssname] = vmss
+            self.vmsslist = vmsslist
+            self.vmssdict = vmssdict
+            self.list_time = time.time()
+            self.status = ""
         except KeyError:
-            self.status = 'KeyError: azurerm.list_vmss_sub() returned: ' + json.dumps(vmss_sub_list)
+            self.status = 'KeyError: list_vmss_sub() returned: ' + json.dumps(vmss_sub_list)
         return self.vmsslist
+
+    def invalidate(self):
+        '''discard the cached VMSS list so the next get_vmss_list() lists the subscription'''
+        self.list_time = None
+
+    def update_vmss_model(self, vmssname, vmssmodel):
+        '''replace the cached model of one scale set, e.g. after vmss.refresh_model()'''
+        if vmssname not in self.vmssdict:
+            self.vmsslist.append(vmssname)
+        self.vmssdict[vmssname] = vmssmodel
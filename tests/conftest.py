@@ -0,0 +1,52 @@
+'''conftest.py - fixtures shared by the tests: a local ARM emulator and clients for it'''
+import json
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import armclient  # noqa: E402
+import armemulator  # noqa: E402
+import metrics  # noqa: E402
+import ratelimit  # noqa: E402
+
+
+def open_governor():
+    '''a rate governor which never holds a request back'''
+    return ratelimit.RateGovernor(read_rate=1e6, read_burst=1e6, write_rate=1e6,
+                                  write_burst=1e6)
+
+
+@pytest.fixture
+def emulator():
+    '''a running ARM emulator with short operations and small pages'''
+    emulator = armemulator.ArmEmulator(operation_time=0.1, page_size=10)
+    emulator.start()
+    yield emulator
+    emulator.stop()
+
+
+@pytest.fixture
+def client(emulator):
+    '''an ArmClient pointed at the emulator'''
+    client = armclient.ArmClient(endpoint=emulator.endpoint, governor=open_governor(),
+                                 registry=metrics.Registry())
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def open_scale_set(emulator, client):
+    '''returns open(scale_set_class, vmssname, **add_vmss_args), which adds a scale set to
+       the emulator and opens it as a vmss or VMSSZ object
+    '''
+    def open(scale_set_class, vmssname, **kwargs):
+        '''add and open an emulated scale set'''
+        model = emulator.add_vmss(vmssname, **kwargs)
+        return scale_set_class(vmssname, json.loads(json.dumps(model)), emulator.sub_id,
+                               'emulated-token', client=client)
+
+    return open
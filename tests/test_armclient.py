@@ -0,0 +1,135 @@
+'''test_armclient.py - the pooled ARM client, its paging and its retries'''
+import json
+
+import armclient
+import metrics
+import tokenprovider
+from conftest import open_governor
+
+URL = 'https://arm.test/subscriptions/sub/providers/Microsoft.Compute/' \
+      'virtualMachineScaleSets?api-version=2019-03-01'
+
+
+def fake_client(handler, **kwargs):
+    '''an ArmClient answering from handler, with an open governor and its own registry'''
+    return armclient.ArmClient(transport=armclient.FakeTransport(handler),
+                               governor=open_governor(), registry=metrics.Registry(), **kwargs)
+
+
+def test_get_all_follows_the_next_links():
+    pages = {URL: {'value': [1, 2], 'nextLink': URL + '&page=2'},
+             URL + '&page=2': {'value': [3], 'nextLink': URL + '&page=3'},
+             URL + '&page=3': {'value': [4]}}
+    client = fake_client(lambda request: (200, pages[request.url], {}))
+    assert client.get_all(URL, 'token') == {'value': [1, 2, 3, 4]}
+    assert [page['value'] for page in client.get_pages(URL, 'token')] == [[1, 2], [3], [4]]
+    client.close()
+
+
+def test_error_page_ends_the_list():
+    error = {'error': {'code': 'ResourceNotFound'}}
+    pages = {URL: {'value': [1], 'nextLink': URL + '&page=2'}, URL + '&page=2': error}
+    client = fake_client(lambda request: (404 if 'error' in pages[request.url] else 200,
+                                          pages[request.url], {}))
+    assert client.get_all(URL, 'token') == error
+    client.close()
+
+
+def test_action_is_posted_with_a_json_body():
+    sent = []
+
+    def handler(request):
+        sent.append((request.method, request.url, request.headers['Content-Type'],
+                     json.loads(request.body)))
+        return 202, None, {}
+
+    client = fake_client(handler)
+    response = client.vmss_action('token', 'sub', 'rg', 'vmss', 'restart', '["1", "2"]')
+    assert response.status_code == 202
+    assert sent == [('POST', 'https://management.azure.com/subscriptions/sub/resourceGroups/'
+                     'rg/providers/Microsoft.Compute/virtualMachineScaleSets/vmss/restart?'
+                     'api-version=2019-03-01', 'application/json',
+                     {'instanceIds': ['1', '2']})]
+    client.close()
+
+
+def test_the_shared_client_is_created_once(monkeypatch):
+    monkeypatch.setattr(armclient, 'default_client', None)
+    client = armclient.get_client()
+    assert armclient.get_client() is client
+    fake = fake_client(lambda request: (200, {'value': []}, {}))
+    armclient.set_client(fake)
+    assert armclient.get_client() is fake
+    client.close()
+    fake.close()
+
+
+def get_counter(client, name, **labels):
+    '''value of a counter in the client's metrics registry, 0 if never incremented'''
+    for counter in client.registry.snapshot()['counters']:
+        if counter['name'] == name and counter['labels'] == labels:
+            return counter['value']
+    return 0
+
+
+def test_unauthorized_request_renews_the_token():
+    tokens = iter(['expired', 'renewed'])
+    sent_tokens = []
+
+    def handler(request):
+        sent_tokens.append(request.headers['Authorization'])
+        if request.headers['Authorization'] == 'Bearer expired':
+            return 401, {'error': {'code': 'ExpiredAuthenticationToken'}}, {}
+        return 200, {'value': []}, {}
+
+    provider = tokenprovider.TokenProvider(lambda: (next(tokens), None))
+    client = fake_client(handler)
+    response = client.get(URL, provider)
+    assert response.status_code == 200
+    assert sent_tokens == ['Bearer expired', 'Bearer renewed']
+    assert get_counter(client, 'arm_retries_total', reason='unauthorized') == 1
+    client.close()
+
+
+def test_unauthorized_token_string_is_not_retried():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url)
+        return 401, {'error': {'code': 'InvalidAuthenticationToken'}}, {}
+
+    client = fake_client(handler)
+    assert client.get(URL, 'token').status_code == 401
+    assert len(calls) == 1
+    client.close()
+
+
+def test_throttled_request_is_sent_again():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url)
+        if len(calls) <= 2:
+            return 429, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': '0'}
+        return 200, {'value': []}, {}
+
+    client = fake_client(handler)
+    response = client.get(URL, 'token')
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert client.governor.status()['throttled'] == 2
+    assert get_counter(client, 'arm_retries_total', reason='throttled') == 2
+    client.close()
+
+
+def test_throttled_request_gives_up():
+    calls = []
+
+    def handler(request):
+        calls.append(request.url)
+        return 429, {'error': {'code': 'TooManyRequests'}}, {'Retry-After': '0'}
+
+    client = fake_client(handler, throttle_retries=2)
+    assert client.get(URL, 'token').status_code == 429
+    assert len(calls) == 3
+    client.close()
@@ -0,0 +1,95 @@
+'''test_bulkops.py - selecting scale sets and running one action on many of them'''
+import time
+
+import pytest
+
+import bulkops
+import catalog
+import subscription
+
+
+@pytest.fixture
+def vmss_catalog(emulator, client, monkeypatch):
+    '''a catalog of the emulator's subscription, with scale sets in two resource groups,
+       two locations and with different tags
+    '''
+    monkeypatch.setattr(subscription.subscription, 'acquire_token',
+                        lambda self: ('token', time.time() + 3600))
+    emulator.add_vmss('dev-web', 'DevRG', capacity=2, tags={'env': 'dev', 'team': 'web'})
+    emulator.add_vmss('dev-worker', 'devrg', capacity=2, location='eastus',
+                      tags={'env': 'dev'})
+    emulator.add_vmss('prod-web', 'prodrg', capacity=2, tags={'Env': 'prod', 'team': 'web'})
+    emulator.add_vmss('prod-worker', 'prodrg', capacity=2, location='eastus')
+    sub = subscription.subscription('tenant', 'app', 'secret', emulator.sub_id, client=client)
+    vmss_catalog = catalog.Catalog([sub])
+    vmss_catalog.refresh()
+    return vmss_catalog
+
+
+def names(keys):
+    '''the scale set names of a list of catalog keys'''
+    return sorted(key[2] for key in keys)
+
+
+def test_select_by_name_resource_group_location_and_tags(vmss_catalog):
+    assert names(bulkops.select(vmss_catalog, 'dev-*')) == ['dev-web', 'dev-worker']
+    assert names(bulkops.select(vmss_catalog, '*-web')) == ['dev-web', 'prod-web']
+    assert names(bulkops.select(vmss_catalog, resource_group='DEV*')) == \
+        ['dev-web', 'dev-worker']
+    assert names(bulkops.select(vmss_catalog, location='EastUS')) == \
+        ['dev-worker', 'prod-worker']
+    assert names(bulkops.select(vmss_catalog, tags=['team=web'])) == ['dev-web', 'prod-web']
+    assert names(bulkops.select(vmss_catalog, tags=['env'])) == \
+        ['dev-web', 'dev-worker', 'prod-web']
+    assert names(bulkops.select(vmss_catalog, tags=['env=prod', 'team'])) == ['prod-web']
+    assert names(bulkops.select(vmss_catalog, 'prod-*', location='westus',
+                                tags=['env=dev'])) == []
+
+
+def test_action_runs_on_every_selected_scale_set(emulator, vmss_catalog):
+    emulator.fail_actions.add('restart')
+    keys = bulkops.select(vmss_catalog, 'dev-*')
+    progress = []
+    bulk = bulkops.BulkOperation(vmss_catalog, keys, 'restart', max_workers=2, wait=True,
+                                 progress=lambda row: progress.append(row['name']))
+    rows = bulk.run()
+    assert [row['name'] for row in rows] == ['dev-web', 'dev-worker']
+    assert sorted(progress) == ['dev-web', 'dev-worker']
+    assert [row['state'] for row in rows] == ['Failed', 'Failed']
+    assert 'EmulatedFailure' in rows[0]['error']
+    assert bulk.summary()['states'] == {'Failed': 2}
+
+
+def test_min_interval_spaces_the_submissions(vmss_catalog):
+    keys = vmss_catalog.keys()
+    bulk = bulkops.BulkOperation(vmss_catalog, keys, 'start', max_workers=4,
+                                 min_interval=0.2)
+    start_time = time.time()
+    rows = bulk.run()
+    # four submissions at least 0.2 seconds apart, even with four workers
+    assert time.time() - start_time >= 0.6
+    assert all(row['state'] in ('InProgress', 'Succeeded') for row in rows)
+
+
+def test_stopped_operation_skips_the_rest(vmss_catalog):
+    bulk = bulkops.BulkOperation(vmss_catalog, vmss_catalog.keys(), 'start')
+    bulk.stop()
+    assert [row['state'] for row in bulk.run()] == ['Skipped'] * 4
+    assert bulk.summary()['submitLatency'] == {'p50': None, 'p95': None, 'max': None}
+
+
+def test_summary_percentiles(vmss_catalog):
+    bulk = bulkops.BulkOperation(vmss_catalog, [], 'start')
+    for latency in range(1, 21):
+        bulk.finish_row({'state': 'Succeeded', 'submitLatency': latency / 10,
+                         'duration': latency})
+    summary = bulk.summary()
+    assert summary['states'] == {'Succeeded': 20}
+    assert summary['submitLatency'] == {'p50': 1.1, 'p95': 2.0, 'max': 2.0}
+    assert summary['duration'] == {'p50': 11, 'p95': 20, 'max': 20}
+    assert bulkops.percentile([], 0.5) is None
+
+
+def test_unknown_action_is_rejected(vmss_catalog):
+    with pytest.raises(ValueError):
+        bulkops.BulkOperation(vmss_catalog, [], 'explode')
@@ -0,0 +1,100 @@
+'''test_catalog.py - listing scale sets across subscriptions'''
+import time
+
+import pytest
+import requests
+
+import armclient
+import armemulator
+import catalog
+import metrics
+import subscription
+from conftest import open_governor
+
+CONFIG = {'tenantId': 'tenant', 'appId': 'app', 'appSecret': 'secret', 'subscriptionId': 'sub-a',
+          'subscriptions': ['sub-b', {'subscriptionId': 'sub-c', 'appId': 'other-app',
+                                      'name': 'Other'}, 'sub-a']}
+
+
+class SubscriptionHandler():
+    '''FakeTransport handler listing two scale sets per subscription, failing the
+       subscriptions in failing with an error body, or raising for those in unreachable
+    '''
+
+    def __init__(self):
+        '''class initialization routine'''
+        self.failing = set()
+        self.unreachable = set()
+        self.listed = []
+
+    def __call__(self, request):
+        '''answer a scale set list request'''
+        sub_id = request.url.split('/subscriptions/')[1].split('/')[0]
+        self.listed.append(sub_id)
+        if sub_id in self.unreachable:
+            raise requests.ConnectionError('connection refused')
+        if sub_id in self.failing:
+            return 403, {'error': {'code': 'AuthorizationFailed'}}, {}
+        return 200, {'value': [armemulator.make_vmss_model(sub_id, 'rg', name)
+                               for name in ('web', 'worker')]}, {}
+
+
+@pytest.fixture
+def handler():
+    '''the handler the subscriptions are listed from'''
+    return SubscriptionHandler()
+
+
+@pytest.fixture
+def subscriptions(handler, monkeypatch):
+    '''the subscriptions of CONFIG, listed through a FakeTransport'''
+    monkeypatch.setattr(subscription.subscription, 'acquire_token',
+                        lambda self: (self.app_id + '-token', time.time() + 3600))
+    client = armclient.ArmClient(transport=armclient.FakeTransport(handler),
+                                 governor=open_governor(), registry=metrics.Registry())
+    yield catalog.load_subscriptions(CONFIG, client=client)
+    client.close()
+
+
+def test_config_subscriptions_share_a_token_provider_per_app(subscriptions):
+    assert [sub.sub_id for sub in subscriptions] == ['sub-a', 'sub-b', 'sub-c']
+    assert subscriptions[0].token_provider is subscriptions[1].token_provider
+    assert subscriptions[2].token_provider is not subscriptions[0].token_provider
+    assert subscriptions[2].name == 'Other'
+    assert subscriptions[2].access_token == 'other-app-token'
+
+
+def test_refresh_lists_every_subscription(handler, subscriptions):
+    vmss_catalog = catalog.Catalog(subscriptions)
+    results = {sub_id: (keys, error) for sub_id, keys, error in vmss_catalog.iter_refresh()}
+    assert sorted(handler.listed) == ['sub-a', 'sub-b', 'sub-c']
+    assert results['sub-b'] == ([('sub-b', 'rg', 'web'), ('sub-b', 'rg', 'worker')], None)
+    assert len(vmss_catalog) == 6
+    assert vmss_catalog.find('web', 'sub-c') == [('sub-c', 'rg', 'web')]
+    assert vmss_catalog.label(('sub-c', 'rg', 'web')) == 'web (Other/rg)'
+
+
+@pytest.mark.parametrize('failure', ['failing', 'unreachable'])
+def test_failed_subscription_keeps_its_entries(handler, subscriptions, failure):
+    vmss_catalog = catalog.Catalog(subscriptions)
+    assert vmss_catalog.refresh() == {}
+    getattr(handler, failure).add('sub-b')
+    errors = vmss_catalog.refresh(force=True)
+    assert list(errors) == ['sub-b']
+    assert ('AuthorizationFailed' if failure == 'failing' else 'connection refused') in \
+        errors['sub-b']
+    # the other subscriptions were listed again, sub-b's entries are kept
+    assert handler.listed.count('sub-a') == 2
+    assert vmss_catalog.keys('sub-b') == [('sub-b', 'rg', 'web'), ('sub-b', 'rg', 'worker')]
+    getattr(handler, failure).clear()
+    assert vmss_catalog.refresh(force=True) == {}
+
+
+def test_merge_replaces_the_entries_of_a_subscription(subscriptions):
+    vmss_catalog = catalog.Catalog(subscriptions)
+    vmss_catalog.refresh()
+    sub = subscriptions[0]
+    del sub.vmssdict['worker']
+    assert vmss_catalog.merge(sub) == [('sub-a', 'rg', 'web')]
+    assert vmss_catalog.keys('sub-a') == [('sub-a', 'rg', 'web')]
+    assert len(vmss_catalog) == 5
@@ -0,0 +1,87 @@
+'''test_dispatcher.py - work runs on the thread pool, results are handed to the UI thread'''
+import threading
+import time
+
+import dispatcher
+
+
+class FakeRoot():
+    '''stand-in for a tk root which records after() callbacks instead of running them'''
+
+    def __init__(self):
+        '''class initialization routine'''
+        self.scheduled = []
+
+    def after(self, ms, fn):
+        '''schedule fn, the test calls it'''
+        self.scheduled.append(fn)
+
+
+def drain(dispatch):
+    '''wait for something to be queued for the UI thread, then run one poll as Tk would
+       - the future is done just before its callback is queued
+    '''
+    deadline = time.time() + 5
+    while dispatch.ui_queue.empty() and time.time() < deadline:
+        time.sleep(0.01)
+    dispatch.root.scheduled.pop()()
+
+
+def test_work_runs_off_the_ui_thread_and_its_callback_on_it():
+    dispatch = dispatcher.Dispatcher(FakeRoot())
+    threads = {}
+
+    def work(value):
+        '''record the worker thread'''
+        threads['work'] = threading.current_thread()
+        return value * 2
+
+    def callback(result):
+        '''record the callback thread and result'''
+        threads['callback'] = threading.current_thread()
+        threads['result'] = result
+
+    future = dispatch.submit(work, 21, callback=callback)
+    future.result(5)
+    assert threads['work'] is not threading.current_thread()
+    assert 'callback' not in threads  # not until the UI thread polls
+    drain(dispatch)
+    assert threads['callback'] is threading.current_thread()
+    assert threads['result'] == 42
+    assert len(dispatch.root.scheduled) == 1  # the next poll
+    dispatch.shutdown()
+
+
+def test_errors_go_to_the_errback_or_error_fn():
+    errors = []
+    dispatch = dispatcher.Dispatcher(FakeRoot(), error_fn=lambda error: errors.append(
+        ('error_fn', str(error))))
+
+    def fail(message):
+        '''work which raises'''
+        raise ValueError(message)
+
+    dispatch.submit(fail, 'first')
+    drain(dispatch)
+    dispatch.submit(fail, 'second', errback=lambda error: errors.append(('errback', str(error))))
+    drain(dispatch)
+    assert errors == [('error_fn', 'first'), ('errback', 'second')]
+    dispatch.shutdown()
+
+
+def test_call_soon_from_a_worker_runs_on_the_ui_thread():
+    dispatch = dispatcher.Dispatcher(FakeRoot(), error_fn=lambda error: None)
+    calls = []
+
+    def work():
+        '''queue a UI call which fails, then one which succeeds'''
+        dispatch.call_soon(lambda: 1 / 0)
+        dispatch.call_soon(lambda: calls.append(dispatch.on_ui_thread()))
+        return dispatch.on_ui_thread()
+
+    future = dispatch.submit(work)
+    assert future.result(5) is False
+    drain(dispatch)
+    # the failed call is reported without stopping the queue
+    assert calls == [True]
+    dispatch.shutdown()
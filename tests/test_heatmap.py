@@ -0,0 +1,151 @@
+'''test_heatmap.py - the heatmaps only touch the canvas items of VMs which changed'''
+import heatmap
+import inventory
+
+RUNNING = 1
+STOPPED = 3
+
+
+class StubCanvas():
+    '''stand-in for a tk.Canvas which records the items each call touches'''
+
+    def __init__(self):
+        '''class initialization routine'''
+        self.next_id = 0
+        self.created = []  # (kind, item id)
+        self.touched = []  # (method, item id) of calls changing existing items
+        self.texts = {}    # item id -> text of the text items
+
+    def create(self, kind):
+        '''create an item, return its id'''
+        self.next_id += 1
+        self.created.append((kind, self.next_id))
+        return self.next_id
+
+    def create_oval(self, *args, **kwargs):
+        '''create a VM circle'''
+        return self.create('oval')
+
+    def create_text(self, *args, **kwargs):
+        '''create a label'''
+        item = self.create('text')
+        self.texts[item] = kwargs.get('text')
+        return item
+
+    def create_line(self, *args, **kwargs):
+        '''create a grid line'''
+        return self.create('line')
+
+    def create_rectangle(self, *args, **kwargs):
+        '''create a zone background'''
+        return self.create('rectangle')
+
+    def coords(self, item, *args):
+        '''move an item'''
+        self.touched.append(('coords', item))
+
+    def itemconfig(self, item, **kwargs):
+        '''change an item's options'''
+        self.touched.append(('itemconfig', item))
+
+    def delete(self, *items):
+        '''delete items'''
+        for item in items:
+            self.touched.append(('delete', item))
+
+    def cget(self, option):
+        '''canvas options, only the width is asked for'''
+        return '1300'
+
+
+def vm_entries(count, group_id='single group', power=RUNNING):
+    '''[group_id, instance_id, fd, ud, power] entries spread over the FDs and UDs'''
+    return [[group_id, str(vmid), vmid % 5, (vmid // 5) % 5, power] for vmid in range(count)]
+
+
+def test_unchanged_update_touches_nothing():
+    canvas = StubCanvas()
+    domain_heatmap = heatmap.DomainHeatmap(canvas)
+    domain_heatmap.update(vm_entries(12))
+    created = len(canvas.created)
+    canvas.touched = []
+    domain_heatmap.update(vm_entries(12))
+    assert len(canvas.created) == created
+    assert canvas.touched == []
+
+
+def test_update_recolors_only_the_changed_vm():
+    canvas = StubCanvas()
+    domain_heatmap = heatmap.DomainHeatmap(canvas)
+    vm_list = vm_entries(12)
+    domain_heatmap.update(vm_list)
+    created = len(canvas.created)
+    canvas.touched = []
+    vm_list[7][4] = STOPPED
+    domain_heatmap.update(vm_list)
+    assert len(canvas.created) == created
+    assert canvas.touched == [('itemconfig', domain_heatmap.items['7'][0])]
+    assert domain_heatmap.items['7'][4] == inventory.POWER_COLORS[STOPPED]
+
+
+def test_update_moves_only_the_vm_which_moved():
+    canvas = StubCanvas()
+    domain_heatmap = heatmap.DomainHeatmap(canvas)
+    vm_list = vm_entries(12)
+    domain_heatmap.update(vm_list)
+    canvas.touched = []
+    vm_list[11][3] = 4  # a new update domain
+    domain_heatmap.update(vm_list)
+    oval, text = domain_heatmap.items['11'][:2]
+    assert canvas.touched == [('coords', oval), ('coords', text)]
+
+
+def test_update_deletes_removed_vms_and_creates_new_ones():
+    canvas = StubCanvas()
+    domain_heatmap = heatmap.DomainHeatmap(canvas)
+    domain_heatmap.update(vm_entries(12))
+    removed = domain_heatmap.items['11'][:2]
+    created = len(canvas.created)
+    canvas.touched = []
+    vm_list = vm_entries(11) + [['single group', '20', 0, 2, RUNNING]]
+    domain_heatmap.update(vm_list)
+    assert [kind for kind, _ in canvas.created[created:]] == ['oval', 'text']
+    assert canvas.touched == [('delete', removed[0]), ('delete', removed[1])]
+    assert sorted(domain_heatmap.items, key=int) == [str(vmid) for vmid in range(11)] + ['20']
+
+
+def test_removed_placement_group_grid_is_deleted():
+    canvas = StubCanvas()
+    domain_heatmap = heatmap.DomainHeatmap(canvas)
+    domain_heatmap.update(vm_entries(5, 'pg-0') + vm_entries(5, 'pg-1') +
+                          [['pg-2', '10', 0, 0, RUNNING]])
+    removed_grid = domain_heatmap.grids['pg-1']
+    origin = domain_heatmap.groups['pg-1']
+    canvas.touched = []
+    # pg-1 is gone after a scale in, a new pg-3 takes its place
+    domain_heatmap.update(vm_entries(5, 'pg-0') + [['pg-2', '10', 0, 0, RUNNING],
+                                                   ['pg-3', '11', 0, 0, RUNNING]])
+    deleted = [item for method, item in canvas.touched if method == 'delete']
+    assert set(removed_grid) <= set(deleted)
+    assert sorted(domain_heatmap.groups) == ['pg-0', 'pg-2', 'pg-3']
+    assert domain_heatmap.groups['pg-3'] == origin
+    assert 'Placement group: pg-3' in canvas.texts.values()
+
+
+def test_zone_heatmap_counts_vms_without_a_zone():
+    canvas = StubCanvas()
+    zone_heatmap = heatmap.ZoneHeatmap(canvas, 1300, 800)
+    vm_inventory = inventory.VMInventory()
+    for vmid in range(4):
+        vm_inventory.add(str(vmid), 'single group', vmid % 2, 0, RUNNING, vmid % 2)
+    zone_heatmap.update(vm_inventory)
+    assert sorted(zone_heatmap.items) == ['1', '3']
+    assert '2 VMs are not in an availability zone and are not shown' in \
+        canvas.texts.values()
+    # the count is replaced on each update, and goes once every VM is in a zone
+    zonal = inventory.VMInventory()
+    zonal.add('1', 'single group', 1, 0, RUNNING, 1)
+    canvas.touched = []
+    zone_heatmap.update(zonal)
+    assert ('delete', 'unzoned') in canvas.touched
+    assert len([text for text in canvas.texts.values() if 'availability zone' in text]) == 1
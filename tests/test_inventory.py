@@ -0,0 +1,97 @@
+'''test_inventory.py - the column-wise inventory groups VMs like the old per-VM dicts did'''
+import pytest
+
+import inventory
+import vmss
+
+POWERS = ['running', 'stopped', 'deallocated', 'starting']
+
+
+def set_domain_lists(instance_views, single_placement_group):
+    '''the dict-based grouping vmss.set_domain_lists() did before VMInventory, as
+       {group id: {'fd_dict': {fd: [[instance id, power]]}, 'ud_dict': ...}}
+    '''
+    if single_placement_group is False:
+        instance_views = sorted(
+            instance_views, key=lambda k: k['properties']['instanceView']['placementGroupId'])
+    pg_dict = {}
+    for instance in instance_views:
+        instance_view = instance['properties']['instanceView']
+        group_id = instance_view.get('placementGroupId', 'single group')
+        power_state = [status['code'][11:] for status in instance_view['statuses']
+                       if status['code'].startswith('Power')][0]
+        pg = pg_dict.setdefault(group_id, {'fd_dict': {f: [] for f in range(5)},
+                                           'ud_dict': {u: [] for u in range(5)}})
+        pg['fd_dict'][instance_view['platformFaultDomain']].append(
+            [instance['instanceId'], power_state])
+        pg['ud_dict'][instance_view['platformUpdateDomain']].append(
+            [instance['instanceId'], power_state])
+    return pg_dict
+
+
+@pytest.fixture
+def mixed_scale_set(emulator, open_scale_set):
+    '''a loaded scale set of 3 placement groups interleaved across 5 pages of 10, with
+       mixed power states
+    '''
+    scale_set = open_scale_set(vmss.vmss, 'mixed', capacity=47, placement_groups=3)
+    for vmid, vm in emulator.vmss[('vmssrg', 'mixed')].vms.items():
+        vm['power'] = POWERS[int(vmid) % len(POWERS)]
+    scale_set.load_vm_instance_view()
+    return scale_set
+
+
+def test_fd_and_ud_lists_match_the_dict_grouping(mixed_scale_set):
+    vm_inventory = mixed_scale_set.inventory
+    expected = set_domain_lists(mixed_scale_set.vm_instance_view['value'], False)
+    assert sorted(vm_inventory.groups) == sorted(expected) == ['pg-0', 'pg-1', 'pg-2']
+    for group_id, pg in expected.items():
+        for domain in range(5):
+            assert [[vmid, vm_inventory.power_state(vm_inventory.rows[vmid])]
+                    for vmid in vm_inventory.fd_ids(domain, group_id)] == pg['fd_dict'][domain]
+            assert [[vmid, vm_inventory.power_state(vm_inventory.rows[vmid])]
+                    for vmid in vm_inventory.ud_ids(domain, group_id)] == pg['ud_dict'][domain]
+    # across all placement groups
+    assert sorted(vm_inventory.fd_ids(2), key=int) == \
+        sorted([vm[0] for pg in expected.values() for vm in pg['fd_dict'][2]], key=int)
+
+
+def test_domain_groups_match_the_dict_grouping(mixed_scale_set):
+    expected = set_domain_lists(mixed_scale_set.vm_instance_view['value'], False)
+    # the old lists had an entry for every FD, empty or not
+    assert mixed_scale_set.get_domain_groups() == {
+        group_id: {fd: [vm[0] for vm in vms] for fd, vms in pg['fd_dict'].items() if vms}
+        for group_id, pg in expected.items()}
+
+
+def test_groups_are_bucketed_in_arrival_order():
+    vm_inventory = inventory.VMInventory()
+    for vmid, group_id in enumerate(['pg-b', 'pg-a', 'pg-b', 'pg-c', 'pg-a']):
+        vm_inventory.add(str(vmid), group_id, vmid % 5, 0, 1)
+    assert vm_inventory.groups == ['pg-b', 'pg-a', 'pg-c']
+    assert vm_inventory.fd_ids(0, 'pg-b') == ['0']
+    assert vm_inventory.ud_ids(0, 'pg-a') == ['1', '4']
+    assert vm_inventory.fd_ids(0, 'pg-missing') == []
+
+
+@pytest.mark.parametrize('power_state', inventory.POWER_STATES[1:])
+def test_power_state_is_decoded_once_into_a_code(power_state):
+    statuses = [{'code': 'ProvisioningState/succeeded'}, {'code': 'PowerState/' + power_state}]
+    code = inventory.decode_power_state(statuses)
+    assert inventory.POWER_STATES[code] == power_state
+    assert inventory.POWER_COLORS[code] != inventory.POWER_COLORS[0]
+
+
+def test_missing_power_state_is_unknown():
+    assert inventory.decode_power_state([{'code': 'ProvisioningState/updating'}]) == 0
+    assert inventory.decode_power_state([{'code': 'PowerState/hibernated'}]) == 0
+
+
+def test_power_codes_match_the_decoded_names(mixed_scale_set):
+    vm_inventory = mixed_scale_set.inventory
+    for vm in mixed_scale_set.vm_instance_view['value']:
+        row = vm_inventory.rows[vm['instanceId']]
+        assert vm_inventory.power_state(row) == POWERS[int(vm['instanceId']) % len(POWERS)]
+    vm_inventory.set_power_state('0', 2)
+    assert vm_inventory.power_state(vm_inventory.rows['0']) == 'stopped'
+    assert vm_inventory.set_power_state('missing', 2) is False
@@ -0,0 +1,59 @@
+'''test_metrics.py - histograms, counters and their export'''
+import json
+
+import metrics
+
+
+def test_prometheus_text():
+    registry = metrics.Registry()
+    registry.inc('arm_retries_total', reason='throttled')
+    registry.inc('arm_retries_total', 2, reason='transport')
+    for value in (3, 40, 40, 5000):
+        registry.observe('arm_response_bytes', value, (256, 4096), method='GET')
+    registry.observe('custom_thing', 1, (1,))
+    assert registry.to_prometheus().splitlines() == [
+        '# HELP vmssdashboard_arm_retries_total ARM requests sent again, by reason',
+        '# TYPE vmssdashboard_arm_retries_total counter',
+        'vmssdashboard_arm_retries_total{reason="throttled"} 1',
+        'vmssdashboard_arm_retries_total{reason="transport"} 2',
+        '# HELP vmssdashboard_arm_response_bytes ARM response body size by method and route',
+        '# TYPE vmssdashboard_arm_response_bytes histogram',
+        'vmssdashboard_arm_response_bytes_bucket{method="GET",le="256"} 3',
+        'vmssdashboard_arm_response_bytes_bucket{method="GET",le="4096"} 3',
+        'vmssdashboard_arm_response_bytes_bucket{method="GET",le="+Inf"} 4',
+        'vmssdashboard_arm_response_bytes_sum{method="GET"} 5083.0',
+        'vmssdashboard_arm_response_bytes_count{method="GET"} 4',
+        '# HELP vmssdashboard_custom_thing Custom thing',
+        '# TYPE vmssdashboard_custom_thing histogram',
+        'vmssdashboard_custom_thing_bucket{le="1"} 1',
+        'vmssdashboard_custom_thing_bucket{le="+Inf"} 1',
+        'vmssdashboard_custom_thing_sum 1.0',
+        'vmssdashboard_custom_thing_count 1']
+
+
+def test_label_values_are_escaped():
+    assert metrics.format_labels((('route', 'a"b\\c\nd'), ('bad-name', 1))) == \
+        '{route="a\\"b\\\\c\\nd",bad_name="1"}'
+
+
+def test_requests_are_recorded_by_route():
+    registry = metrics.Registry()
+    url = 'https://management.azure.com/subscriptions/sub/resourceGroups/rg/providers/' \
+          'Microsoft.Compute/virtualMachineScaleSets/vmss/virtualMachines?' \
+          '$expand=instanceView&api-version=2019-03-01'
+    registry.record_request('GET', url, 200, 0.02, 1000)
+    registry.record_request('GET', url, 200, 0.3, 3000)
+    registry.tick()
+    snapshot = json.loads(registry.to_json())
+    route = 'virtualMachineScaleSets/{}/virtualMachines?$expand=instanceView'
+    seconds = [histogram for histogram in snapshot['histograms']
+               if histogram['name'] == 'arm_request_seconds'][0]
+    assert seconds['labels'] == {'method': 'GET', 'route': route}
+    assert seconds['count'] == 2
+    assert seconds['buckets']['0.025'] == 1 and seconds['buckets']['0.5'] == 2
+    assert snapshot['counters'] == [{'name': 'arm_requests_total', 'value': 2,
+                                     'labels': {'method': 'GET', 'route': route,
+                                                'status': '200'}}]
+    calls = [histogram for histogram in snapshot['histograms']
+             if histogram['name'] == 'arm_calls_per_tick'][0]
+    assert calls['sum'] == 2
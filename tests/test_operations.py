@@ -0,0 +1,157 @@
+'''test_operations.py - polling long running operations and keeping their history'''
+import threading
+
+import pytest
+import requests
+
+import armclient
+import operations
+import vmss
+
+STATUS_URL = 'https://arm.test/subscriptions/sub/providers/Microsoft.Compute/locations/' \
+             'westus/operations/1?api-version=2019-03-01'
+LOCATION_URL = 'https://arm.test/subscriptions/sub/providers/Microsoft.Compute/locations/' \
+               'westus/operationResults/1?api-version=2019-03-01'
+
+
+def make_response(status_code, headers=None, content=b''):
+    '''an HTTP response, as returned by an action or a status poll'''
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = content
+    response.encoding = 'utf-8'
+    return response
+
+
+class StatusTransport():
+    '''requests adapter answering operation polls from a list of canned responses, the
+       last one repeating
+    '''
+
+    def __init__(self, *responses):
+        '''class initialization routine - responses are (status_code, content) tuples'''
+        self.responses = list(responses)
+        self.polls = []
+
+    def send(self, request, **kwargs):
+        '''answer the next poll'''
+        self.polls.append(request.url)
+        status_code, content = self.responses[min(len(self.polls), len(self.responses)) - 1]
+        response = make_response(status_code, content=content)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        '''nothing to close'''
+        pass
+
+
+def start(*responses, headers=None):
+    '''an in-progress operation polled through a StatusTransport, and the transport'''
+    transport = StatusTransport(*responses)
+    client = armclient.ArmClient(transport=transport, throttle_retries=0)
+    operation = operations.Operation(
+        'restart', make_response(202, headers or {'Azure-AsyncOperation': STATUS_URL}),
+        client=client)
+    return operation, transport
+
+
+def test_async_operation_is_polled_until_it_succeeds(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'async', capacity=3)
+    operation = scale_set.restart()
+    assert operation.state == 'InProgress'
+    assert operation.status_url is not None
+    assert operation.poll(scale_set.access_token) is False
+    assert operation.poll_until_done(scale_set.access_token, min_poll=0.02, max_poll=0.1)
+    assert operation.state == 'Succeeded'
+    assert operation.error is None
+    assert scale_set.operations.in_flight() == []
+
+
+def test_async_operation_failure_is_reported(emulator, open_scale_set):
+    emulator.fail_actions.add('restart')
+    scale_set = open_scale_set(vmss.vmss, 'failing', capacity=3)
+    operation = scale_set.restart()
+    operation.poll_until_done(scale_set.access_token, min_poll=0.02, max_poll=0.1)
+    assert operation.state == 'Failed'
+    assert operation.error['code'] == 'EmulatedFailure'
+
+
+def test_location_operation_is_done_when_it_stops_returning_202():
+    operation, transport = start((202, b''), (202, b''), (200, b''),
+                                 headers={'Location': LOCATION_URL})
+    assert operation.status_url is None
+    assert operation.location_url == LOCATION_URL
+    assert operation.poll_until_done('token', min_poll=0.01, max_poll=0.02)
+    assert operation.state == 'Succeeded'
+    assert transport.polls == [LOCATION_URL] * 3
+
+
+@pytest.mark.parametrize('content', [b'', b'<html><body>Bad gateway</body></html>'])
+def test_status_without_json_is_still_in_progress(content):
+    operation, transport = start((202, content), (200, b'{"status": "Succeeded"}'))
+    assert operation.poll('token') is False
+    assert operation.state == 'InProgress'
+    assert operation.poll('token') is True
+    assert operation.state == 'Succeeded'
+
+
+def test_status_error_page_fails_the_operation():
+    operation, transport = start((404, b'<html>Not Found</html>'))
+    assert operation.poll('token') is True
+    assert operation.state == 'Failed'
+    assert operation.error == '<html>Not Found</html>'
+
+
+def test_throttled_poll_keeps_waiting():
+    operation, transport = start((429, b''))
+    assert operation.poll('token') is False
+    assert operation.state == 'InProgress'
+
+
+def test_synchronous_action_is_done_straight_away():
+    transport = StatusTransport()
+    operation = operations.Operation('restart', make_response(200),
+                                     client=armclient.ArmClient(transport=transport))
+    assert operation.is_done()
+    assert operation.state == 'Succeeded'
+    assert operation.poll('token') is True
+    assert operation.poll_until_done('token') is True
+    assert transport.polls == []
+
+
+def test_rejected_action_fails_straight_away():
+    operation = operations.Operation('restart', make_response(409, content=b'conflict'),
+                                     client=armclient.ArmClient(transport=StatusTransport()))
+    assert operation.state == 'Failed'
+    assert operation.error == 'conflict'
+
+
+def test_poll_until_done_returns_when_stopped():
+    operation, transport = start((200, b'{"status": "InProgress"}'))
+    stop_event = threading.Event()
+    stop_event.set()
+    assert operation.poll_until_done('token', 0.01, 0.02, stop_event) is False
+    assert operation.state == 'InProgress'
+
+
+def test_tracker_keeps_in_flight_and_the_latest_finished_operations():
+    tracker = operations.OperationTracker(armclient.ArmClient(transport=StatusTransport()),
+                                          history=2)
+    in_flight = tracker.start('restart', make_response(202, {'Location': LOCATION_URL}))
+    finished = [tracker.start('scale', make_response(200)) for _ in range(5)]
+    assert tracker.operations == [in_flight] + finished[-2:]
+    assert tracker.in_flight() == [in_flight]
+
+
+def test_tracker_last_change():
+    tracker = operations.OperationTracker(armclient.ArmClient(transport=StatusTransport()))
+    assert tracker.last_change() is None
+    operation = tracker.start('restart', make_response(202, {'Location': LOCATION_URL}))
+    assert tracker.last_change() == operation.start_time
+    operation.finish('Succeeded')
+    assert tracker.last_change() == operation.end_time
+    later = tracker.start('scale', make_response(200))
+    assert tracker.last_change() == later.end_time
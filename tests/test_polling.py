@@ -0,0 +1,72 @@
+'''test_polling.py - poll backoff and conditional model reads'''
+import threading
+import time
+
+import armclient
+import polling
+
+URL = 'https://arm.test/subscriptions/sub/resourceGroups/rg/providers/Microsoft.Compute/' \
+      'virtualMachineScaleSets/vmss?api-version=2019-03-01'
+
+
+def test_backoff_doubles_up_to_max_interval():
+    poller = polling.PollScheduler(min_interval=2, max_interval=30)
+    delays = [poller.next_delay('Updating') for _ in range(6)]
+    assert delays == [2, 4, 8, 16, 30, 30]
+
+
+def test_backoff_resets_when_the_state_changes():
+    poller = polling.PollScheduler(min_interval=2, max_interval=30)
+    for _ in range(4):
+        poller.next_delay('Updating')
+    assert poller.next_delay('Succeeded') == 2
+    assert poller.next_delay('Succeeded') == 4
+
+
+def test_kick_polls_fast_again():
+    poller = polling.PollScheduler(min_interval=2, max_interval=30)
+    for _ in range(4):
+        poller.next_delay('Succeeded')
+    poller.kick()
+    assert poller.next_delay('Succeeded') == 2
+
+
+def test_retry_after_overrides_a_shorter_delay():
+    poller = polling.PollScheduler(min_interval=2, max_interval=30)
+    assert poller.next_delay('Updating', retry_after=20) == 20
+    assert poller.next_delay('Updating', retry_after=1) == 4
+    assert polling.get_retry_after({'Retry-After': '17'}) == 17
+    assert polling.get_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) is None
+    assert polling.get_retry_after({}) is None
+
+
+def test_wait_returns_early_on_kick():
+    poller = polling.PollScheduler()
+    threading.Timer(0.05, poller.kick).start()
+    start_time = time.time()
+    poller.wait(10)
+    assert time.time() - start_time < 5
+
+
+def test_conditional_get_reports_changes_only():
+    model = {'name': 'vmss', 'properties': {'provisioningState': 'Succeeded'}}
+    sent_etags = []
+
+    def handler(request):
+        etag = request.headers.get('If-None-Match')
+        sent_etags.append(etag)
+        if etag == '"2"':
+            return 304, None, {}
+        return 200, model, {'ETag': '"2"'}
+
+    client = armclient.ArmClient(transport=armclient.FakeTransport(handler))
+    response, changed, fingerprint = polling.conditional_get(client, URL, 'token')
+    assert changed is True and response.status_code == 200
+    # same payload without an ETag match: fetched, but not a change
+    response, changed, same = polling.conditional_get(client, URL, 'token', None, fingerprint)
+    assert changed is False and same == fingerprint
+    # ETag matched
+    response, changed, same = polling.conditional_get(client, URL, 'token', '"2"', fingerprint)
+    assert response.status_code == 304 and changed is False and same == fingerprint
+    assert sent_etags == [None, None, '"2"']
+    client.close()
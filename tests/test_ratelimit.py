@@ -0,0 +1,73 @@
+'''test_ratelimit.py - pacing ARM requests from the remaining-limit headers and 429s'''
+import requests
+
+import ratelimit
+
+URL = 'https://arm.test/subscriptions/SUB/resourceGroups/rg/providers/Microsoft.Compute/' \
+      'virtualMachineScaleSets/vmss?api-version=2019-03-01'
+
+
+def make_response(status_code=200, **headers):
+    '''a response with some headers'''
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    return response
+
+
+def remaining_reads(count):
+    '''a GET response with count reads remaining'''
+    return make_response(**{'x-ms-ratelimit-remaining-subscription-reads': str(count)})
+
+
+def test_requests_are_bucketed_by_subscription_and_kind():
+    assert ratelimit.get_subscription_id(URL) == 'sub'
+    assert ratelimit.get_subscription_id('https://arm.test/providers') == ''
+    assert ratelimit.get_kind('GET') == 'reads'
+    assert ratelimit.get_kind('PATCH') == 'writes'
+
+
+def test_remaining_header_caps_the_bucket():
+    governor = ratelimit.RateGovernor(read_rate=25, read_burst=250, low_water=50)
+    assert governor.observe('GET', URL, remaining_reads(120)) is None
+    bucket = governor.buckets[('sub', 'reads')]
+    assert bucket.tokens <= 120
+    assert bucket.rate == 25  # still above low water
+    assert governor.status()['remaining'] == {'sub/reads': 120}
+    # writes are paced separately
+    assert ('sub', 'writes') not in governor.buckets
+
+
+def test_falling_remaining_slows_the_refill_below_low_water():
+    governor = ratelimit.RateGovernor(read_rate=25, read_burst=250, low_water=50)
+    rates = []
+    for remaining in (60, 40, 25, 10, 2):
+        governor.observe('GET', URL, remaining_reads(remaining))
+        bucket = governor.buckets[('sub', 'reads')]
+        assert bucket.tokens <= remaining
+        rates.append(bucket.rate)
+    assert rates == [25, 20, 12.5, 5, 2.5]  # in proportion, but never below a tenth
+    # the limit has been reset
+    governor.observe('GET', URL, remaining_reads(11999))
+    assert governor.buckets[('sub', 'reads')].rate == 25
+
+
+def test_bucket_makes_callers_wait_once_empty():
+    governor = ratelimit.RateGovernor(read_rate=100, read_burst=2)
+    assert governor.acquire('GET', URL) == 0
+    assert governor.acquire('GET', URL) == 0
+    assert governor.acquire('GET', URL) > 0
+    assert governor.status()['waited'] > 0
+
+
+def test_throttled_response_pauses_the_subscription():
+    governor = ratelimit.RateGovernor(max_backoff=60)
+    assert governor.observe('GET', URL, make_response(429, **{'Retry-After': '7'})) == 7
+    assert governor.observe('GET', URL, make_response(429)) == 4  # second 429 in a row
+    assert governor.status()['throttled'] == 2
+    bucket = governor.buckets[('sub', 'reads')]
+    assert bucket.tokens <= 0
+    assert bucket.paused_until > 0
+    # a success resets the backoff
+    governor.observe('GET', URL, make_response(200))
+    assert governor.observe('GET', URL, make_response(429)) == 2
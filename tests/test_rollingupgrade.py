@@ -0,0 +1,172 @@
+'''test_rollingupgrade.py - rolling upgrades of placement groups in parallel'''
+import json
+import threading
+import time
+
+import rollingupgrade
+import vmss
+
+
+class InFlightCounter():
+    '''counts the VMs from each batch's upgrade request until the engine releases them'''
+
+    def __init__(self, scale_set, engine):
+        '''class initialization routine - wraps scale_set.upgradevm and engine.release'''
+        self.count = 0
+        self.max = 0
+        self.lock = threading.Lock()
+        upgradevm = scale_set.upgradevm
+        release = engine.release
+
+        def counted_upgradevm(vmstring):
+            '''count the VMs of a batch as it is submitted'''
+            with self.lock:
+                self.count += len(json.loads(vmstring))
+                self.max = max(self.max, self.count)
+            return upgradevm(vmstring)
+
+        def counted_release(count):
+            '''uncount the VMs of a batch before the engine lets the next one go'''
+            with self.lock:
+                self.count -= count
+            release(count)
+
+        scale_set.upgradevm = counted_upgradevm
+        engine.release = counted_release
+
+
+def open_loaded(open_scale_set, vmssname, **kwargs):
+    '''open a large scale set and load its instance view'''
+    scale_set = open_scale_set(vmss.vmss, vmssname, **kwargs)
+    scale_set.load_vm_instance_view()
+    return scale_set
+
+
+def test_upgrade_never_exceeds_max_vms(emulator, open_scale_set):
+    scale_set = open_loaded(open_scale_set, 'large', capacity=40, placement_groups=4)
+    engine = rollingupgrade.DomainRollingUpgrade(
+        scale_set, scale_set.get_domain_groups(), batchsize=2, max_vms=4, min_poll=0.02,
+        max_poll=0.05)
+    counter = InFlightCounter(scale_set, engine)
+    assert engine.run() is True
+    assert counter.max == 4  # two groups at a time, never three
+    assert counter.count == 0
+    # every VM was upgraded exactly once
+    upgraded = [vmid for operation in scale_set.operations.operations
+                for vmid in operation.as_dict()['instanceIds']]
+    assert sorted(upgraded, key=int) == [str(vmid) for vmid in range(40)]
+
+
+def test_batch_larger_than_max_vms_runs_alone(emulator, open_scale_set):
+    scale_set = open_loaded(open_scale_set, 'wide', capacity=30, placement_groups=2)
+    engine = rollingupgrade.DomainRollingUpgrade(
+        scale_set, scale_set.get_domain_groups(), batchsize=3, max_vms=2, min_poll=0.02,
+        max_poll=0.05)
+    counter = InFlightCounter(scale_set, engine)
+    assert engine.run() is True
+    assert counter.max == 3
+
+
+def test_failed_batch_halts_every_group(emulator, open_scale_set):
+    emulator.fail_actions.add('manualupgrade')
+    scale_set = open_loaded(open_scale_set, 'failing', capacity=20, placement_groups=2)
+    messages = []
+    engine = rollingupgrade.DomainRollingUpgrade(
+        scale_set, scale_set.get_domain_groups(), batchsize=2, max_vms=4, min_poll=0.02,
+        max_poll=0.05, status_fn=messages.append)
+    assert engine.run() is False
+    assert engine.failed_operation.state == 'Failed'
+    assert engine.batch_count <= 2
+    assert messages[-1].startswith('Rolling upgrade halted')
+
+
+def test_batch_error_halts_every_group(emulator, open_scale_set):
+    scale_set = open_loaded(open_scale_set, 'unreachable', capacity=20, placement_groups=2)
+    messages = []
+    engine = rollingupgrade.DomainRollingUpgrade(
+        scale_set, scale_set.get_domain_groups(), batchsize=2, max_vms=4, min_poll=0.02,
+        max_poll=0.05, status_fn=messages.append)
+
+    def unreachable(vmstring):
+        '''a batch which can't be submitted'''
+        raise ConnectionError('connection refused')
+
+    scale_set.upgradevm = unreachable
+    assert engine.run() is False
+    assert isinstance(engine.error, ConnectionError)
+    assert 'Batch failed: connection refused' in messages
+    assert messages[-1].startswith('Rolling upgrade halted')
+
+
+def test_no_pause_after_the_last_batch(emulator, open_scale_set):
+    scale_set = open_loaded(open_scale_set, 'paused', capacity=1)
+    engine = rollingupgrade.DomainRollingUpgrade(
+        scale_set, scale_set.get_domain_groups(), pausetime=30, min_poll=0.02, max_poll=0.05)
+    start_time = time.time()
+    assert engine.run() is True
+    assert time.time() - start_time < 10
+
+
+def set_power(emulator, vmssname, instance_ids, power):
+    '''put emulated VMs in a power state, e.g. 'starting' or 'stopped' '''
+    for vmid in instance_ids:
+        emulator.vmss[('vmssrg', vmssname)].vms[vmid]['power'] = power
+
+
+def test_healthy_batches_double_the_batch_size(emulator, open_scale_set):
+    scale_set = open_loaded(open_scale_set, 'growing', capacity=15)
+    batches = []
+    engine = rollingupgrade.RollingUpgrade(
+        scale_set, [str(vmid) for vmid in range(15)], batchsize=1, min_poll=0.02,
+        max_poll=0.05, health_budget=5, health_poll=0.05, adaptive=True, max_batchsize=4,
+        batch_fn=lambda batch_count, operation: batches.append(
+            (batch_count, len(operation.as_dict()['instanceIds']))))
+    assert engine.run() is True
+    assert batches == [(1, 1), (2, 2), (3, 4), (4, 4), (5, 4)]
+    assert engine.batchsize == 4
+
+
+def test_slow_batch_halves_the_batch_size(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'slow', capacity=4)
+    engine = rollingupgrade.RollingUpgrade(scale_set, ['0', '1', '2', '3'], batchsize=4,
+                                           health_budget=0.1, health_poll=0.05, adaptive=True)
+    set_power(emulator, 'slow', ['1'], 'starting')
+    assert engine.check_health(['0', '1']) == ('slow', [])
+    engine.adapt('slow')
+    assert engine.batchsize == 2
+    engine.adapt('slow')
+    engine.adapt('slow')
+    assert engine.batchsize == 1
+
+
+def test_check_health(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'health', capacity=4)
+    engine = rollingupgrade.RollingUpgrade(scale_set, ['0', '1', '2', '3'],
+                                           health_budget=0.1, health_poll=0.05)
+    assert engine.check_health(['0', '1']) == ('healthy', [])
+    set_power(emulator, 'health', ['1'], 'starting')
+    set_power(emulator, 'health', ['2'], 'stopped')
+    assert engine.check_health(['0', '1', '2']) == ('failed', ['2'])
+    engine.stop()
+    assert engine.check_health(['0', '1', '2']) == ('stopped', [])
+
+
+def test_unhealthy_batch_halts_the_upgrade(emulator, open_scale_set):
+    scale_set = open_loaded(open_scale_set, 'unhealthy', capacity=4)
+    messages = []
+    engine = rollingupgrade.RollingUpgrade(
+        scale_set, ['0', '1', '2', '3'], batchsize=2, min_poll=0.02, max_poll=0.05,
+        health_budget=0.2, health_poll=0.05, status_fn=messages.append)
+    wait_for = engine.wait_for
+
+    def wait_then_fail(operation):
+        '''a VM of the batch fails to come back once its upgrade has finished'''
+        done = wait_for(operation)
+        set_power(emulator, 'unhealthy', ['1'], 'stopped')
+        return done
+
+    engine.wait_for = wait_then_fail
+    assert engine.run() is False
+    assert engine.unhealthy == ['1']
+    assert engine.upgraded == []
+    assert messages[-1].startswith('Rolling upgrade halted')
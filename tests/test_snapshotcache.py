@@ -0,0 +1,93 @@
+'''test_snapshotcache.py - saving, loading and pruning scale set snapshots'''
+import os
+import time
+
+import catalog
+import inventory
+import snapshotcache
+
+KEY = ('sub', 'rg', 'vmss')
+
+
+def make_inventory():
+    '''a small inventory across two placement groups and two zones'''
+    vm_inventory = inventory.VMInventory()
+    for vmid in range(6):
+        vm_inventory.add(str(vmid), 'pg-' + str(vmid % 2), vmid % 5, vmid // 2, vmid % 3,
+                         vmid % 2 + 1)
+    return vm_inventory
+
+
+def test_models_round_trip():
+    cache = snapshotcache.SnapshotCache(':memory:')
+    models = {KEY: {'name': 'vmss', 'sku': {'capacity': 6}},
+              ('sub', 'rg', 'other'): {'name': 'other'}}
+    cache.save_models('sub', models)
+    cache.save_model(('sub2', 'rg', 'third'), {'name': 'third'})
+    loaded = {key: model for key, (model, saved) in cache.load_models().items()}
+    assert loaded == {KEY: models[KEY], ('sub', 'rg', 'other'): {'name': 'other'},
+                      ('sub2', 'rg', 'third'): {'name': 'third'}}
+    # saving a subscription replaces all its models
+    cache.save_models('sub', {KEY: {'name': 'vmss'}})
+    assert sorted(cache.load_models()) == [KEY, ('sub2', 'rg', 'third')]
+
+
+def test_inventory_round_trip():
+    cache = snapshotcache.SnapshotCache(':memory:')
+    vm_inventory = make_inventory()
+    cache.save_inventory(KEY, vm_inventory)
+    loaded, saved = cache.load_inventory(KEY)
+    assert loaded.vm_list() == vm_inventory.vm_list()
+    assert loaded.zone_groups() == vm_inventory.zone_groups()
+    assert saved <= time.time()
+    assert cache.load_inventory(('sub', 'rg', 'unknown')) is None
+
+
+def test_prune_drops_old_entries():
+    cache = snapshotcache.SnapshotCache(':memory:', max_age=60)
+    cache.save_model(KEY, {'name': 'vmss'})
+    cache.save_inventory(KEY, make_inventory())
+    cache.save_model(('sub', 'rg', 'fresh'), {'name': 'fresh'})
+    with cache.db:
+        for table in ('models', 'inventories'):
+            cache.db.execute('UPDATE ' + table + ' SET saved = ? WHERE name = ?',
+                             (time.time() - 120, 'vmss'))
+    cache.prune()
+    assert list(cache.load_models()) == [('sub', 'rg', 'fresh')]
+    assert cache.load_inventory(KEY) is None
+
+
+def test_prune_keeps_the_newest_entries_within_max_bytes(tmp_path):
+    path = str(tmp_path / 'snapshots.db')
+    cache = snapshotcache.SnapshotCache(path, max_bytes=100000, prune_writes=1000)
+    for number in range(20):
+        # random-ish payloads which don't compress away
+        payload = os.urandom(10000).hex()
+        cache.save_model(('sub', 'rg', 'vmss' + str(number)), {'payload': payload})
+        with cache.db:
+            cache.db.execute('UPDATE models SET saved = ? WHERE name = ?',
+                             (time.time() - 20 + number, 'vmss' + str(number)))
+    size_before = os.path.getsize(path)
+    cache.prune()
+    kept = sorted(int(key[2][4:]) for key in cache.load_models())
+    assert kept == list(range(20 - len(kept), 20))
+    assert 0 < len(kept) < 20
+    assert cache.size() <= 100000
+    # the file is vacuumed, not just emptied
+    assert os.path.getsize(path) < size_before
+    cache.close()
+
+
+def test_saves_prune_every_prune_writes(monkeypatch):
+    cache = snapshotcache.SnapshotCache(':memory:', prune_writes=3)
+    prunes = []
+    monkeypatch.setattr(cache, 'prune', lambda: prunes.append(cache.writes))
+    for number in range(7):
+        cache.save_model(('sub', 'rg', 'vmss' + str(number)), {})
+    assert prunes == [3, 6]
+
+
+def test_catalog_without_a_cache_saves_nothing():
+    vmss_catalog = catalog.Catalog([])
+    vmss_catalog.save_inventory(KEY, make_inventory())
+    assert vmss_catalog.load_inventory(KEY) is None
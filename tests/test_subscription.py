@@ -0,0 +1,50 @@
+'''test_subscription.py - caching the scale set list of a subscription'''
+import time
+
+import pytest
+
+import subscription
+
+
+@pytest.fixture
+def sub(emulator, client, monkeypatch):
+    '''a subscription listing the emulator, with two scale sets and a 300 second cache'''
+    monkeypatch.setattr(subscription.subscription, 'acquire_token',
+                        lambda self: ('token', time.time() + 3600))
+    emulator.add_vmss('vmss1')
+    emulator.add_vmss('vmss2')
+    return subscription.subscription('tenant', 'app', 'secret', emulator.sub_id,
+                                     cache_ttl=300, client=client)
+
+
+def test_list_is_reused_within_the_ttl(emulator, sub):
+    requests_before = emulator.request_count
+    assert sub.get_vmss_list() == ['vmss1', 'vmss2']
+    emulator.add_vmss('vmss3')
+    assert sub.get_vmss_list() == ['vmss1', 'vmss2']
+    assert emulator.request_count - requests_before == 1
+
+
+def test_list_is_fetched_again_once_the_ttl_expires(emulator, sub):
+    sub.get_vmss_list()
+    emulator.add_vmss('vmss3')
+    sub.list_time -= 301
+    assert sub.get_vmss_list() == ['vmss1', 'vmss2', 'vmss3']
+    assert sorted(sub.vmssdict) == ['vmss1', 'vmss2', 'vmss3']
+
+
+def test_force_and_invalidate_fetch_the_list_again(emulator, sub):
+    sub.get_vmss_list()
+    emulator.add_vmss('vmss3')
+    assert sub.get_vmss_list(force=True) == ['vmss1', 'vmss2', 'vmss3']
+    emulator.add_vmss('vmss4')
+    sub.invalidate()
+    assert sub.get_vmss_list() == ['vmss1', 'vmss2', 'vmss3', 'vmss4']
+
+
+def test_error_keeps_the_cached_list(emulator, client, sub, monkeypatch):
+    sub.get_vmss_list()
+    monkeypatch.setattr(client, 'list_vmss_sub',
+                        lambda *args: {'error': {'code': 'AuthorizationFailed'}})
+    assert sub.get_vmss_list(force=True) == ['vmss1', 'vmss2']
+    assert sub.status.startswith('KeyError')
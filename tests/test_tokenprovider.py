@@ -0,0 +1,75 @@
+'''test_tokenprovider.py - single-flight token refresh'''
+import threading
+import time
+
+import tokenprovider
+
+
+class CountingAcquirer():
+    '''acquire_fn which counts its calls and can be held until released'''
+
+    def __init__(self, lifetime=3600, hold=False):
+        '''class initialization routine'''
+        self.lifetime = lifetime
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if hold is False:
+            self.release.set()
+
+    def __call__(self):
+        '''return a new token'''
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        return 'token' + str(self.calls), time.time() + self.lifetime
+
+
+def test_first_token_is_acquired_once():
+    acquirer = CountingAcquirer(hold=True)
+    provider = tokenprovider.TokenProvider(acquirer)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(provider.get()))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    acquirer.started.wait(5)
+    time.sleep(0.05)  # let the other threads queue up behind the refresh
+    acquirer.release.set()
+    for thread in threads:
+        thread.join()
+    assert acquirer.calls == 1
+    assert results == ['token1'] * 8
+
+
+def test_refresh_due_keeps_serving_the_valid_token():
+    acquirer = CountingAcquirer(hold=True)
+    provider = tokenprovider.TokenProvider(acquirer, refresh_margin=300)
+    provider.current = ('old', time.time() + 100)  # valid, but inside the refresh margin
+    refreshed = []
+    refresher = threading.Thread(target=lambda: refreshed.append(provider.get()))
+    refresher.start()
+    acquirer.started.wait(5)
+    # a refresh is in progress, other callers don't wait for it
+    assert provider.get() == 'old'
+    acquirer.release.set()
+    refresher.join()
+    assert refreshed == ['token1']
+    assert provider.get() == 'token1'
+    assert acquirer.calls == 1
+
+
+def test_rejected_token_is_renewed_once():
+    acquirer = CountingAcquirer()
+    provider = tokenprovider.TokenProvider(acquirer)
+    rejected = provider.get()
+    assert provider.renew(rejected) == 'token2'
+    assert provider.renew(rejected) == 'token2'
+    assert acquirer.calls == 2
+
+
+def test_expiry_is_read_from_the_token():
+    # header.payload.signature with payload {"exp": 1700000000}
+    token = 'e30.eyJleHAiOiAxNzAwMDAwMDAwfQ.sig'
+    assert tokenprovider.get_token_expiry(token) == 1700000000
+    assert tokenprovider.get_token_expiry('opaque') > time.time()
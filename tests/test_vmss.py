@@ -0,0 +1,95 @@
+'''test_vmss.py - loading the instance view of a scale set a page at a time'''
+import json
+import threading
+import time
+
+import pytest
+
+import vmss
+
+
+def test_instance_view_is_loaded_page_by_page(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'paged', capacity=35)
+    progress = []
+    requests_before = emulator.request_count
+    pages = list(scale_set.iter_vm_instance_view(
+        progress=lambda page_count, vm_count: progress.append((page_count, vm_count))))
+    assert [len(page) for page in pages] == [10, 10, 10, 5]
+    assert progress == [(1, 10), (2, 20), (3, 30), (4, 35)]
+    assert emulator.request_count - requests_before == 4
+    assert len(scale_set.vm_instance_view['value']) == 35
+    assert 'nextLink' not in scale_set.vm_instance_view
+    assert [vm[1] for vm in scale_set.inventory.vm_list()] == [str(vmid) for vmid in range(35)]
+    assert scale_set.missing_instance_view == []
+
+
+@pytest.mark.parametrize('error', [ConnectionError('connection reset'),
+                                   json.JSONDecodeError('Expecting value', '', 0)])
+def test_producer_error_reaches_the_caller(emulator, client, open_scale_set, monkeypatch,
+                                           error):
+    scale_set = open_scale_set(vmss.vmss, 'broken', capacity=25)
+    scale_set.load_vm_instance_view()
+    loaded = scale_set.inventory
+    get_page = client.list_vmss_vm_instance_view_pg
+
+    def failing_get_page(access_token, sub_id, rgname, vmssname, link=None):
+        '''fail on the second page'''
+        if link is not None:
+            raise error
+        return get_page(access_token, sub_id, rgname, vmssname, link)
+
+    monkeypatch.setattr(client, 'list_vmss_vm_instance_view_pg', failing_get_page)
+    pages = scale_set.iter_vm_instance_view()
+    assert len(next(pages)) == 10
+    with pytest.raises(type(error)):
+        next(pages)
+    # the inventory of the last complete load is kept, and a new load can start
+    assert scale_set.inventory is loaded
+    monkeypatch.setattr(client, 'list_vmss_vm_instance_view_pg', get_page)
+    assert len(scale_set.load_vm_instance_view()['value']) == 25
+
+
+def test_error_page_ends_the_load(emulator, client, open_scale_set, monkeypatch):
+    scale_set = open_scale_set(vmss.vmss, 'missing', capacity=5)
+    monkeypatch.setattr(client, 'list_vmss_vm_instance_view_pg',
+                        lambda *args: {'error': {'code': 'ResourceNotFound'}})
+    assert list(scale_set.iter_vm_instance_view()) == []
+    assert scale_set.status.startswith('Error getting instance view')
+
+
+def test_closing_early_stops_the_producer(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'abandoned', capacity=200)
+    requests_before = emulator.request_count
+    pages = scale_set.iter_vm_instance_view(prefetch=1)
+    next(pages)
+    pages.close()
+    time.sleep(0.2)
+    # the first page, the one buffered and at most one in flight when it was closed
+    assert emulator.request_count - requests_before <= 3
+    assert scale_set.inventory.vm_list() == []
+
+
+def test_abandoned_load_blocks_nobody(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'dropped', capacity=30)
+    pages = scale_set.iter_vm_instance_view()
+    next(pages)  # left suspended, e.g. by a consumer which raised
+    loader = threading.Thread(target=scale_set.load_vm_instance_view)
+    loader.start()
+    loader.join(5)
+    assert not loader.is_alive()
+    assert len(scale_set.inventory) == 30
+    pages.close()
+
+
+def test_concurrent_loads_do_not_mix_their_pages(emulator, open_scale_set):
+    scale_set = open_scale_set(vmss.vmss, 'shared', capacity=95, placement_groups=3)
+    loaders = [threading.Thread(target=scale_set.load_vm_instance_view) for _ in range(4)]
+    for loader in loaders:
+        loader.start()
+    for loader in loaders:
+        loader.join(10)
+    assert not any(loader.is_alive() for loader in loaders)
+    instance_ids = [vm['instanceId'] for vm in scale_set.vm_instance_view['value']]
+    assert sorted(instance_ids, key=int) == [str(vmid) for vmid in range(95)]
+    assert len(scale_set.inventory) == 95
+    assert sorted(scale_set.get_domain_groups()) == ['pg-0', 'pg-1', 'pg-2']
@@ -0,0 +1,76 @@
+'''test_vmsscli.py - command results and errors are printed as JSON'''
+import json
+import time
+
+import pytest
+import requests
+
+import armclient
+import subscription
+import vmsscli
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    '''write a vmssconfig.json, return its path'''
+    def write(config_data):
+        '''write config_data, a dict or raw text'''
+        path = tmp_path / 'vmssconfig.json'
+        path.write_text(config_data if isinstance(config_data, str) else
+                        json.dumps(config_data))
+        return str(path)
+
+    return write
+
+
+def run(capsys, *argv):
+    '''run a command line, return its exit code and JSON output'''
+    exit_code = vmsscli.run(vmsscli.get_parser().parse_args(argv))
+    return exit_code, json.loads(capsys.readouterr().out)
+
+
+def test_list_prints_the_scale_sets(emulator, client, config_file, capsys, monkeypatch):
+    monkeypatch.setattr(subscription.subscription, 'acquire_token',
+                        lambda self: ('token', time.time() + 3600))
+    monkeypatch.setattr(armclient, 'default_client', client)
+    emulator.add_vmss('vmss1', capacity=3)
+    path = config_file({'tenantId': 'tenant', 'appId': 'app', 'appSecret': 'secret',
+                        'subscriptionId': emulator.sub_id})
+    exit_code, result = run(capsys, '--config', path, 'list')
+    assert exit_code == 0
+    assert [(vm['name'], vm['capacity']) for vm in result] == [('vmss1', 3)]
+
+
+@pytest.mark.parametrize('config_data, message', [
+    (None, 'Expecting '),
+    ('{"tenantId": ', 'is not valid JSON'),
+    ('["sub"]', 'should hold a JSON object'),
+    ({'tenantId': 'tenant', 'subscriptions': [{'name': 'no id'}]},
+     'has an invalid subscription entry')])
+def test_bad_config_is_reported(config_file, tmp_path, capsys, config_data, message):
+    path = str(tmp_path / 'missing.json') if config_data is None else config_file(config_data)
+    exit_code, result = run(capsys, '--config', path, 'list')
+    assert exit_code == 1
+    assert message in result['error']
+
+
+@pytest.mark.parametrize('status_code', [None, 403, 500])
+def test_request_errors_are_reported(config_file, capsys, monkeypatch, status_code):
+    def failing_list(vmss_catalog, args):
+        '''a connection error, or an HTTP error raised for a response'''
+        if status_code is None:
+            raise requests.ConnectionError('connection refused')
+        response = requests.Response()
+        response.status_code = status_code
+        response.url = 'https://management.azure.com/subscriptions/sub'
+        response.raise_for_status()
+
+    monkeypatch.setattr(vmsscli, 'cmd_list', failing_list)
+    path = config_file({'tenantId': 'tenant', 'appId': 'app', 'appSecret': 'secret',
+                        'subscriptionId': 'sub'})
+    exit_code, result = run(capsys, '--config', path, 'list')
+    assert exit_code == 1
+    if status_code is None:
+        assert result['error'] == 'connection refused'
+    else:
+        assert result['error'].startswith(str(status_code) + ' ')
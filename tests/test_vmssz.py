@@ -0,0 +1,91 @@
+'''test_vmssz.py - joining the model and instance views of a zonal scale set'''
+import vmssz
+
+
+def test_vm_details_are_joined_by_instance_id(emulator, open_scale_set):
+    scale_set = open_scale_set(vmssz.VMSSZ, 'zonal', capacity=24, zones=['1', '2', '3'])
+    scale_set.init_vm_details()
+    assert len(scale_set.inventory) == 24
+    assert scale_set.missing_instance_view == []
+    assert scale_set.missing_model_view == []
+    zone_groups = scale_set.get_domain_groups()
+    assert sorted(zone_groups) == [1, 2, 3]
+    assert sum(len(vms) for fd_dict in zone_groups.values()
+               for vms in fd_dict.values()) == 24
+
+
+def test_unmatched_vms_are_listed_not_plotted(emulator, client, open_scale_set,
+                                              monkeypatch):
+    scale_set = open_scale_set(vmssz.VMSSZ, 'scaling', capacity=12, zones=['1', '2'])
+    list_vms = client.list_vmss_vms
+    list_instance_views = client.list_vmss_vm_instance_view
+
+    def changed_vms(*args):
+        '''VM 0 was deleted and VM new added after the instance views were listed'''
+        model_view = list_vms(*args)
+        model_view['value'] = [vm for vm in model_view['value'] if vm['instanceId'] != '0']
+        model_view['value'].append({'instanceId': 'new', 'zones': ['1'], 'properties': {}})
+        return model_view
+
+    def unplaced_instance_views(*args):
+        '''VM 1 doesn't have a fault domain yet'''
+        instance_views = list_instance_views(*args)
+        for instance in instance_views['value']:
+            if instance['instanceId'] == '1':
+                del instance['properties']['instanceView']['platformFaultDomain']
+        return instance_views
+
+    monkeypatch.setattr(client, 'list_vmss_vms', changed_vms)
+    monkeypatch.setattr(client, 'list_vmss_vm_instance_view', unplaced_instance_views)
+    scale_set.init_vm_details()
+    assert sorted(scale_set.missing_instance_view) == ['1', 'new']
+    assert scale_set.missing_model_view == ['0']
+    assert len(scale_set.inventory) == 10
+
+
+def test_error_body_keeps_the_previous_details(emulator, client, open_scale_set,
+                                               monkeypatch):
+    scale_set = open_scale_set(vmssz.VMSSZ, 'throttled', capacity=6, zones=['1'])
+    scale_set.init_vm_details()
+    loaded = scale_set.inventory
+    monkeypatch.setattr(client, 'list_vmss_vms',
+                        lambda *args: {'error': {'code': 'TooManyRequests'}})
+    scale_set.init_vm_details()
+    assert scale_set.status.startswith('Error getting VM details')
+    assert scale_set.inventory is loaded
+
+
+def test_details_are_only_fetched_again_when_stale(emulator, open_scale_set):
+    scale_set = open_scale_set(vmssz.VMSSZ, 'steady', capacity=6, zones=['1', '2'])
+    assert scale_set.refresh_model() is True  # never fetched
+    requests_before = emulator.request_count
+    assert scale_set.refresh_model() is False
+    assert emulator.request_count - requests_before == 1  # only the model GET
+    # the details interval has gone by
+    scale_set.details_time -= scale_set.details_interval
+    assert scale_set.refresh_model() is True
+    assert scale_set.refresh_model() is False
+
+
+def test_model_change_makes_the_details_stale(emulator, open_scale_set):
+    scale_set = open_scale_set(vmssz.VMSSZ, 'tagged', capacity=6, zones=['1', '2'])
+    scale_set.refresh_model()
+    emulator.scale_sets[('vmssrg', 'tagged')]['tags'] = {'owner': 'someone else'}
+    assert scale_set.refresh_model() is True
+    assert scale_set.model_changed is True
+    assert scale_set.refresh_model() is False
+
+
+def test_operation_makes_the_details_stale(emulator, open_scale_set):
+    scale_set = open_scale_set(vmssz.VMSSZ, 'restarted', capacity=6, zones=['1', '2'])
+    scale_set.refresh_model()
+    operation = scale_set.restart()
+    assert scale_set.vm_details_stale() is True
+    assert scale_set.refresh_model() is True
+    operation.poll_until_done(scale_set.access_token, min_poll=0.02, max_poll=0.05)
+    # finished since the details were fetched
+    assert scale_set.vm_details_stale() is True
+    assert scale_set.refresh_model() is True
+    assert scale_set.refresh_model() is False
+    scale_set.provisioningState = 'Updating'
+    assert scale_set.vm_details_stale() is True
@@ -0,0 +1,88 @@
+'''tokenprovider.py - expiry-aware access token shared by a subscription and its scale sets'''
+import base64
+import json
+import threading
+import time
+
+import metrics
+
+
+def get_token_expiry(access_token, default_lifetime=3600):
+    '''read the expiry time from the exp claim of a JWT access token
+       - falls back to default_lifetime seconds from now if the token can't be decoded
+    '''
+    try:
+        payload = access_token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return time.time() + default_lifetime
+
+
+class TokenProvider():
+    '''hands out a current access token, refreshing it ahead of expiry
+       - acquire_fn() returns (token, expires_on), expires_on in epoch seconds or None to read
+         it from the token itself
+       - refreshes are single-flight: one caller refreshes while the others keep using the
+         current token if it is still valid, or wait for the new one if it is not
+       - pass a TokenProvider wherever ArmClient takes an access_token and a 401 response
+         is answered by one refresh and retry
+    '''
+
+    def __init__(self, acquire_fn, refresh_margin=300):
+        '''class initialization routine
+           - refresh_margin is how many seconds before expiry to start refreshing
+        '''
+        self.acquire_fn = acquire_fn
+        self.refresh_margin = refresh_margin
+        self.current = (None, 0)  # (token, expires_on), replaced as one tuple
+        self.lock = threading.Lock()
+
+    def get(self):
+        '''return a valid token, acquiring the first one or refreshing it if it is due'''
+        token, expires_on = self.current
+        now = time.time()
+        if token is not None and now < expires_on - self.refresh_margin:
+            return token
+        if token is not None and now < expires_on:
+            # due for refresh but still valid - don't queue up behind a refresh in progress
+            if not self.lock.acquire(blocking=False):
+                return token
+        else:
+            self.lock.acquire()
+        try:
+            if self.current[0] is token:  # nobody else refreshed it meanwhile
+                self.acquire()
+            return self.current[0]
+        finally:
+            self.lock.release()
+
+    def renew(self, rejected_token):
+        '''return a new token after rejected_token got a 401
+           - only the first caller to report a rejected token refreshes it
+        '''
+        with self.lock:
+            if self.current[0] == rejected_token or self.current[0] is None:
+                self.acquire()
+            return self.current[0]
+
+    def refresh(self):
+        '''acquire a new token now, whatever the expiry of the current one'''
+        with self.lock:
+            self.acquire()
+            return self.current[0]
+
+    def acquire(self):
+        '''get a new token from acquire_fn - the caller holds the lock'''
+        with metrics.span('token_acquire'):
+            token, expires_on = self.acquire_fn()
+        if expires_on is None:
+            expires_on = get_token_expiry(token)
+        self.current = (token, expires_on)
+
+    def expires_in(self):
+        '''seconds until the current token expires, 0 if there is no token yet'''
+        token, expires_on = self.current
+        if token is None:
+            return 0
+        return max(0, expires_on - time.time())
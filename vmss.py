@@ -1,19 +1,30 @@
 '''vmss.py - class of basic Azure VM scale set operations'''
 import json
+import queue
+import threading
 
-import azurerm
+import armclient
+import inventory
+import metrics
+import operations
+import polling
 
 
 class vmss():
     '''vmss class - encapsulates the model and status of a VM scale set'''
 
-    def __init__(self, vmssname, vmssmodel, subscription_id, access_token):
-        '''class initializtion routine - set basic VMSS properties'''
+    def __init__(self, vmssname, vmssmodel, subscription_id, access_token, client=None):
+        '''class initializtion routine - set basic VMSS properties
+           - access_token is a token string, or the subscription's TokenProvider to keep
+             using a current token
+           - client is the ArmClient to make REST calls with, default the shared one
+        '''
         self.name = vmssname
         vmssid = vmssmodel['id']
         self.rgname = vmssid[vmssid.index('resourceGroups/') + 15:vmssid.index('/providers')]
         self.sub_id = subscription_id
         self.access_token = access_token
+        self.client = client or armclient.get_client()
 
         self.model = vmssmodel
         self.adminuser = \
@@ -25,7 +36,8 @@ class vmss():
         self.overprovision = vmssmodel['properties']['overprovision']
         self.vm_instance_view = None
         self.vm_model_view = None # for now only initialized in group_by_zone()
-        self.pg_list = []
+        self.inventory = inventory.VMInventory()
+        self.missing_instance_view = []  # VMs without a UD/FD yet, e.g. while scaling out
         if 'zones' in vmssmodel:
             self.zonal = True
         else:
@@ -69,9 +81,36 @@ class vmss():
         self.provisioningState = vmssmodel['properties']['provisioningState']
         self.status = self.provisioningState
 
+        # conditional read state for refresh_model()
+        self.model_etag = None
+        self.model_fingerprint = None
+        self.model_changed = False
+        self.retry_after = None
+
+        # long running operations started by this object - each action method returns the
+        # Operation it started
+        self.operations = operations.OperationTracker(self.client)
+        # held while a page of the instance view is published, see iter_vm_instance_view()
+        self.view_lock = threading.Lock()
+
     def refresh_model(self):
-        '''update the model, useful to see if provisioning is complete'''
-        vmssmodel = azurerm.get_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        '''update the model, useful to see if provisioning is complete
+           - the model is only re-parsed when its ETag or payload fingerprint has changed
+        '''
+        endpoint = self.client.vmss_url(self.sub_id, self.rgname, self.name)
+        response, self.model_changed, self.model_fingerprint = polling.conditional_get(
+            self.client, endpoint, self.access_token, self.model_etag, self.model_fingerprint)
+        self.retry_after = polling.get_retry_after(response.headers)
+        if response.status_code >= 400:
+            if response.status_code != 429:  # throttled polls are retried after retry_after
+                self.status = response.text
+            return
+        if self.model_changed is False:
+            # model unchanged, skip re-parsing it
+            self.status = self.provisioningState
+            return
+        self.model_etag = response.headers.get('ETag')
+        vmssmodel = response.json()
         self.model = vmssmodel
         self.capacity = vmssmodel['sku']['capacity']
         self.vmsize = vmssmodel['sku']['name']
@@ -82,12 +121,10 @@ class vmss():
         self.provisioningState = vmssmodel['properties']['provisioningState']
         self.status = self.provisioningState
 
-    def update_token(self, access_token):
-        '''update the token property'''
-        self.access_token = access_token
-
     def update_model(self, newsku, newversion, newvmsize):
-        '''update the VMSS model with any updated properties'''
+        '''update the VMSS model with any updated properties
+           - returns the Operation started, or None if the model is unchanged
+        '''
         changes = 0
         if self.sku != newsku:
             if self.image_type == 'platform':  # sku not relevant for custom image
@@ -118,153 +155,259 @@ class vmss():
             self.vmsize = newvmsize
         if changes == 0:
             self.status = 'VMSS model is unchanged, skipping update'
+            return None
         else:
             # put the vmss model
-            updateresult = azurerm.update_vmss(self.access_token, self.sub_id, self.rgname,
-                                               self.name, json.dumps(self.model))
+            updateresult = self.client.update_vmss(self.access_token, self.sub_id, self.rgname,
+                                                   self.name, json.dumps(self.model))
             self.status = updateresult
+            return self.operations.start('update_model', updateresult)
 
     def scale(self, capacity):
         '''set the VMSS to a new capacity'''
         self.model['sku']['capacity'] = capacity
-        scaleoutput = azurerm.scale_vmss(self.access_token, self.sub_id, self.rgname, self.name,
-                                         capacity)
+        scaleoutput = self.client.scale_vmss(self.access_token, self.sub_id, self.rgname,
+                                             self.name, capacity)
         self.status = scaleoutput
+        return self.operations.start('scale', scaleoutput)
 
     def poweron(self):
         '''power on all the VMs in the scale set'''
-        result = azurerm.start_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'start')
         self.status = result
+        return self.operations.start('poweron', result)
 
     def restart(self):
         '''restart all the VMs in the scale set'''
-        result = azurerm.restart_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'restart')
         self.status = result
+        return self.operations.start('restart', result)
 
     def poweroff(self):
         '''power off all the VMs in the scale set'''
-        result = azurerm.poweroff_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'powerOff')
         self.status = result
+        return self.operations.start('poweroff', result)
 
     def dealloc(self):
         '''stop deallocate all the VMs in the scale set'''
-        result = azurerm.stopdealloc_vmss(
-            self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'deallocate')
         self.status = result
+        return self.operations.start('dealloc', result)
 
     def init_vm_instance_view(self):
         '''get the VMSS instance view and set the class property'''
         # get an instance view list in order to build a heatmap
         self.vm_instance_view = \
-            azurerm.list_vmss_vm_instance_view(self.access_token, self.sub_id, self.rgname,
-                                               self.name)
+            self.client.list_vmss_vm_instance_view(self.access_token, self.sub_id, self.rgname,
+                                                   self.name)
 
     def grow_vm_instance_view(self, link=None):
         '''grow the VMSS instance view by one page'''
         # get an instance view list in order to build a heatmap
         if link is None:
             self.vm_instance_view = \
-                azurerm.list_vmss_vm_instance_view_pg(self.access_token, self.sub_id, self.rgname,
-                                                      self.name)
+                self.client.list_vmss_vm_instance_view_pg(self.access_token, self.sub_id,
+                                                          self.rgname, self.name)
         else:
-            instance_page = azurerm.list_vmss_vm_instance_view_pg(self.access_token, self.sub_id,
-                                                                  self.rgname, self.name, link)
+            instance_page = self.client.list_vmss_vm_instance_view_pg(self.access_token,
+                                                                      self.sub_id, self.rgname,
+                                                                      self.name, link)
             if 'nextLink' in instance_page:
                 self.vm_instance_view['nextLink'] = instance_page['nextLink']
             else:
                 del self.vm_instance_view['nextLink']
             self.vm_instance_view['value'].extend(instance_page['value'])
 
+    def iter_vm_instance_view(self, prefetch=2, progress=None):
+        '''get the VMSS instance view one page at a time, yielding the VMs of each page as a
+           list of [group_id, instanceId, fd, ud, power] entries as it arrives
+           - a background thread walks the nextLink chain and keeps up to prefetch pages
+             buffered ahead of the caller, so network round trips overlap with drawing
+           - pages are appended to self.vm_instance_view['value'] in nextLink order
+           - each page is added to a new VM inventory as it arrives, which replaces
+             self.inventory once the last page is in
+           - progress(page_count, vm_count) is called on the caller's thread for each page
+           - each load builds its own view and inventory, publishing a page at a time under
+             self.view_lock, so concurrent loads don't mix their pages
+           - close() the generator to stop early, which also stops the background thread
+        '''
+        page_queue = queue.Queue(maxsize=max(1, prefetch))
+        stop_event = threading.Event()
+
+        def put_page(item):
+            '''queue an item for the consumer unless it has gone away'''
+            while not stop_event.is_set():
+                try:
+                    page_queue.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def fetch_pages():
+            '''producer thread - walk the nextLink chain'''
+            link = None
+            try:
+                while not stop_event.is_set():
+                    page = self.client.list_vmss_vm_instance_view_pg(self.access_token,
+                                                                     self.sub_id, self.rgname,
+                                                                     self.name, link)
+                    if not put_page(('page', page)):
+                        return
+                    if 'nextLink' not in page:
+                        break
+                    link = page['nextLink']
+            except Exception as err:  # hand the error to the consumer thread
+                put_page(('error', err))
+                return
+            put_page(('done', None))
+
+        vm_instance_view = {'value': []}
+        missing_instance_view = []
+        vm_inventory = inventory.VMInventory()
+        fetch_thread = threading.Thread(target=fetch_pages, args=())
+        fetch_thread.daemon = True
+        fetch_thread.start()
+        page_count = 0
+        try:
+            while True:
+                kind, page = page_queue.get()
+                if kind == 'done':
+                    with self.view_lock:
+                        self.inventory = vm_inventory
+                    break
+                if kind == 'error':
+                    raise page
+                if 'value' not in page:
+                    self.status = 'Error getting instance view: ' + json.dumps(page)
+                    break
+                page_count += 1
+                # publish the page under the lock, but never hold it across the yield
+                with self.view_lock:
+                    vm_instance_view['value'].extend(page['value'])
+                    if 'nextLink' in page:
+                        vm_instance_view['nextLink'] = page['nextLink']
+                    else:
+                        vm_instance_view.pop('nextLink', None)
+                    self.vm_instance_view = vm_instance_view
+                    self.missing_instance_view = missing_instance_view
+                    vm_list = self.add_vms(vm_inventory, page['value'])
+                if progress is not None:
+                    progress(page_count, len(vm_instance_view['value']))
+                yield vm_list
+        finally:
+            # the consumer has finished or given up, stop the producer thread
+            stop_event.set()
+
+    def load_vm_instance_view(self, prefetch=2, progress=None):
+        '''get the complete VMSS instance view using the prefetching page fetcher'''
+        for _ in self.iter_vm_instance_view(prefetch, progress):
+            pass
+        return self.vm_instance_view
+
     def reimagevm(self, vmstring):
         '''reaimge individual VMs or groups of VMs in a scale set'''
-        result = azurerm.reimage_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                          vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'reimage', vmstring)
         self.status = result
+        return self.operations.start('reimagevm', result, vmstring)
 
     def upgradevm(self, vmstring):
         '''upgrade individual VMs or groups of VMs in a scale set'''
-        result = azurerm.upgrade_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                          vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'manualupgrade', vmstring)
         self.status = result
+        return self.operations.start('upgradevm', result, vmstring)
 
     def deletevm(self, vmstring):
         '''delete individual VMs or groups of VMs in a scale set'''
-        result = azurerm.delete_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                         vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'delete', vmstring)
         self.status = result
+        return self.operations.start('deletevm', result, vmstring)
 
     def startvm(self, vmstring):
         '''start individual VMs or groups of VMs in a scale set'''
-        result = azurerm.start_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                        vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'start', vmstring)
         self.status = result
+        return self.operations.start('startvm', result, vmstring)
 
     def restartvm(self, vmstring):
         '''restart individual VMs or groups of VMs in a scale set'''
-        result = azurerm.restart_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                          vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'restart', vmstring)
         self.status = result
+        return self.operations.start('restartvm', result, vmstring)
 
     def deallocvm(self, vmstring):
         '''dealloc individual VMs or groups of VMs in a scale set'''
-        result = azurerm.stopdealloc_vmss_vms(self.access_token, self.sub_id, self.rgname,
-                                              self.name, vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'deallocate', vmstring)
         self.status = result
+        return self.operations.start('deallocvm', result, vmstring)
 
     def poweroffvm(self, vmstring):
         '''power off individual VMs or groups of VMs in a scale set'''
-        result = azurerm.poweroff_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                           vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'powerOff', vmstring)
         self.status = result
+        return self.operations.start('poweroffvm', result, vmstring)
 
-    def get_power_state(self, statuses):
-        '''get power state from a list of VM isntance statuses'''
-        for status in statuses:
-            if status['code'].startswith('Power'):
-                return status['code'][11:]
+    def get_vm_power_states(self, instance_ids):
+        '''get the current power state of a list of VMs as an {instance id: power state} dict'''
+        return inventory.get_vm_power_states(self.client, self.access_token, self.sub_id,
+                                             self.rgname, self.name, instance_ids)
 
-    def set_domain_lists(self):
-        '''create lists of VMs in the scale set by fault domain, update domain, and all-up'''
-        # sort the list of VM instance views by group id
-        if self.singlePlacementGroup is False:
-            self.vm_instance_view['value'] = \
-                sorted(self.vm_instance_view['value'],
-                       key=lambda k: k['properties']['instanceView']['placementGroupId'])
-            last_group_id = \
-                self.vm_instance_view['value'][0]['properties']['instanceView']['placementGroupId']
-        else:
-            last_group_id = "single group"
-        # now create a list of group id + FD/UD list objects
-        # each time group id changes append a new value to the list
-        fd_dict = {f: [] for f in range(5)}
-        ud_dict = {u: [] for u in range(5)}
+    def get_vm_list(self, instances):
+        '''get a list of [group_id, instanceId, fd, ud, power] entries from a list of VM
+           instance views, e.g. a newly fetched instance view page
+           - VMs without a UD/FD yet are left out and listed in self.missing_instance_view
+        '''
         vm_list = []
-        self.pg_list = []
-        for instance in self.vm_instance_view['value']:
+        for instance in instances:
             try:
-                # when group Id changes, load fd/ud/vm dictionaries into the placement group list
-                # may need to change this to copy by value
-                # debug: print(json.dumps(instance))
                 if self.singlePlacementGroup is False:
-                    if instance['properties']['instanceView']['placementGroupId'] != last_group_id:
-                        self.pg_list.append(
-                            {'guid': last_group_id, 'fd_dict': fd_dict, 'ud_dict': ud_dict,
-                             'vm_list': vm_list})
-                        fd_dict = {f: [] for f in range(5)}
-                        ud_dict = {u: [] for u in range(5)}
-                        vm_list = []
-                        last_group_id = instance['properties']['instanceView']['placementGroupId']
-                instanceId = instance['instanceId']
+                    group_id = instance['properties']['instanceView']['placementGroupId']
+                else:
+                    group_id = "single group"
                 ud = instance['properties']['instanceView']['platformUpdateDomain']
                 fd = instance['properties']['instanceView']['platformFaultDomain']
-                power_state = self.get_power_state(
+                power = inventory.decode_power_state(
                     instance['properties']['instanceView']['statuses'])
-                ud_dict[ud].append([instanceId, power_state])
-                fd_dict[fd].append([instanceId, power_state])
-                vm_list.append([instanceId, fd, ud, power_state])
+                vm_list.append([group_id, instance['instanceId'], fd, ud, power])
             except KeyError:
-                print('KeyError - UD/FD may not be assigned yet. Instance view: '\
-                    + json.dumps(instance))
-                break
-        self.pg_list.append(
-            {'guid': last_group_id, 'fd_dict': fd_dict, 'ud_dict': ud_dict, 'vm_list': vm_list})
+                # skip this VM rather than dropping the rest of the page
+                self.missing_instance_view.append(instance.get('instanceId'))
+        return vm_list
+
+    def add_vms(self, vm_inventory, instances):
+        '''add a list of VM instance views, e.g. a new page, to an inventory
+           - VMs are bucketed by placement group id as they are added, new groups go after
+             the ones already seen, so no sorting is needed
+           - returns the [group_id, instanceId, fd, ud, power] entries which were added
+        '''
+        with metrics.span('process', step='add_vms'):
+            vm_list = self.get_vm_list(instances)
+            for group_id, instance_id, fd, ud, power in vm_list:
+                vm_inventory.add(instance_id, group_id, fd, ud, power)
+        return vm_list
+
+    def set_domain_lists(self):
+        '''rebuild the VM inventory from self.vm_instance_view in a single pass
+           - VMs are indexed by placement group, fault domain and update domain
+        '''
+        with metrics.span('process', step='set_domain_lists'):
+            vm_inventory = inventory.VMInventory()
+            self.missing_instance_view = []
+            self.add_vms(vm_inventory, self.vm_instance_view['value'])
+        self.inventory = vm_inventory
+
+    def get_domain_groups(self):
+        '''map each placement group id to a {fd: [instance ids]} dict'''
+        return self.inventory.domain_groups()
@@ -0,0 +1,374 @@
+'''vmsscli.py - command line interface to VM scale set operations, no GUI required
+   - run with: python -m vmsscli <command> ...
+   - results are written to stdout as JSON, progress messages to stderr
+'''
+import argparse
+import json
+import sys
+
+import bulkops
+import catalog
+import inventory
+import metrics
+import rollingupgrade as ru
+import vmss
+import vmssz
+
+# scale set wide actions -> vmss method
+VMSS_ACTIONS = {'start': 'poweron', 'restart': 'restart', 'poweroff': 'poweroff',
+                'dealloc': 'dealloc'}
+# actions on a list of VMs -> vmss method
+VM_ACTIONS = {'reimage': 'reimagevm', 'upgrade': 'upgradevm', 'delete': 'deletevm',
+              'start': 'startvm', 'restart': 'restartvm', 'dealloc': 'deallocvm',
+              'poweroff': 'poweroffvm'}
+# actions allowed on a whole fault domain or zone
+DOMAIN_ACTIONS = ('reimage', 'upgrade', 'start', 'poweroff')
+
+
+class CliError(Exception):
+    '''an error to report as JSON with a non-zero exit code'''
+    pass
+
+
+def load_catalog(config_file):
+    '''set up the subscriptions in a vmssconfig.json file'''
+    try:
+        with open(config_file) as config:
+            config_data = json.load(config)
+    except FileNotFoundError:
+        raise CliError('Expecting ' + config_file + ' - see vmssconfig.json.tmpl')
+    except ValueError as error:
+        raise CliError(config_file + ' is not valid JSON: ' + str(error))
+    if not isinstance(config_data, dict):
+        raise CliError(config_file + ' should hold a JSON object - see vmssconfig.json.tmpl')
+    try:
+        return catalog.Catalog(catalog.load_subscriptions(config_data))
+    except (KeyError, TypeError, AttributeError) as error:
+        raise CliError(config_file + ' has an invalid subscription entry: ' + repr(error))
+
+
+def list_catalog(vmss_catalog, sub_id=None):
+    '''list the subscriptions, or one of them, reporting listing errors on stderr'''
+    if sub_id is not None and sub_id not in vmss_catalog.subscriptions:
+        raise CliError('Subscription ' + sub_id + ' is not in the config')
+    errors = vmss_catalog.refresh(sub_ids=None if sub_id is None else [sub_id])
+    for error_sub_id, error in errors.items():
+        print('Error listing subscription ' + error_sub_id + ': ' + error, file=sys.stderr)
+    if len(errors) == len(vmss_catalog.subscriptions) or sub_id in errors:
+        raise CliError('Could not list VM scale sets')
+
+
+def open_scale_set(vmss_catalog, args, zones=None):
+    '''create a vmss object, or a VMSSZ object for a zonal scale set
+       - args.subscription and args.resource_group pick between scale sets of the same name
+       - zones=None picks the class from the scale set model
+    '''
+    list_catalog(vmss_catalog, args.subscription)
+    keys = vmss_catalog.find(args.vmss, args.subscription, args.resource_group)
+    if len(keys) == 0:
+        raise CliError('Scale set ' + args.vmss + ' not found')
+    if len(keys) > 1:
+        raise CliError('Scale set name ' + args.vmss + ' is used in ' +
+                       ', '.join(key[0] + '/' + key[1] for key in keys) +
+                       ' - pick one with --subscription and --resource-group')
+    if zones is None:
+        zones = 'zones' in vmss_catalog.models[keys[0]]
+    return vmss_catalog.open(keys[0], vmssz.VMSSZ if zones else vmss.vmss)
+
+
+def load_inventory(scale_set):
+    '''fetch the VM details of a scale set into its inventory'''
+    if isinstance(scale_set, vmssz.VMSSZ):
+        scale_set.init_vm_details()
+    else:
+        scale_set.load_vm_instance_view()
+    return scale_set.inventory
+
+
+def scale_set_summary(scale_set):
+    '''the main properties of a scale set as a dict'''
+    return {'name': scale_set.name, 'resourceGroup': scale_set.rgname,
+            'location': scale_set.location, 'capacity': scale_set.capacity,
+            'vmSize': scale_set.vmsize, 'offer': scale_set.offer, 'sku': scale_set.sku,
+            'version': scale_set.version, 'upgradePolicy': scale_set.upgradepolicy,
+            'overprovision': scale_set.overprovision,
+            'singlePlacementGroup': scale_set.singlePlacementGroup,
+            'zonal': scale_set.zonal, 'provisioningState': scale_set.provisioningState}
+
+
+def inventory_records(vm_inventory):
+    '''the VMs of an inventory as a list of dicts'''
+    return [{'instanceId': vm_inventory.instance_ids[row],
+             'placementGroup': vm_inventory.groups[vm_inventory.pg[row]],
+             'fd': vm_inventory.fd[row], 'ud': vm_inventory.ud[row],
+             'zone': vm_inventory.zone[row],
+             'powerState': inventory.POWER_STATES[vm_inventory.power[row]]}
+            for row in range(len(vm_inventory))]
+
+
+def finish_operation(scale_set, operation, wait):
+    '''optionally wait for an operation, then describe it'''
+    if operation is None:  # nothing was submitted, e.g. the model was unchanged
+        return {'vmss': scale_set.name, 'status': str(scale_set.status)}
+    if wait is True:
+        print(operation.name + ' submitted, waiting for it to finish', file=sys.stderr)
+        operation.poll_until_done(scale_set.access_token)
+    return {'vmss': scale_set.name, 'operation': operation.as_dict()}
+
+
+def cmd_list(vmss_catalog, args):
+    '''list the scale sets in the subscriptions'''
+    list_catalog(vmss_catalog, args.subscription)
+    result = []
+    for key in vmss_catalog.keys(args.subscription):
+        if args.resource_group is not None and key[1].lower() != args.resource_group.lower():
+            continue
+        model = vmss_catalog.models[key]
+        result.append({'subscriptionId': key[0], 'resourceGroup': key[1], 'name': key[2],
+                       'location': model['location'], 'capacity': model['sku']['capacity'],
+                       'vmSize': model['sku']['name'],
+                       'provisioningState': model['properties']['provisioningState']})
+    return result
+
+
+def cmd_show(vmss_catalog, args):
+    '''show a scale set, optionally with its VMs'''
+    scale_set = open_scale_set(vmss_catalog, args)
+    result = scale_set_summary(scale_set)
+    if args.vms is True:
+        result['vms'] = inventory_records(load_inventory(scale_set))
+    return result
+
+
+def cmd_scale(vmss_catalog, args):
+    '''set the capacity of a scale set'''
+    scale_set = open_scale_set(vmss_catalog, args, zones=False)
+    operation = scale_set.scale(args.capacity)
+    return finish_operation(scale_set, operation, args.wait)
+
+
+def cmd_update_model(vmss_catalog, args):
+    '''change the sku, image version or VM size of a scale set model'''
+    scale_set = open_scale_set(vmss_catalog, args, zones=False)
+    operation = scale_set.update_model(newsku=args.sku or scale_set.sku,
+                                       newversion=args.version or scale_set.version,
+                                       newvmsize=args.vmsize or scale_set.vmsize)
+    return finish_operation(scale_set, operation, args.wait)
+
+
+def cmd_vmss_action(vmss_catalog, args):
+    '''start, restart, power off or deallocate all the VMs in a scale set'''
+    scale_set = open_scale_set(vmss_catalog, args, zones=False)
+    operation = getattr(scale_set, VMSS_ACTIONS[args.action])()
+    return finish_operation(scale_set, operation, args.wait)
+
+
+def run_vm_action(scale_set, action, instance_ids, wait):
+    '''run a VM action on a list of instance ids'''
+    if len(instance_ids) == 0:
+        raise CliError('No VMs to ' + action)
+    operation = getattr(scale_set, VM_ACTIONS[action])(json.dumps(instance_ids))
+    return finish_operation(scale_set, operation, wait)
+
+
+def cmd_vm(vmss_catalog, args):
+    '''run an action on individual VMs'''
+    scale_set = open_scale_set(vmss_catalog, args, zones=False)
+    return run_vm_action(scale_set, args.action, args.instance_ids, args.wait)
+
+
+def cmd_fd(vmss_catalog, args):
+    '''run an action on every VM in a fault domain, across all placement groups'''
+    scale_set = open_scale_set(vmss_catalog, args, zones=False)
+    return run_vm_action(scale_set, args.action, load_inventory(scale_set).fd_ids(args.fd),
+                         args.wait)
+
+
+def cmd_zone(vmss_catalog, args):
+    '''run an action on every VM in an availability zone'''
+    scale_set = open_scale_set(vmss_catalog, args, zones=True)
+    return run_vm_action(scale_set, args.action, load_inventory(scale_set).zone_ids(args.zone),
+                         args.wait)
+
+
+def cmd_rolling_upgrade(vmss_catalog, args):
+    '''upgrade every VM to the latest model, placement groups or zones in parallel'''
+    scale_set = open_scale_set(vmss_catalog, args)
+    load_inventory(scale_set)
+    max_batchsize = None
+    if args.adaptive is True:
+        max_batchsize = max(args.batch_size, scale_set.capacity // 5)
+    engine = ru.DomainRollingUpgrade(
+        scale_set, scale_set.get_domain_groups(), args.batch_size, args.pause, args.max_vms,
+        status_fn=lambda message: print(message, file=sys.stderr),
+        health_budget=args.health_budget, adaptive=args.adaptive,
+        max_batchsize=max_batchsize)
+    try:
+        succeeded = engine.run()
+    except KeyboardInterrupt:
+        engine.stop()
+        succeeded = False
+    result = {'vmss': scale_set.name, 'succeeded': succeeded,
+              'batchCount': engine.batch_count, 'upgraded': engine.upgraded,
+              'unhealthy': engine.unhealthy, 'failedOperation': None}
+    if engine.failed_operation is not None:
+        result['failedOperation'] = engine.failed_operation.as_dict()
+    return result
+
+
+def cmd_bulk(vmss_catalog, args):
+    '''run an action on every scale set matching a selector'''
+    list_catalog(vmss_catalog, args.subscription)
+    keys = bulkops.select(vmss_catalog, args.name, args.resource_group, args.location,
+                          args.tag, args.subscription)
+    if len(keys) == 0:
+        raise CliError('No scale sets match the selector')
+    if args.dry_run is True:
+        return [{'subscriptionId': key[0], 'resourceGroup': key[1], 'name': key[2]}
+                for key in keys]
+    print(args.action + ' on ' + str(len(keys)) + ' scale sets', file=sys.stderr)
+    bulk = bulkops.BulkOperation(
+        vmss_catalog, keys, args.action, max_workers=args.concurrency,
+        min_interval=args.interval, wait=args.wait,
+        progress=lambda row: print(row['name'] + ': ' + row['state'], file=sys.stderr))
+    try:
+        results = bulk.run()
+    except KeyboardInterrupt:
+        bulk.stop()
+        results = bulk.results
+    return {'summary': bulk.summary(), 'results': results}
+
+
+def get_parser():
+    '''build the argument parser'''
+    parser = argparse.ArgumentParser(prog='python -m vmsscli',
+                                     description='Azure VM scale set operations')
+    parser.add_argument('--config', default='vmssconfig.json',
+                        help='app and subscription details, default ./vmssconfig.json')
+    parser.add_argument('--subscription', help='only look in this subscription id')
+    parser.add_argument('--resource-group', help='only look in this resource group')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='save ARM call timings to FILE when done, in Prometheus text '
+                        'format if it ends in .prom or .txt, else as JSON')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    command = commands.add_parser('list', help='list the scale sets in the subscriptions')
+    command.set_defaults(func=cmd_list)
+
+    command = commands.add_parser('show', help='show a scale set')
+    command.add_argument('vmss')
+    command.add_argument('--vms', action='store_true', help='include the VMs')
+    command.set_defaults(func=cmd_show)
+
+    command = commands.add_parser('scale', help='set the capacity of a scale set')
+    command.add_argument('vmss')
+    command.add_argument('capacity', type=int)
+    command.set_defaults(func=cmd_scale)
+
+    command = commands.add_parser('update-model', help='update the scale set model')
+    command.add_argument('vmss')
+    command.add_argument('--sku', help='platform image sku')
+    command.add_argument('--version', help='image version, or custom image')
+    command.add_argument('--vmsize', help='VM size')
+    command.set_defaults(func=cmd_update_model)
+
+    command = commands.add_parser('vmss', help='run an action on the whole scale set')
+    command.add_argument('vmss')
+    command.add_argument('action', choices=sorted(VMSS_ACTIONS))
+    command.set_defaults(func=cmd_vmss_action)
+
+    command = commands.add_parser('vm', help='run an action on individual VMs')
+    command.add_argument('vmss')
+    command.add_argument('action', choices=sorted(VM_ACTIONS))
+    command.add_argument('instance_ids', nargs='+', metavar='instance_id')
+    command.set_defaults(func=cmd_vm)
+
+    command = commands.add_parser('fd', help='run an action on a fault domain')
+    command.add_argument('vmss')
+    command.add_argument('fd', type=int, choices=range(5))
+    command.add_argument('action', choices=DOMAIN_ACTIONS)
+    command.set_defaults(func=cmd_fd)
+
+    command = commands.add_parser('zone', help='run an action on an availability zone')
+    command.add_argument('vmss')
+    command.add_argument('zone', type=int, choices=range(1, 4))
+    command.add_argument('action', choices=DOMAIN_ACTIONS)
+    command.set_defaults(func=cmd_zone)
+
+    for name in ('scale', 'update-model', 'vmss', 'vm', 'fd', 'zone'):
+        commands.choices[name].add_argument('--wait', action='store_true',
+                                            help='wait for the operation to finish')
+
+    command = commands.add_parser('bulk', help='run an action on many scale sets at once')
+    command.add_argument('action', choices=sorted(bulkops.ACTIONS))
+    command.add_argument('--name', default='*', help='scale set name glob, e.g. "dev-*"')
+    command.add_argument('--location', help='only scale sets in this region')
+    command.add_argument('--tag', action='append', default=[],
+                         help='key or key=value the scale set is tagged with, repeatable')
+    command.add_argument('--concurrency', type=int, default=8,
+                         help='most actions in flight at once')
+    command.add_argument('--interval', type=float, default=0,
+                         help='least seconds between submitting two actions, on top of '
+                              'the pacing from the ARM rate limit headers')
+    command.add_argument('--wait', action='store_true',
+                         help='wait for each operation to finish')
+    command.add_argument('--dry-run', action='store_true',
+                         help='list the matching scale sets without acting on them')
+    command.set_defaults(func=cmd_bulk)
+
+    command = commands.add_parser('rolling-upgrade',
+                                  help='upgrade all VMs to the latest model in batches')
+    command.add_argument('vmss')
+    command.add_argument('--batch-size', type=int, default=1)
+    command.add_argument('--pause', type=int, default=0, help='seconds between batches')
+    command.add_argument('--max-vms', type=int, help='most VMs upgrading at once')
+    command.add_argument('--health-budget', type=int,
+                         help='seconds for each batch to come back running')
+    command.add_argument('--adaptive', action='store_true',
+                         help='grow the batch size while batches come back healthy')
+    command.set_defaults(func=cmd_rolling_upgrade)
+    return parser
+
+
+def main(argv=None):
+    '''run a command, print its JSON result and return the exit code'''
+    args = get_parser().parse_args(argv)
+    try:
+        return run(args)
+    finally:
+        if args.metrics is not None:
+            metrics.save(args.metrics)
+
+
+def run(args):
+    '''run the command of a parsed command line, print its JSON result and return the exit
+       code
+    '''
+    if args.command == 'rolling-upgrade' and args.adaptive is True and \
+            args.health_budget is None:
+        args.health_budget = 300
+    # imported here rather than at startup, like the ArmClient does
+    import requests
+    try:
+        vmss_catalog = load_catalog(args.config)
+        result = args.func(vmss_catalog, args)
+    # connection errors, timeouts and HTTPErrors raised for 4xx/5xx responses are reported
+    # like the CLI's own errors
+    except (CliError, requests.RequestException) as error:
+        print(json.dumps({'error': str(error)}, indent=2))
+        return 1
+    print(json.dumps(result, indent=2))
+    if isinstance(result, dict) and 'summary' in result:
+        if set(result['summary']['states']) - {'Succeeded', 'InProgress'}:
+            return 1
+    elif isinstance(result, dict):
+        operation = result.get('operation')
+        if result.get('succeeded') is False or \
+                (operation is not None and operation['state'] in ('Failed', 'Canceled')):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,10 +5,18 @@ import os
 import sys
 import threading
 import tkinter as tk
-from time import sleep, strftime
+from contextlib import closing
+from time import localtime, strftime
 from tkinter import messagebox
 
-import subscription
+import catalog
+import dispatcher
+import heatmap as hm
+import metrics
+import polling
+import rollingupgrade as ru
+import snapshotcache
+import statspanel
 import vmss
 
 # size and color defaults
@@ -37,6 +45,9 @@ frame_bgcolor = '#B0E0E6'
 canvas_bgcolor = '#F0FFFF'
 btncolor = '#F8F8FF'
 
+# seconds an upgraded batch has to come back running in an adaptive rolling upgrade
+adaptive_health_budget = 300
+
 # Load Azure app defaults
 try:
     with open('vmssconfig.json') as configFile:
@@ -44,302 +55,181 @@ try:
 except FileNotFoundError:
     sys.exit('Error: Expecting vmssconfig.json in current folder')
 
-sub = subscription.subscription(config_data['tenantId'], config_data['appId'],
-                                config_data['appSecret'], config_data['subscriptionId'])
+# the scale sets of every subscription in the config, keyed by (sub_id, rgname, vmssname)
+vmss_catalog = catalog.Catalog(catalog.load_subscriptions(config_data),
+                               cache=snapshotcache.SnapshotCache())
 current_vmss = None
+current_key = None
 refresh_thread_running = False
-
-def subidkeepalive():
-    '''thread to keep access token alive'''
-    while True:
-        sleep(2000)
-        sub.auth()
-        current_vmss.update_token(sub.access_token)
+heatmap_generation = 0 # incremented each time the heatmap is reset
+# back off to at most 30 seconds between polls to avoid API throttling
+poller = polling.PollScheduler(min_interval=2, max_interval=30)
 
 def refresh_loop():
     '''thread to refresh details until provisioning is complete'''
     global refresh_thread_running
-    # refresh large scale sets slower to avoid API throttling
-    if current_vmss is not None:
-        if current_vmss.singlePlacementGroup is False:
-            sleep_time = 30
-        else:
-            sleep_time = 10
-
-        while True:
-            while refresh_thread_running is True:
+    # imported here rather than at startup, like the ArmClient does
+    import requests
+    heatmap_change = None  # operations.last_change() when the heatmap was last refreshed
+    while True:
+        # a failed API call is reported and retried after the idle wait below
+        try:
+            while refresh_thread_running is True and current_vmss is not None:
+                # while operations are in flight poll their status URLs, not the whole model
+                if len(current_vmss.operations.in_flight()) > 0:
+                    for operation in current_vmss.operations.poll(current_vmss.access_token):
+                        statusmsg(operation)
+                    in_flight = current_vmss.operations.in_flight()
+                    if len(in_flight) > 0:
+                        metrics.tick()
+                        poller.wait(poller.next_delay(len(in_flight),
+                                                      current_vmss.operations.retry_after()))
+                        continue
                 current_vmss.refresh_model()
+                if current_vmss.model_changed is True:
+                    vmss_catalog.update_model(current_key, current_vmss.model)
                 if current_vmss.status == 'Succeeded' or current_vmss.status == 'Failed':
                     refresh_thread_running = False
-                sleep(sleep_time)
-                vmssdetails()
-            sleep(10)
-
-def rolling_upgrade_engine(batchsize, pausetime, vmbyfd_list):
-    '''rolling upgrade thread'''
+                # only download the instance view again if the model changed or an
+                # operation started or finished since the last refresh
+                last_change = current_vmss.operations.last_change()
+                if current_vmss.model_changed is True or last_change != heatmap_change:
+                    heatmap_change = last_change
+                    refresh_heatmap(current_vmss, current_key)
+                metrics.tick()
+                # poll fast after an operation starts, back off while nothing changes
+                poller.wait(poller.next_delay(current_vmss.provisioningState,
+                                              current_vmss.retry_after))
+        except (requests.RequestException, ValueError) as error:
+            statusmsg('Error: ' + str(error))
+        poller.wait(10)
+
+def start_refresh():
+    '''start polling the scale set until the current operation is complete'''
     global refresh_thread_running
-    batch_count = 0 # to give user a running status update
-    # loop through all VMs
-    num_vms_to_upgrade = len(vmbyfd_list)
-    upgrade_index = 0 # running count of VMs updated or in batch to update
-    while upgrade_index < num_vms_to_upgrade:
-        batch_count += 1
-        # determine the next batch of VM IDs
-        batch_list = []
-        for batch_index in range(batchsize):
-            batch_list.append(vmbyfd_list[upgrade_index][0])
-            upgrade_index += 1
-            if upgrade_index == num_vms_to_upgrade:
-                break
-
-        # do an upgrade on the batch
-        statusmsg('Upgrading batch ' + str(batch_count))
-        current_vmss.upgradevm(json.dumps(batch_list))
-        statusmsg('Batch ' + str(batch_count) + ' status: ' + current_vmss.status)
-        refresh_thread_running = True
-
-        # wait for upgrade to complete
-        statusmsg('Batch ' + str(batch_count) + ' upgrade in progress')
-        while refresh_thread_running is True:
-            sleep(1)
-        print('Batch ' + str(batch_count) + ' complete')
-        # wait for pausetime
-        sleep(pausetime)
-    statusmsg('Rolling upgrade complete. Batch count: ' + str(batch_count))
-
-# start timer thread
-timer_thread = threading.Thread(target=subidkeepalive, args=())
-timer_thread.daemon = True
-timer_thread.start()
-
-# start refresh thread
-refresh_thread = threading.Thread(target=refresh_loop, args=())
-refresh_thread.daemon = True
-refresh_thread.start()
-
-
-def assign_color_to_power_state(powerstate):
-    '''visually represent VM powerstate with a color'''
-    if powerstate == 'running':
-        return 'green'
-    elif powerstate == 'stopped':
-        return 'red'
-    elif powerstate == 'starting':
-        return 'yellow'
-    elif powerstate == 'stopping':
-        return 'orange'
-    elif powerstate == 'deallocating':
-        return 'grey'
-    elif powerstate == 'deallocated':
-        return 'black'
-    else: # unknown
-        return 'blue'
-
-def draw_grid(originx, originy, row_height, ystart, xend, groupId):
-    '''draw a grid to delineate fault domains and update domains on the VMSS heatmap'''
-    vmcanvas.create_text(originx + 180, originy + 10, text='Placement group: ' + groupId)
-    # horizontal lines for UDs
-    for y in range(5):
-        ydelta = y * row_height
-        vmcanvas.create_text(originx + 15, originy + ydelta + 50, text='UD ' + str(y))
-        if y < 4:
-            vmcanvas.create_line(originx + 35, originy + ystart + ydelta, originx + 415, \
-                originy + ystart + ydelta)
-
-    # vertical lines for FDs
-    for x in range(5):
-        xdelta = x * 80
-        vmcanvas.create_text(originx + 45 + xdelta, originy + 30, text='FD ' + str(x))
-        if x < 4:
-            vmcanvas.create_line(originx + 110 + xdelta, originy + 40, originx + 110 + xdelta, \
-                originy + xend, dash=(4, 2))
-
-def draw_vms():
-    '''draw a heat map for the VMSS VMs'''
-    xval = 35
-    yval = 40
-    diameter = 10
-    row_height = 27
-    ystart = 60
-    xend = 170
-    originx = 0
-    originy = 0
-    current_vmss.set_domain_lists()
-    vmcanvas.delete("all")
-    if current_vmss.singlePlacementGroup is False and len(current_vmss.pg_list) > 1:
-        vbar.pack(side=tk.RIGHT, fill=tk.Y)
-        vbar.config(command=vmcanvas.yview)
-        vmcanvas.config(yscrollcommand=vbar.set)
-        vmcanvas.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
-        fontsize = 4
-    else:
-        fontsize = 5
-    pgcount = 0
-    for placementGroup in current_vmss.pg_list:
-        draw_grid(originx, originy, row_height, ystart, xend, placementGroup['guid'])
-        matrix = [[0 for x in range(5)] for y in range(5)]
-        for vm in placementGroup['vm_list']:
-            instance_id = vm[0]
-            fd = vm[1]
-            ud = vm[2]
-            powerstate = vm[3]
-            statuscolor = assign_color_to_power_state(powerstate)
-
-            # the purpose of this is to build up multiple rows of 5 in each UD/FD
-            row = matrix[ud][fd] // 5
-            xdelta = fd * 80 + (matrix[ud][fd] - row * 5) * 15
-            ydelta = ud * row_height + row * 30
-
-            # colored circle represents machine power state
-            vmcanvas.create_oval(originx + xval + xdelta, originy + yval + ydelta,
-                                 originx + xval + xdelta + diameter,
-                                 originy + yval + ydelta + diameter, fill=statuscolor)
-            # print VM ID under each circle
-            vmcanvas.create_text(originx + xval + xdelta + 7, originy + yval + ydelta + 15,
-                                 font=("Purisa", fontsize), text=instance_id)
-            matrix[ud][fd] += 1
-        originx += 425
-        pgcount += 1
-        if pgcount % 3 == 0:
-            originy += 170
-            originx = 0
-    vmcanvas.update_idletasks() # refresh the display
-    sleep(0.01) # add a little nap seems to make the display refresh more reliable
+    refresh_thread_running = True
+    poller.kick()
+
+
+def draw_vms(generation, vm_list):
+    '''add a page of VMs to the VMSS heat map, unless the heatmap has been reset since'''
+    if generation != heatmap_generation:
+        return
+    with metrics.span('render', step='draw_vms'):
+        heatmap.add_vms(vm_list)
+        if len(heatmap.groups) > 1 and not vbar.winfo_manager():
+            vbar.pack(side=tk.RIGHT, fill=tk.Y)
+            vbar.config(command=vmcanvas.yview)
+            vmcanvas.config(yscrollcommand=vbar.set)
+            vmcanvas.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        vmcanvas.update_idletasks() # refresh the display
 
 def getfds():
     '''build a list of fault domains'''
     fd = int(selectedfd.get())
-    fdinstancelist = []
-    # loop through placement groups
-    for pg in current_vmss.pg_list:
-        for entry in pg['fd_dict'][fd]:
-            fdinstancelist.append(entry[0])  # entry[0] is the instance id
-    # build list of FDs
-    return fdinstancelist
+    # the FD across all placement groups
+    return current_vmss.inventory.fd_ids(fd)
 
 
 def startfd():
     '''start all the VMs in a fault domain'''
-    global refresh_thread_running
     fdinstancelist = getfds()
-    current_vmss.startvm(json.dumps(fdinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.startvm, json.dumps(fdinstancelist))
 
 
 def powerfd():
     '''power off all the VMs in a fault domain'''
-    global refresh_thread_running
     fdinstancelist = getfds()
-    current_vmss.poweroffvm(json.dumps(fdinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweroffvm, json.dumps(fdinstancelist))
 
 
 def reimagefd():
     '''reimage all the VMs in a fault domain'''
-    global refresh_thread_running
     fdinstancelist = getfds()
-    current_vmss.reimagevm(json.dumps(fdinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.reimagevm, json.dumps(fdinstancelist))
 
 
 def upgradefd():
     '''upgrade all the VMs in a fault domain'''
-    global refresh_thread_running
     fdinstancelist = getfds()
-    current_vmss.upgradevm(json.dumps(fdinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.upgradevm, json.dumps(fdinstancelist))
 
 
 def rollingupgrade():
-    '''initiate a rolling upgrade to the latest model'''
+    '''initiate a rolling upgrade to the latest model
+       - placement groups are upgraded in parallel, with at most max VMs being upgraded
+    '''
     batchsize = int(batchtext.get())
     pausetime = int(pausetext.get())
+    max_vms = int(maxvmstext.get())
 
-    # get list of VMs ordered by FD - get this by concatenating the vmss fd_dict into a single list
-    vmbyfd_list = []
-    for fdval in range(5):
-        for pg in current_vmss.pg_list:
-            vmbyfd_list += pg['fd_dict'][fdval]
+    # adaptive mode grows the batch size while upgraded VMs come back running in time, up to
+    # 20% of the scale set
+    if adaptive.get() == 1:
+        health_budget = adaptive_health_budget
+        max_batchsize = max(batchsize, current_vmss.capacity // 5)
+    else:
+        health_budget = None
+        max_batchsize = None
 
     # launch rolling update thread
-    rolling_upgrade_thread = threading.Thread(target=rolling_upgrade_engine, \
-        args=(batchsize, pausetime, vmbyfd_list,))
+    engine = ru.DomainRollingUpgrade(current_vmss, current_vmss.get_domain_groups(), batchsize,
+                                     pausetime, max_vms, status_fn=statusmsg,
+                                     batch_fn=lambda count, operation: start_refresh(),
+                                     health_budget=health_budget, adaptive=adaptive.get() == 1,
+                                     max_batchsize=max_batchsize)
+    rolling_upgrade_thread = threading.Thread(target=engine.run, args=())
     rolling_upgrade_thread.daemon = True
     rolling_upgrade_thread.start()
 
 
 def reimagevm():
     '''reimage a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.reimagevm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.reimagevm, vmstring)
 
 
 def upgradevm():
     '''upgrade a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.upgradevm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.upgradevm, vmstring)
 
 
 def deletevm():
     '''delete a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.deletevm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.deletevm, vmstring)
 
 
 def startvm():
     '''start a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.startvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.startvm, vmstring)
 
 
 def restartvm():
     '''restart a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.restartvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.restartvm, vmstring)
 
 
 def deallocvm():
     '''stop dealloc a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.deallocvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.deallocvm, vmstring)
 
 
 def poweroffvm():
     '''power off a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.poweroffvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweroffvm, vmstring)
 
 
 # begin tkinter components
@@ -348,6 +238,8 @@ root.wm_title("Azure VM Scale Set Editor")
 root.geometry(geometry1)
 root.configure(background=frame_bgcolor)
 root.wm_iconbitmap('vmss.ico')
+# F2 opens a window with the ARM call and render timings
+root.bind('<F2>', lambda event: statspanel.StatsPanel(root, bgcolor=frame_bgcolor))
 topframe = tk.Frame(root, bg=frame_bgcolor)
 middleframe = tk.Frame(root, bg=frame_bgcolor)
 selectedfd = tk.StringVar()
@@ -355,6 +247,7 @@ vmcanvas = tk.Canvas(middleframe, height=canvas_height100, width=canvas_width100
                      scrollregion=(0, 0, canvas_width1000, canvas_height1000 + 110),
                      bg=canvas_bgcolor)
 vbar = tk.Scrollbar(middleframe, orient=tk.VERTICAL)
+heatmap = hm.DomainHeatmap(vmcanvas)
 vmframe = tk.Frame(root, bg=frame_bgcolor)
 baseframe = tk.Frame(root, bg=frame_bgcolor)
 topframe.pack(fill=tk.X)
@@ -369,6 +262,12 @@ pausetimelabel = tk.Label(vmframe, text='Pause time:', bg=frame_bgcolor)
 pausetext = tk.Entry(vmframe, width=11, bg=canvas_bgcolor)
 pausetext.delete(0, tk.END)
 pausetext.insert(0, '0')
+maxvmslabel = tk.Label(vmframe, text='Max VMs:', bg=frame_bgcolor)
+maxvmstext = tk.Entry(vmframe, width=11, bg=canvas_bgcolor)
+maxvmstext.delete(0, tk.END)
+maxvmstext.insert(0, '1')
+adaptive = tk.IntVar()
+adaptivecheck = tk.Checkbutton(vmframe, text='Adaptive', variable=adaptive, bg=frame_bgcolor)
 rollingbtn = tk.Button(vmframe, text='Rolling upgrade', command=rollingupgrade, width=btnwidth,
                        bg=btncolor)
 
@@ -404,17 +303,51 @@ statustext = tk.Text(baseframe, height=1, width=status_width, bg=canvas_bgcolor)
 
 
 def statusmsg(statusstring):
-    '''output a status message to screen'''
+    '''output a status message to screen - can be called from any thread'''
+    if not dispatch.on_ui_thread():
+        dispatch.call_soon(statusmsg, statusstring)
+        return
     st_message = strftime("%Y-%m-%d %H:%M:%S ") + str(statusstring)
     if statustext.get(1.0, tk.END):
         statustext.delete(1.0, tk.END)
     statustext.insert(tk.END, st_message)
 
 
-def displayvmss(vmssname):
+# API calls run on worker threads, results come back to the Tk thread through the dispatcher
+dispatch = dispatcher.Dispatcher(root, error_fn=lambda error: statusmsg('Error: ' + str(error)))
+
+# start refresh thread, once the dispatcher it reports through exists
+refresh_thread = threading.Thread(target=refresh_loop, args=())
+refresh_thread.daemon = True
+refresh_thread.start()
+
+
+def run_action(action, *args):
+    '''run a scale set action on a worker thread, then show its status and start polling'''
+    scale_set = current_vmss
+
+    def action_done(result):
+        '''Tk thread: the action request has returned'''
+        statusmsg(scale_set.status)
+        start_refresh()
+
+    dispatch.submit(action, *args, callback=action_done)
+
+
+def reset_heatmap():
+    '''clear the heatmap and ignore pages still arriving for the previous one'''
+    global heatmap_generation
+    heatmap_generation += 1
+    heatmap.reset()
+    return heatmap_generation
+
+
+def displayvmss(label):
     '''Display scale set details'''
-    global current_vmss
-    current_vmss = vmss.vmss(vmssname, sub.vmssdict[vmssname], sub.sub_id, sub.access_token)
+    global current_vmss, current_key
+    current_key = vmss_keys[label]
+    current_vmss = vmss_catalog.open(current_key, vmss.vmss)
+    reset_heatmap()
     # capacity - row 0
     locationlabel = tk.Label(topframe, text=current_vmss.location, width=btnwidth, justify=tk.LEFT,
                              bg=frame_bgcolor)
@@ -482,66 +415,106 @@ def displayvmss(vmssname):
 
     # status line
     statustext.pack()
-    statusmsg(current_vmss.status)
+    saved = vmss_catalog.is_stale(current_key)
+    if saved is None:
+        statusmsg(current_vmss.status)
+    else:
+        statusmsg(current_vmss.status + ' (cached ' +
+                  strftime('%Y-%m-%d %H:%M', localtime(saved)) + ', refreshing)')
 
 
 def scalevmss():
     '''scale a scale set in or out'''
-    global refresh_thread_running
     newcapacity = int(capacitytext.get())
-    current_vmss.scale(newcapacity)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.scale, newcapacity)
 
 
 def updatevmss():
     '''Update a scale set to VMSS model'''
-    global refresh_thread_running
     newsku = skutext.get()
     newversion = versiontext.get()
     newvmsize = vmsizetext.get()
-    current_vmss.update_model(newsku=newsku, newversion=newversion, newvmsize=newvmsize)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.update_model, newsku, newversion, newvmsize)
 
 
 def poweronvmss():
     '''Power on a VM scale set'''
-    global refresh_thread_running
-    current_vmss.poweron()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweron)
 
 def restartvmss():
     '''Restart' a VM scale set'''
-    global refresh_thread_running
-    current_vmss.restart()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.restart)
 
 def poweroffvmss():
     '''Power off a VM scale set'''
-    global refresh_thread_running
-    current_vmss.poweroff()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweroff)
 
 
 def deallocvmss():
     '''Stop deallocate on a VM scale set'''
-    global refresh_thread_running
-    current_vmss.dealloc()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.dealloc)
+
+
+def refresh_heatmap(scale_set, key):
+    '''worker thread: get the latest instance view and queue an in-place heatmap update'''
+    scale_set.load_vm_instance_view()
+    vmss_catalog.save_inventory(key, scale_set.inventory)
+    vm_list = scale_set.inventory.vm_list()
+    dispatch.call_soon(update_heatmap, scale_set, vm_list)
+
+
+def update_heatmap(scale_set, vm_list):
+    '''Tk thread: update the heatmap in place, only redrawing the VMs which changed'''
+    if scale_set is current_vmss:
+        with metrics.span('render', step='update_heatmap'):
+            heatmap.update(vm_list)
+            heatmap.set_stale(None)
+        statusmsg(get_status(scale_set))
+
+
+def load_heatmap(scale_set, key, generation):
+    '''worker thread: fetch the instance view and queue each page for drawing
+       - pages are prefetched in the background while the previous page is being drawn
+         and only the VMs on each new page are added to the heatmap
+       - stops fetching, and returns None, if the heatmap is reset meanwhile
+    '''
+    pages = scale_set.iter_vm_instance_view(progress=heatmap_progress)
+    with closing(pages):
+        for vm_list in pages:
+            if generation != heatmap_generation:  # reset since, stop fetching pages
+                return None
+            dispatch.call_soon(draw_vms, generation, vm_list)
+    vmss_catalog.save_inventory(key, scale_set.inventory)
+    return get_status(scale_set)
+
+
+def heatmap_loaded(status):
+    '''Tk thread: show the status once the heatmap has loaded, unless it was abandoned'''
+    if status is not None:
+        statusmsg(status)
+
+
+def get_status(scale_set):
+    '''status of a scale set, with the number of VMs left off the heatmap, if any'''
+    # VMs without a UD/FD yet aren't plotted, e.g. while scaling out
+    unplaced = len(scale_set.missing_instance_view)
+    if unplaced > 0:
+        return scale_set.status + ' - ' + str(unplaced) + ' VMs not shown yet'
+    return scale_set.status
+
+
+def heatmap_progress(page_count, vm_count):
+    '''report heatmap loading progress'''
+    statusmsg('Loading heatmap: ' + str(vm_count) + ' VMs in ' + str(page_count) + ' pages')
 
 
 def vmssdetails():
-    global vmsslist
-    # refresh VMSS model details
-    vmsslist = sub.get_vmss_list()
     '''Show VM scale set placement details'''
+    # draw the snapshot saved by the last run straight away, if there is one
+    cached = vmss_catalog.load_inventory(current_key)
+    groups = current_vmss.inventory.groups if cached is None else cached[0].groups
     # VMSS VM canvas - middle frame
-    if current_vmss.singlePlacementGroup == True or len(current_vmss.pg_list) < 2:
+    if current_vmss.singlePlacementGroup == True or len(groups) < 2:
         geometry2 = geometry100
         canvas_height = canvas_height100
         canvas_width = canvas_width100
@@ -552,15 +525,15 @@ def vmssdetails():
     root.geometry(geometry2)
     vmcanvas.config(height=canvas_height, width=canvas_width)
     vmcanvas.pack()
-    looping = True
-    nextLink = None
-    while looping is True:
-        current_vmss.grow_vm_instance_view(nextLink)
-        draw_vms()
-        if not 'nextLink' in current_vmss.vm_instance_view:
-            looping = False
-        else:
-            nextLink = current_vmss.vm_instance_view['nextLink']
+    generation = reset_heatmap()
+    if cached is None:
+        dispatch.submit(load_heatmap, current_vmss, current_key, generation,
+                        callback=heatmap_loaded)
+    else:
+        # show the snapshot as stale until the instance view has been fetched again
+        draw_vms(generation, cached[0].vm_list())
+        heatmap.set_stale(cached[1])
+        dispatch.submit(refresh_heatmap, current_vmss, current_key)
 
     # draw rollingframe components
     batchsizelabel.grid(row=0, column=1, sticky=tk.W)
@@ -582,27 +555,70 @@ def vmssdetails():
     vmupgradebtn.grid(row=2, column=3, sticky=tk.W)
     vmstartbtn.grid(row=2, column=4, sticky=tk.W)
     vmpoweroffbtn.grid(row=2, column=5, sticky=tk.W)
+    maxvmslabel.grid(row=3, column=0, sticky=tk.W)
+    maxvmstext.grid(row=3, column=1, sticky=tk.W)
     vmdeletebtn.grid(row=3, column=2, sticky=tk.W)
     vmrestartbtn.grid(row=3, column=3, sticky=tk.W)
     vmdeallocbtn.grid(row=3, column=4, sticky=tk.W)
+    adaptivecheck.grid(row=3, column=5, sticky=tk.W)
 
-    # draw status frame
-    statusmsg(current_vmss.status)
-
-# start by listing VM Scale Sets
-vmsslist = sub.get_vmss_list()
 selectedvmss = tk.StringVar()
-if len(vmsslist) > 0:
-    selectedvmss.set(vmsslist[0])
-    selectedfd.set('0')
-    displayvmss(vmsslist[0])
-    # create top level GUI components
-    vmsslistoption = tk.OptionMenu(topframe, selectedvmss, *vmsslist, command=displayvmss)
-    vmsslistoption.config(width=list_width, bg=btncolor, activebackground=btncolor)
-    vmsslistoption["menu"].config()
-    vmsslistoption.grid(row=0, column=0, sticky=tk.W)
-else:
-    messagebox.showwarning("Warning", "Your subscription:\n" + sub.sub_id +\
-                           "\ncontains no VM Scale Sets")
+vmss_keys = {}  # selector label -> catalog key
+vmsslistoption = None
+
+
+def show_vmss_list(sub_id, keys, error):
+    '''Tk thread: a subscription's VM Scale Set list has arrived, add it to the selector'''
+    global vmss_keys, vmsslistoption
+    if error is not None:
+        statusmsg('Error listing subscription ' + sub_id + ': ' + error)
+    if len(keys) == 0:
+        return
+    vmss_keys = {vmss_catalog.label(key): key for key in vmss_catalog.keys()}
+    labels = sorted(vmss_keys)
+    if vmsslistoption is None:
+        selectedvmss.set(labels[0])
+        selectedfd.set('0')
+        displayvmss(labels[0])
+        # create top level GUI components
+        vmsslistoption = tk.OptionMenu(topframe, selectedvmss, *labels, command=displayvmss)
+        vmsslistoption.config(width=list_width, bg=btncolor, activebackground=btncolor)
+        vmsslistoption["menu"].config()
+        vmsslistoption.grid(row=0, column=0, sticky=tk.W)
+    else:
+        menu = vmsslistoption["menu"]
+        menu.delete(0, tk.END)
+        for label in labels:
+            menu.add_command(label=label, command=tk._setit(selectedvmss, label, displayvmss))
+        # the scale set on display may have been opened from the cached list
+        if current_key in keys and current_vmss.model is not vmss_catalog.models[current_key]:
+            if current_vmss.model != vmss_catalog.models[current_key]:
+                displayvmss(selectedvmss.get())
+            else:
+                current_vmss.model = vmss_catalog.models[current_key]
+                statusmsg(current_vmss.status)
+
+
+def list_vmss():
+    '''worker thread: list the subscriptions concurrently, showing each as it arrives'''
+    for sub_id, keys, error in vmss_catalog.iter_refresh():
+        dispatch.call_soon(show_vmss_list, sub_id, keys, error)
+
+
+def vmss_listed(result):
+    '''Tk thread: every subscription has been listed'''
+    if len(vmss_catalog) == 0:
+        messagebox.showwarning("Warning", "Your subscriptions:\n" +
+                               "\n".join(vmss_catalog.subscriptions) +
+                               "\ncontain no VM Scale Sets")
+
+
+# show the window straight away, authenticating and listing VM Scale Sets on worker threads
+statustext.pack()
+if len(vmss_catalog) > 0:  # start with the list saved by the last run
+    show_vmss_list(None, vmss_catalog.keys(), None)
+statusmsg('Loading VM Scale Sets in ' + str(len(vmss_catalog.subscriptions)) +
+          ' subscription(s)')
+dispatch.submit(list_vmss, callback=vmss_listed)
 
 root.mainloop()
@@ -1,19 +1,33 @@
 '''vmssz.py - class of basic Azure VM scale set operations, without UDs, with zones'''
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-import azurerm
+import armclient
+import inventory
+import metrics
+import operations
+import polling
 
 
 class VMSSZ():
     '''VMSSZ class - encapsulates the model and status of a zone redundant VM scale set'''
 
-    def __init__(self, vmssname, vmssmodel, subscription_id, access_token):
-        '''class initializtion routine - set basic VMSS properties'''
+    def __init__(self, vmssname, vmssmodel, subscription_id, access_token, client=None,
+                 details_interval=120):
+        '''class initializtion routine - set basic VMSS properties
+           - access_token is a token string, or the subscription's TokenProvider to keep
+             using a current token
+           - client is the ArmClient to make REST calls with, default the shared one
+           - details_interval is the longest time in seconds refresh_model() goes without
+             refreshing the VM details of an unchanged scale set
+        '''
         self.name = vmssname
         vmssid = vmssmodel['id']
         self.rgname = vmssid[vmssid.index('resourceGroups/') + 15:vmssid.index('/providers')]
         self.sub_id = subscription_id
         self.access_token = access_token
+        self.client = client or armclient.get_client()
 
         self.model = vmssmodel
         self.adminuser = \
@@ -25,8 +39,9 @@ class VMSSZ():
         self.overprovision = vmssmodel['properties']['overprovision']
         self.vm_instance_view = None
         self.vm_model_view = None
-        self.pg_list = []
-        self.zones = []
+        self.inventory = inventory.VMInventory()
+        self.missing_instance_view = []
+        self.missing_model_view = []
         if 'zones' in vmssmodel:
             self.zonal = True
         else:
@@ -70,9 +85,66 @@ class VMSSZ():
         self.provisioningState = vmssmodel['properties']['provisioningState']
         self.status = self.provisioningState
 
+        # conditional read state for refresh_model()
+        self.model_etag = None
+        self.model_fingerprint = None
+        self.model_changed = False
+        self.retry_after = None
+
+        # long running operations started by this object - each action method returns the
+        # Operation it started
+        self.operations = operations.OperationTracker(self.client)
+
+        # when init_vm_details() last ran, see refresh_model()
+        self.details_interval = details_interval
+        self.details_time = None
+
     def refresh_model(self):
-        '''update the model, useful to see if provisioning is complete'''
-        vmssmodel = azurerm.get_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        '''update the model, useful to see if provisioning is complete
+           - the VM details are only refreshed when they may have changed, see
+             vm_details_stale()
+           - returns True if the VM details were refreshed
+        '''
+        self.refresh_vmss_model()
+        if self.vm_details_stale() is False:
+            return False
+        self.init_vm_details()
+        return True
+
+    def vm_details_stale(self):
+        '''decide whether the per-VM details need fetching again
+           - the scale set model changed (e.g. capacity or provisioning state)
+           - the scale set is not in a steady state, or an operation was started or has
+             finished since the details were fetched
+           - otherwise only every details_interval seconds
+        '''
+        if self.details_time is None or self.model_changed is True:
+            return True
+        if self.provisioningState != 'Succeeded':
+            return True
+        last_change = self.operations.last_change()
+        if last_change is not None and last_change >= self.details_time:
+            return True
+        return time.time() - self.details_time >= self.details_interval
+
+    def refresh_vmss_model(self):
+        '''update the scale set model
+           - the model is only re-parsed when its ETag or payload fingerprint has changed
+        '''
+        endpoint = self.client.vmss_url(self.sub_id, self.rgname, self.name)
+        response, self.model_changed, self.model_fingerprint = polling.conditional_get(
+            self.client, endpoint, self.access_token, self.model_etag, self.model_fingerprint)
+        self.retry_after = polling.get_retry_after(response.headers)
+        if response.status_code >= 400:
+            if response.status_code != 429:  # throttled polls are retried after retry_after
+                self.status = response.text
+            return
+        if self.model_changed is False:
+            # model unchanged, skip re-parsing it
+            self.status = self.provisioningState
+            return
+        self.model_etag = response.headers.get('ETag')
+        vmssmodel = response.json()
         self.model = vmssmodel
         self.capacity = vmssmodel['sku']['capacity']
         self.vmsize = vmssmodel['sku']['name']
@@ -82,14 +154,11 @@ class VMSSZ():
             self.version = vmssmodel['properties']['virtualMachineProfile']['storageProfile']['osDisk']['image']['uri']
         self.provisioningState = vmssmodel['properties']['provisioningState']
         self.status = self.provisioningState
-        self.init_vm_details()
-
-    def update_token(self, access_token):
-        '''update the token property'''
-        self.access_token = access_token
 
     def update_model(self, newsku, newversion, newvmsize):
-        '''update the VMSS model with any updated properties'''
+        '''update the VMSS model with any updated properties
+           - returns the Operation started, or None if the model is unchanged
+        '''
         changes = 0
         if self.sku != newsku:
             if self.image_type == 'platform':  # sku not relevant for custom image
@@ -120,135 +189,167 @@ class VMSSZ():
             self.vmsize = newvmsize
         if changes == 0:
             self.status = 'VMSS model is unchanged, skipping update'
+            return None
         else:
             # put the vmss model
-            updateresult = azurerm.update_vmss(self.access_token, self.sub_id, self.rgname,
-                                               self.name, json.dumps(self.model))
+            updateresult = self.client.update_vmss(self.access_token, self.sub_id, self.rgname,
+                                                   self.name, json.dumps(self.model))
             self.status = updateresult
+            return self.operations.start('update_model', updateresult)
 
     def scale(self, capacity):
         '''set the VMSS to a new capacity'''
         self.model['sku']['capacity'] = capacity
-        scaleoutput = azurerm.scale_vmss(self.access_token, self.sub_id, self.rgname, self.name,
-                                         capacity)
+        scaleoutput = self.client.scale_vmss(self.access_token, self.sub_id, self.rgname,
+                                             self.name, capacity)
         self.status = scaleoutput
+        return self.operations.start('scale', scaleoutput)
 
     def poweron(self):
         '''power on all the VMs in the scale set'''
-        result = azurerm.start_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'start')
         self.status = result
+        return self.operations.start('poweron', result)
 
     def restart(self):
         '''restart all the VMs in the scale set'''
-        result = azurerm.restart_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'restart')
         self.status = result
+        return self.operations.start('restart', result)
 
     def poweroff(self):
         '''power off all the VMs in the scale set'''
-        result = azurerm.poweroff_vmss(self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'powerOff')
         self.status = result
+        return self.operations.start('poweroff', result)
 
     def dealloc(self):
         '''stop deallocate all the VMs in the scale set'''
-        result = azurerm.stopdealloc_vmss(
-            self.access_token, self.sub_id, self.rgname, self.name)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'deallocate')
         self.status = result
+        return self.operations.start('dealloc', result)
 
     def init_vm_instance_view(self):
         '''get the VMSS instance view and set the class property'''
         # get an instance view list in order to build FD heatmap
         self.vm_instance_view = \
-            azurerm.list_vmss_vm_instance_view(self.access_token, self.sub_id, self.rgname,
-                                               self.name)
+            self.client.list_vmss_vm_instance_view(self.access_token, self.sub_id, self.rgname,
+                                                   self.name)
 
     def init_vm_model_view(self):
         '''get the VMSS instance view and set the class property'''
         # get a model view list in order to build a zones heatmap
         self.vm_model_view = \
-            azurerm.list_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name)
+            self.client.list_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name)
 
     def reimagevm(self, vmstring):
         '''reaimge individual VMs or groups of VMs in a scale set'''
-        result = azurerm.reimage_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                          vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'reimage', vmstring)
         self.status = result
+        return self.operations.start('reimagevm', result, vmstring)
 
     def upgradevm(self, vmstring):
         '''upgrade individual VMs or groups of VMs in a scale set'''
-        result = azurerm.upgrade_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                          vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'manualupgrade', vmstring)
         self.status = result
+        return self.operations.start('upgradevm', result, vmstring)
 
     def deletevm(self, vmstring):
         '''delete individual VMs or groups of VMs in a scale set'''
-        result = azurerm.delete_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                         vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'delete', vmstring)
         self.status = result
+        return self.operations.start('deletevm', result, vmstring)
 
     def startvm(self, vmstring):
         '''start individual VMs or groups of VMs in a scale set'''
-        result = azurerm.start_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                        vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'start', vmstring)
         self.status = result
+        return self.operations.start('startvm', result, vmstring)
 
     def restartvm(self, vmstring):
         '''restart individual VMs or groups of VMs in a scale set'''
-        result = azurerm.restart_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                          vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'restart', vmstring)
         self.status = result
+        return self.operations.start('restartvm', result, vmstring)
 
     def deallocvm(self, vmstring):
         '''dealloc individual VMs or groups of VMs in a scale set'''
-        result = azurerm.stopdealloc_vmss_vms(self.access_token, self.sub_id, self.rgname,
-                                              self.name, vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'deallocate', vmstring)
         self.status = result
+        return self.operations.start('deallocvm', result, vmstring)
 
     def poweroffvm(self, vmstring):
         '''power off individual VMs or groups of VMs in a scale set'''
-        result = azurerm.poweroff_vmss_vms(self.access_token, self.sub_id, self.rgname, self.name,
-                                           vmstring)
+        result = self.client.vmss_action(self.access_token, self.sub_id, self.rgname,
+                                         self.name, 'powerOff', vmstring)
         self.status = result
+        return self.operations.start('poweroffvm', result, vmstring)
 
-    def get_power_state(self, statuses):
-        '''get power state from a list of VM isntance statuses'''
-        for status in statuses:
-            if status['code'].startswith('Power'):
-                return status['code'][11:]
+    def get_vm_power_states(self, instance_ids):
+        '''get the current power state of a list of VMs as an {instance id: power state} dict'''
+        return inventory.get_vm_power_states(self.client, self.access_token, self.sub_id,
+                                             self.rgname, self.name, instance_ids)
 
-    def init_zones(self):
-        '''create a structure to represent VMs by zone and FD
-           - ignore placement groups for now.
-        '''
-        self.zones = []
-        for zone_id in range(1, 4):
-            zone = {'zone': zone_id}
-            fds = []
-            for fd_num in range(5):
-                fault_domain = {'fd': fd_num, 'vms': []}
-                fds.append(fault_domain)
-            zone['fds'] = fds
-            self.zones.append(zone)
+    def get_domain_groups(self):
+        '''map each zone to a {fd: [instance ids]} dict'''
+        return self.inventory.zone_groups()
 
     def init_vm_details(self):
-        '''Populate the self.zones structure
+        '''Populate the self.inventory VM inventory
            - with a physically ordered representation of the VMs in a scale set.
+           - the model view and instance view lists are fetched concurrently, each following
+             its nextLink chain, and joined on instanceId
+           - VMs missing from either list (e.g. while scaling) are listed in
+             self.missing_instance_view and self.missing_model_view instead of being plotted
         '''
-        self.init_zones()
-        # get the model view
-        self.vm_model_view = azurerm.list_vmss_vms(self.access_token, self.sub_id, self.rgname,
-                                                   self.name)
-        # get the instance view
-        self.vm_instance_view = azurerm.list_vmss_vm_instance_view(self.access_token, self.sub_id,
-                                                                   self.rgname, self.name)
-        # do a loop through the number of VMs and populate VMs properties in the zones structure
-        # make an assumption that len(vm_model_view) == len(vm_instance_view)
-        #   - true if not actively scaling
-        for idx in range(len(self.vm_model_view['value'])):
-            vm_id = self.vm_model_view['value'][idx]['instanceId']
-            zone_num = self.vm_model_view['value'][idx]['zones'][0]
-            power_state = self.get_power_state(
-                self.vm_instance_view['value'][idx]['properties']['instanceView']['statuses'])
-            fault_domain = self.vm_instance_view['value'][idx]['properties']['instanceView']['platformFaultDomain']
-            vm_data = {'vmid': vm_id, 'power_state': power_state}
-            self.zones[int(zone_num)-1]['fds'][fault_domain]['vms'].append(vm_data)
-        #print(json.dumps(self.zones))
+        fetch_time = time.time()
+        with metrics.span('fetch', call='init_vm_details'), \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            model_future = executor.submit(self.client.list_vmss_vms, self.access_token,
+                                           self.sub_id, self.rgname, self.name)
+            instance_future = executor.submit(self.client.list_vmss_vm_instance_view,
+                                              self.access_token, self.sub_id, self.rgname,
+                                              self.name)
+            vm_model_view = model_future.result()
+            vm_instance_view = instance_future.result()
+        self.details_time = fetch_time
+        for view in (vm_model_view, vm_instance_view):
+            if 'value' not in view:
+                self.status = 'Error getting VM details: ' + json.dumps(view)
+                return
+        self.vm_model_view = vm_model_view
+        self.vm_instance_view = vm_instance_view
+
+        with metrics.span('process', step='init_vm_details'):
+            # index the instance views by instanceId, then walk the model view once
+            instance_index = {instance['instanceId']: instance
+                              for instance in vm_instance_view['value']}
+            vm_inventory = inventory.VMInventory()
+            missing_instance_view = []
+            for vm in vm_model_view['value']:
+                vm_id = vm['instanceId']
+                instance = instance_index.pop(vm_id, None)
+                try:
+                    instance_view = instance['properties']['instanceView']
+                    fault_domain = instance_view['platformFaultDomain']
+                except (KeyError, TypeError):  # no instance view, or FD not assigned yet
+                    missing_instance_view.append(vm_id)
+                    continue
+                zone_num = int(vm['zones'][0]) if 'zones' in vm else 0
+                power = inventory.decode_power_state(instance_view['statuses'])
+                vm_inventory.add(vm_id, 'single group', fault_domain,
+                                 instance_view.get('platformUpdateDomain', 0), power, zone_num)
+            self.missing_instance_view = missing_instance_view
+            # whatever is left in the index has no model view
+            self.missing_model_view = list(instance_index)
+        self.inventory = vm_inventory
@@ -5,10 +5,16 @@ import os
 import sys
 import threading
 import tkinter as tk
-from time import sleep, strftime
+from time import localtime, strftime
 from tkinter import messagebox
 
-import subscription
+import catalog
+import dispatcher
+import heatmap as hm
+import metrics
+import polling
+import snapshotcache
+import statspanel
 import vmssz
 
 # size and color defaults
@@ -44,234 +50,153 @@ try:
 except FileNotFoundError:
     sys.exit('Error: Expecting vmssconfig.json in current folder')
 
-sub = subscription.subscription(config_data['tenantId'], config_data['appId'],
-                                config_data['appSecret'], config_data['subscriptionId'])
+# the scale sets of every subscription in the config, keyed by (sub_id, rgname, vmssname)
+vmss_catalog = catalog.Catalog(catalog.load_subscriptions(config_data),
+                               cache=snapshotcache.SnapshotCache())
 current_vmss = None
+current_key = None
 refresh_thread_running = False
-
-def subidkeepalive():
-    '''thread to keep access token alive'''
-    while True:
-        sleep(2000)
-        sub.auth()
-        current_vmss.update_token(sub.access_token)
+poller = polling.PollScheduler(min_interval=2, max_interval=30)
 
 def refresh_loop():
     '''thread to refresh details until provisioning is complete'''
     global refresh_thread_running
-    sleep_time = 5
+    # imported here rather than at startup, like the ArmClient does
+    import requests
     while True:
-        while refresh_thread_running is True:
-            current_vmss.refresh_model()
-            # for demoing small scale sets - dont' switch off refresh
-            # if current_vmss.status == 'Succeeded' or current_vmss.status == 'Failed':
-            if current_vmss.status == 'Failed':
-                refresh_thread_running = False
-            sleep(sleep_time)
-            vmssdetails()
-        sleep(sleep_time)
-
-
-# start timer thread
-timer_thread = threading.Thread(target=subidkeepalive, args=())
-timer_thread.daemon = True
-timer_thread.start()
-
-# start refresh thread
-refresh_thread = threading.Thread(target=refresh_loop, args=())
-refresh_thread.daemon = True
-refresh_thread.start()
-
-
-def assign_color_to_power_state(powerstate):
-    '''visually represent VM powerstate with a color'''
-    if powerstate == 'running':
-        return 'green'
-    elif powerstate == 'stopped':
-        return 'red'
-    elif powerstate == 'starting':
-        return 'yellow'
-    elif powerstate == 'stopping':
-        return 'orange'
-    elif powerstate == 'deallocating':
-        return 'grey'
-    elif powerstate == 'deallocated':
-        return 'black'
-    else: # unknown
-        return 'blue'
-
-def draw_grid(originx, originy, row_height, ystart, zone):
-    '''draw a grid to delineate zones and fault domains on the VMSS heatmap'''
-    vmcanvas.create_text(originx + 180, originy + 10, text='Zone: ' + str(zone))
-
-    # horizontal lines for FDs
-    for y in range(5):
-        ydelta = y * row_height
-        vmcanvas.create_text(originx + 20, originy + ydelta + 50, text='FD ' + str(y))
-        if y < 4:
-            vmcanvas.create_line(originx + 35, originy + ystart + ydelta, originx + 390, \
-                originy + ystart + ydelta)
-
-
-def draw_vms():
-    '''draw a heat map for the VMSS VMs'''
-    xval = 55
-    yval = 40
-    diameter = 10
-    row_height = 27
-    ystart = 60
-    originx = 0
-    originy = 0
-
-    vmcanvas.delete("all")
-    # one rectangle for each zone
-    vmcanvas.create_rectangle(0, 0, canvas_width1000/3, canvas_height100,
-                              outline="#FFFACD", fill="#FFFACD")
-    vmcanvas.create_rectangle(canvas_width1000/3, 0, 2*canvas_width1000/3, canvas_height100,
-                              outline="#C1FFC1", fill="#C1FFC1")
-    vmcanvas.create_rectangle(2*canvas_width1000/3, 0, canvas_width1000, canvas_height100,
-                              outline="#fd0", fill="#fd0")
-    # draw 3 'zones' on canvas
-    fontsize = 5
-    for zone in current_vmss.zones:
-        draw_grid(originx, originy, row_height, ystart, zone['zone'])
-        for zfd in zone['fds']:
-            fd_id = zfd['fd']
-            xinc = xval
-            for vm_info in zfd['vms']:
-                instance_id = vm_info['vmid']
-                powerstate = vm_info['power_state']
-                statuscolor = assign_color_to_power_state(powerstate)
-                ydelta = int(fd_id) * 26
-                # colored circle represents machine power state
-                vmcanvas.create_oval(originx + xinc, originy + yval + ydelta,
-                                     originx + xinc + diameter,
-                                     originy + yval + ydelta + diameter, fill=statuscolor)
-                # print VM ID under each circle
-                vmcanvas.create_text(originx + xinc + 7, originy + yval + ydelta + 15,
-                                     font=("Purisa", fontsize), text=instance_id)
-                xinc += 20
-
-        originx += canvas_width1000/3
-    vmcanvas.update_idletasks() # refresh the display
-    sleep(0.01) # add a little nap seems to make the display refresh more reliable
+        # a failed API call is reported and retried after the idle wait below
+        try:
+            while refresh_thread_running is True and current_vmss is not None:
+                # while operations are in flight poll their status URLs, not the whole model
+                if len(current_vmss.operations.in_flight()) > 0:
+                    for operation in current_vmss.operations.poll(current_vmss.access_token):
+                        statusmsg(operation)
+                    in_flight = current_vmss.operations.in_flight()
+                    if len(in_flight) > 0:
+                        metrics.tick()
+                        poller.wait(poller.next_delay(len(in_flight),
+                                                      current_vmss.operations.retry_after()))
+                        continue
+                # VM details are only fetched again when the scale set may have changed
+                details_changed = current_vmss.refresh_model()
+                if current_vmss.model_changed is True:
+                    vmss_catalog.update_model(current_key, current_vmss.model)
+                # for demoing small scale sets - dont' switch off refresh
+                # if current_vmss.status == 'Succeeded' or current_vmss.status == 'Failed':
+                if current_vmss.status == 'Failed':
+                    refresh_thread_running = False
+                # refresh_model() has already fetched the VM details, draw them on the Tk thread
+                if details_changed is True:
+                    vmss_catalog.save_inventory(current_key, current_vmss.inventory)
+                    dispatch.call_soon(draw_vms, current_vmss)
+                metrics.tick()
+                # poll fast after an operation starts, back off while nothing changes
+                poller.wait(poller.next_delay(current_vmss.provisioningState,
+                                              current_vmss.retry_after))
+        except (requests.RequestException, ValueError) as error:
+            statusmsg('Error: ' + str(error))
+        poller.wait(5)
+
+
+def start_refresh():
+    '''start polling the scale set until the current operation is complete'''
+    global refresh_thread_running
+    refresh_thread_running = True
+    poller.kick()
+
+
+def draw_vms(scale_set):
+    '''update the heat map for the VMSS VMs, only redrawing the VMs which changed'''
+    if scale_set is not current_vmss: # another scale set has been selected since
+        return
+    with metrics.span('render', step='draw_vms'):
+        heatmap.update(scale_set.inventory)
+        heatmap.set_stale(None)
+        vmcanvas.update_idletasks() # refresh the display
+    # VMs in only one of the model and instance views aren't plotted, e.g. while scaling
+    unmatched = len(scale_set.missing_instance_view) + len(scale_set.missing_model_view)
+    if unmatched > 0:
+        statusmsg(scale_set.status + ' - ' + str(unmatched) + ' VMs not shown yet')
+    else:
+        statusmsg(scale_set.status)
 
 def getzones():
     '''build a list of vm ids by zone'''
     zone_num = int(selectedz.get())
-    zinstancelist = []
-    # loop through fds
-    for fdomain in current_vmss.zones[int(zone_num)-1]['fds']:
-        for vm_info in fdomain['vms']:
-            zinstancelist.append(vm_info['vmid'])
-    # build list of VM IDs in the zone
-    return zinstancelist
+    return current_vmss.inventory.zone_ids(zone_num)
 
 
 def startz():
     '''start all the VMs in a fault domain'''
-    global refresh_thread_running
     zinstancelist = getzones()
-    current_vmss.startvm(json.dumps(zinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.startvm, json.dumps(zinstancelist))
 
 
 def powerz():
     '''power off all the VMs in a fault domain'''
-    global refresh_thread_running
     zinstancelist = getzones()
-    current_vmss.poweroffvm(json.dumps(zinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweroffvm, json.dumps(zinstancelist))
 
 
 def reimagez():
     '''reimage all the VMs in a fault domain'''
-    global refresh_thread_running
     zinstancelist = getzones()
-    current_vmss.reimagevm(json.dumps(zinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.reimagevm, json.dumps(zinstancelist))
 
 
 def upgradez():
     '''upgrade all the VMs in a fault domain'''
-    global refresh_thread_running
     zinstancelist = getzones()
-    current_vmss.upgradevm(json.dumps(zinstancelist))
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.upgradevm, json.dumps(zinstancelist))
 
 
 def reimagevm():
     '''reimage a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.reimagevm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.reimagevm, vmstring)
 
 
 def upgradevm():
     '''upgrade a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.upgradevm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.upgradevm, vmstring)
 
 
 def deletevm():
     '''delete a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.deletevm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.deletevm, vmstring)
 
 
 def startvm():
     '''start a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.startvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.startvm, vmstring)
 
 
 def restartvm():
     '''restart a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.restartvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.restartvm, vmstring)
 
 
 def deallocvm():
     '''stop dealloc a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.deallocvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.deallocvm, vmstring)
 
 
 def poweroffvm():
     '''power off a VM or list of VMs'''
-    global refresh_thread_running
     vmid = vmtext.get()
     vmstring = '["' + vmid + '"]'
-    current_vmss.poweroffvm(vmstring)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweroffvm, vmstring)
 
 
 # begin tkinter components
@@ -280,6 +205,8 @@ root.wm_title("Azure VM Scale Set Editor - Zones")
 root.geometry(geometry1)
 root.configure(background=frame_bgcolor)
 root.wm_iconbitmap('vmss.ico')
+# F2 opens a window with the ARM call and render timings
+root.bind('<F2>', lambda event: statspanel.StatsPanel(root, bgcolor=frame_bgcolor))
 topframe = tk.Frame(root, bg=frame_bgcolor)
 middleframe = tk.Frame(root, bg=frame_bgcolor)
 selectedz = tk.StringVar()
@@ -287,6 +214,7 @@ vmcanvas = tk.Canvas(middleframe, height=canvas_height100, width=canvas_width100
                      scrollregion=(0, 0, canvas_width1000, canvas_height1000 + 110),
                      bg=canvas_bgcolor)
 vbar = tk.Scrollbar(middleframe, orient=tk.VERTICAL)
+heatmap = hm.ZoneHeatmap(vmcanvas, canvas_width1000, canvas_height100)
 vmframe = tk.Frame(root, bg=frame_bgcolor)
 baseframe = tk.Frame(root, bg=frame_bgcolor)
 topframe.pack(fill=tk.X)
@@ -324,18 +252,43 @@ statustext = tk.Text(baseframe, height=1, width=status_width, bg=canvas_bgcolor)
 
 
 def statusmsg(statusstring):
-    '''output a status message to screen'''
+    '''output a status message to screen - can be called from any thread'''
+    if not dispatch.on_ui_thread():
+        dispatch.call_soon(statusmsg, statusstring)
+        return
     st_message = strftime("%Y-%m-%d %H:%M:%S ") + str(statusstring)
     if statustext.get(1.0, tk.END):
         statustext.delete(1.0, tk.END)
     statustext.insert(tk.END, st_message)
 
 
-def displayvmss(vmssname):
+# API calls run on worker threads, results come back to the Tk thread through the dispatcher
+dispatch = dispatcher.Dispatcher(root, error_fn=lambda error: statusmsg('Error: ' + str(error)))
+
+# start refresh thread, once the dispatcher it reports through exists
+refresh_thread = threading.Thread(target=refresh_loop, args=())
+refresh_thread.daemon = True
+refresh_thread.start()
+
+
+def run_action(action, *args):
+    '''run a scale set action on a worker thread, then show its status and start polling'''
+    scale_set = current_vmss
+
+    def action_done(result):
+        '''Tk thread: the action request has returned'''
+        statusmsg(scale_set.status)
+        start_refresh()
+
+    dispatch.submit(action, *args, callback=action_done)
+
+
+def displayvmss(label):
     '''Display scale set details'''
-    global current_vmss
-    global refresh_thread_running
-    current_vmss = vmssz.VMSSZ(vmssname, sub.vmssdict[vmssname], sub.sub_id, sub.access_token)
+    global current_vmss, current_key
+    current_key = vmss_keys[label]
+    current_vmss = vmss_catalog.open(current_key, vmssz.VMSSZ)
+    heatmap.reset()
     # capacity - row 0
     locationlabel = tk.Label(topframe, text=current_vmss.location, width=btnwidth, justify=tk.LEFT,
                              bg=frame_bgcolor)
@@ -403,66 +356,56 @@ def displayvmss(vmssname):
 
     # status line
     statustext.pack(side=tk.LEFT)
-    statusmsg(current_vmss.status)
+    saved = vmss_catalog.is_stale(current_key)
+    if saved is None:
+        statusmsg(current_vmss.status)
+    else:
+        statusmsg(current_vmss.status + ' (cached ' +
+                  strftime('%Y-%m-%d %H:%M', localtime(saved)) + ', refreshing)')
     if current_vmss.status != 'Failed':
-        refresh_thread_running = True
+        start_refresh()
 
 
 def scalevmss():
     '''scale a scale set in or out'''
-    global refresh_thread_running
     newcapacity = int(capacitytext.get())
-    current_vmss.scale(newcapacity)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.scale, newcapacity)
 
 
 def updatevmss():
     '''Update a scale set to VMSS model'''
-    global refresh_thread_running
     newsku = skutext.get()
     newversion = versiontext.get()
     newvmsize = vmsizetext.get()
-    current_vmss.update_model(newsku=newsku, newversion=newversion, newvmsize=newvmsize)
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.update_model, newsku, newversion, newvmsize)
 
 
 def poweronvmss():
     '''Power on a VM scale set'''
-    global refresh_thread_running
-    current_vmss.poweron()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweron)
 
 def restartvmss():
     '''Restart' a VM scale set'''
-    global refresh_thread_running
-    current_vmss.restart()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.restart)
 
 def poweroffvmss():
     '''Power off a VM scale set'''
-    global refresh_thread_running
-    current_vmss.poweroff()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.poweroff)
 
 
 def deallocvmss():
     '''Stop deallocate on a VM scale set'''
-    global refresh_thread_running
-    current_vmss.dealloc()
-    statusmsg(current_vmss.status)
-    refresh_thread_running = True
+    run_action(current_vmss.dealloc)
+
+
+def load_vm_details(scale_set, key):
+    '''worker thread: fetch the VM details and keep them for the next start'''
+    scale_set.init_vm_details()
+    vmss_catalog.save_inventory(key, scale_set.inventory)
 
 
 def vmssdetails():
     '''Show VM scale set zone placement details'''
-    global vmsslist
-    # refresh VMSS model details
-    vmsslist = sub.get_vmss_list()
     # VMSS VM canvas - middle frame
     geometry2 = geometry_wide
     canvas_height = canvas_height100
@@ -471,8 +414,16 @@ def vmssdetails():
     root.geometry(geometry2)
     vmcanvas.config(height=canvas_height, width=canvas_width)
     vmcanvas.pack(side=tk.LEFT)
-    current_vmss.init_vm_details()
-    draw_vms()
+    # draw the snapshot saved by the last run straight away, if there is one, flagged as
+    # stale until the VM details have been fetched again
+    cached = vmss_catalog.load_inventory(current_key)
+    if cached is not None:
+        heatmap.update(cached[0])
+        heatmap.set_stale(cached[1])
+    # fetch the VM details on a worker thread and draw them when they arrive
+    scale_set = current_vmss
+    dispatch.submit(load_vm_details, scale_set, current_key,
+                    callback=lambda result: draw_vms(scale_set))
 
     # draw VM frame components
     zlabel.grid(row=1, column=0, sticky=tk.W)
@@ -491,23 +442,63 @@ def vmssdetails():
     vmrestartbtn.grid(row=3, column=3, sticky=tk.W)
     vmdeallocbtn.grid(row=3, column=4, sticky=tk.W)
 
-    # draw status frame
-    statusmsg(current_vmss.status)
-
-# start by listing VM Scale Sets
-vmsslist = sub.get_vmss_list()
 selectedvmss = tk.StringVar()
-if len(vmsslist) > 0:
-    selectedvmss.set(vmsslist[0])
-    selectedz.set('1')
-    displayvmss(vmsslist[0])
-    # create top level GUI components
-    vmsslistoption = tk.OptionMenu(topframe, selectedvmss, *vmsslist, command=displayvmss)
-    vmsslistoption.config(width=list_width, bg=btncolor, activebackground=btncolor)
-    vmsslistoption["menu"].config()
-    vmsslistoption.grid(row=0, column=0, sticky=tk.W)
-else:
-    messagebox.showwarning("Warning", "Your subscription:\n" + sub.sub_id +\
-                           "\ncontains no VM Scale Sets")
+vmss_keys = {}  # selector label -> catalog key
+vmsslistoption = None
+
+
+def show_vmss_list(sub_id, keys, error):
+    '''Tk thread: a subscription's VM Scale Set list has arrived, add it to the selector'''
+    global vmss_keys, vmsslistoption
+    if error is not None:
+        statusmsg('Error listing subscription ' + sub_id + ': ' + error)
+    if len(keys) == 0:
+        return
+    vmss_keys = {vmss_catalog.label(key): key for key in vmss_catalog.keys()}
+    labels = sorted(vmss_keys)
+    if vmsslistoption is None:
+        selectedvmss.set(labels[0])
+        selectedz.set('1')
+        displayvmss(labels[0])
+        # create top level GUI components
+        vmsslistoption = tk.OptionMenu(topframe, selectedvmss, *labels, command=displayvmss)
+        vmsslistoption.config(width=list_width, bg=btncolor, activebackground=btncolor)
+        vmsslistoption["menu"].config()
+        vmsslistoption.grid(row=0, column=0, sticky=tk.W)
+    else:
+        menu = vmsslistoption["menu"]
+        menu.delete(0, tk.END)
+        for label in labels:
+            menu.add_command(label=label, command=tk._setit(selectedvmss, label, displayvmss))
+        # the scale set on display may have been opened from the cached list
+        if current_key in keys and current_vmss.model is not vmss_catalog.models[current_key]:
+            if current_vmss.model != vmss_catalog.models[current_key]:
+                displayvmss(selectedvmss.get())
+            else:
+                current_vmss.model = vmss_catalog.models[current_key]
+                statusmsg(current_vmss.status)
+
+
+def list_vmss():
+    '''worker thread: list the subscriptions concurrently, showing each as it arrives'''
+    for sub_id, keys, error in vmss_catalog.iter_refresh():
+        dispatch.call_soon(show_vmss_list, sub_id, keys, error)
+
+
+def vmss_listed(result):
+    '''Tk thread: every subscription has been listed'''
+    if len(vmss_catalog) == 0:
+        messagebox.showwarning("Warning", "Your subscriptions:\n" +
+                               "\n".join(vmss_catalog.subscriptions) +
+                               "\ncontain no VM Scale Sets")
+
+
+# show the window straight away, authenticating and listing VM Scale Sets on worker threads
+statustext.pack(side=tk.LEFT)
+if len(vmss_catalog) > 0:  # start with the list saved by the last run
+    show_vmss_list(None, vmss_catalog.keys(), None)
+statusmsg('Loading VM Scale Sets in ' + str(len(vmss_catalog.subscriptions)) +
+          ' subscription(s)')
+dispatch.submit(list_vmss, callback=vmss_listed)
 
 root.mainloop()